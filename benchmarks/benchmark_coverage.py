@@ -0,0 +1,259 @@
+import os
+import re
+import sys
+import time
+import random
+import argparse
+
+import numpy as np
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+)
+
+from processing import (
+    automaton_trie,
+    automaton_matching,
+    accumulate_coverage,
+    expand_hits,
+    build_ptm_site_table,
+    process_aho_result,
+)
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+PTM_MASSES = {"S": "[79.9663]", "T": "[79.9663]", "Y": "[79.9663]", "M": "[15.9949]"}
+
+
+def synthetic_proteome(n_proteins, seed):
+    """
+    Random proteome with a UniProt-like length distribution (median ~450 residues)
+    """
+    rnd = random.Random(seed)
+    return {
+        f"S{i:06d}": {
+            "sequence": "".join(
+                rnd.choices(AMINO_ACIDS, k=max(30, int(rnd.lognormvariate(6.1, 0.6))))
+            ),
+            "gene": f"GENE{i}",
+            "des": f"Synthetic protein {i}",
+        }
+        for i in range(n_proteins)
+    }
+
+
+def sample_psms(protein_dict, n_peptides, groups, seed):
+    """
+    Sample peptides from the proteome with 1-5 PSMs each, randomly modified and spread over the groups
+    """
+    rnd = random.Random(seed)
+    sequences = [value["sequence"] for value in protein_dict.values()]
+    peptide_psm_dict = {}
+    psm_group_dict = {}
+    while len(peptide_psm_dict) < n_peptides:
+        seq = rnd.choice(sequences)
+        start = rnd.randrange(0, len(seq) - 25)
+        peptide = seq[start : start + rnd.randint(7, 25)]
+        psms = set()
+        for _ in range(rnd.randint(1, 5)):
+            psms.add(
+                "".join(
+                    (
+                        aa + PTM_MASSES[aa]
+                        if aa in PTM_MASSES and rnd.random() < 0.15
+                        else aa
+                    )
+                    for aa in peptide
+                )
+            )
+        for psm in psms:
+            psm_group_dict[psm] = rnd.choice(groups)
+        peptide_psm_dict[peptide] = list(psms)
+    return peptide_psm_dict, psm_group_dict
+
+
+def legacy_coverage(aho_result, peptide_psm_dict, psm_group_dict, groups, length):
+    """
+    Per-hit slice adds for total and group coverage, as done before the difference-array engine
+    """
+    peptides = list(peptide_psm_dict)
+    zero_line = np.zeros(length, dtype=np.int32)
+    group_lines = {group: np.zeros(length, dtype=np.int32) for group in groups}
+    for start, end, pep_idx in zip(*aho_result):
+        psms = peptide_psm_dict[peptides[pep_idx]]
+        zero_line[start : end + 1] += len(psms)
+        for psm in psms:
+            group_lines[psm_group_dict[psm]][start : end + 1] += 1
+    return zero_line, group_lines
+
+
+def batched_coverage(aho_result, peptide_psm_dict, group_table, groups, length):
+    hit_start, hit_end, hit_peptide = aho_result
+    group_ptr, group_key, group_count = group_table
+    psm_count = np.array([len(v) for v in peptide_psm_dict.values()], dtype=np.int64)
+    zero_line = accumulate_coverage(
+        np.zeros(length, dtype=np.int32), hit_start, hit_end, psm_count[hit_peptide]
+    )
+    hit_idx, entry_idx = expand_hits(hit_peptide, group_ptr)
+    keys = group_key[entry_idx]
+    group_lines = {}
+    for key_idx, group in enumerate(groups):
+        mask = keys == key_idx
+        group_lines[group] = accumulate_coverage(
+            np.zeros(length, dtype=np.int32),
+            hit_start[hit_idx[mask]],
+            hit_end[hit_idx[mask]],
+            group_count[entry_idx[mask]],
+        )
+    return zero_line, group_lines
+
+
+def legacy_process_aho_result(
+    aho_result, ptm_index_line_dict, peptide_psm_dict, psm_group_dict, zero_line
+):
+    """
+    process_aho_result before PTM site tables and the difference-array engine
+    """
+    for tp in aho_result:
+        matched_pep = tp[2]
+        zero_line[tp[0] : tp[1] + 1] += len(peptide_psm_dict[matched_pep])
+        for psm in peptide_psm_dict[matched_pep]:
+            if psm in psm_group_dict:
+                ptm_index_line_dict[psm_group_dict[psm]][tp[0] : tp[1] + 1] += 1
+            for ptm in ptm_index_line_dict:
+                ptm_occurrences = [m.start() for m in re.finditer(re.escape(ptm), psm)]
+                ptm_positions = [m.span() for m in re.finditer(r"\[(.*?)\]", psm)]
+                ptm_end_pos = [i[1] for i in ptm_positions]
+                ptm_len = [i[1] - i[0] for i in ptm_positions]
+                ptm_offset = [sum(ptm_len[: idx + 1]) for idx in range(len(ptm_len))]
+                pos_shift_dict = dict(zip(ptm_end_pos, ptm_offset))
+                ptm_shift_dict = {}
+                current_shift = 0
+                for i in range(len(psm)):
+                    if i in pos_shift_dict:
+                        current_shift = pos_shift_dict[i]
+                    ptm_shift_dict[i] = current_shift
+                for ind in ptm_occurrences:
+                    ptm_index_line_dict[ptm][tp[0] + ind - ptm_shift_dict[ind]] += 1
+    return zero_line, ptm_index_line_dict
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark coverage accumulation (per-hit slices vs difference array)."
+    )
+    parser.add_argument(
+        "-f", "--fasta", help="Proteome FASTA file (e.g. UniProt mouse UP000000589)."
+    )
+    parser.add_argument(
+        "--synthetic",
+        type=int,
+        default=17000,
+        help="Number of synthetic proteins if no FASTA is given.",
+    )
+    parser.add_argument(
+        "-p", "--peptides", type=int, default=50000, help="Number of distinct peptides."
+    )
+    parser.add_argument(
+        "-g", "--groups", type=int, default=2, help="Number of PSM groups."
+    )
+    parser.add_argument(
+        "--skip-legacy-ptm",
+        action="store_true",
+        help="Skip the (slow) end-to-end comparison against the legacy PTM loop.",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.fasta:
+        from helpers import fasta_reader
+
+        protein_dict = fasta_reader(args.fasta)
+    else:
+        protein_dict = synthetic_proteome(args.synthetic, args.seed)
+
+    groups = [f"group{i}" for i in range(args.groups)]
+    ptm_keys = groups + ["S[79.9663]", "T[79.9663]", "[15.9949]"]
+    peptide_psm_dict, psm_group_dict = sample_psms(
+        protein_dict, args.peptides, groups, args.seed
+    )
+    seq_line = "|".join(value["sequence"] for value in protein_dict.values())
+    length = len(seq_line)
+
+    match_time, aho_result = timed(
+        automaton_matching, automaton_trie(list(peptide_psm_dict)), seq_line
+    )
+
+    print(f"Proteins: {len(protein_dict)}, residues: {length}")
+    print(
+        f"Peptides: {len(peptide_psm_dict)}, PSMs: {len(psm_group_dict)}, hits: {len(aho_result[0])}"
+    )
+    print(f"Aho-Corasick matching:        {match_time:.3f}s")
+
+    # Coverage engine only (total line + one line per group)
+    table_time, table = timed(
+        build_ptm_site_table, peptide_psm_dict, psm_group_dict, groups
+    )
+    legacy_time, legacy = timed(
+        legacy_coverage, aho_result, peptide_psm_dict, psm_group_dict, groups, length
+    )
+    batched_time, batched = timed(
+        batched_coverage, aho_result, peptide_psm_dict, table[3:], groups, length
+    )
+    assert np.array_equal(legacy[0], batched[0])
+    for group in groups:
+        assert np.array_equal(legacy[1][group], batched[1][group])
+
+    print("Coverage lines (total + groups):")
+    print(f"  per-hit slice adds:         {legacy_time:.3f}s")
+    print(f"  difference array:           {batched_time:.3f}s")
+    print(f"  speedup:                    {legacy_time / batched_time:.1f}x")
+    print(f"  PSM table build (shared):   {table_time:.3f}s")
+
+    # End-to-end process_aho_result with PTM localization
+    def new_lines():
+        return np.zeros(length, dtype=np.int32), {
+            ptm: np.zeros(length, dtype=np.int32) for ptm in ptm_keys
+        }
+
+    zero_line, ptm_lines = new_lines()
+    new_time, new = timed(
+        process_aho_result,
+        aho_result,
+        ptm_lines,
+        peptide_psm_dict,
+        psm_group_dict,
+        zero_line,
+    )
+    print("process_aho_result with PTMs:")
+    print(f"  current:                    {new_time:.3f}s")
+
+    if not args.skip_legacy_ptm:
+        peptides = list(peptide_psm_dict)
+        legacy_hits = [
+            (int(start), int(end), peptides[pep_idx])
+            for start, end, pep_idx in zip(*aho_result)
+        ]
+        zero_line, ptm_lines = new_lines()
+        old_time, old = timed(
+            legacy_process_aho_result,
+            legacy_hits,
+            ptm_lines,
+            peptide_psm_dict,
+            psm_group_dict,
+            zero_line,
+        )
+        assert np.array_equal(old[0], new[0])
+        for ptm in ptm_keys:
+            assert np.array_equal(old[1][ptm], new[1][ptm])
+        print(f"  legacy:                     {old_time:.3f}s")
+        print(f"  speedup:                    {old_time / new_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+from collections import defaultdict
+
+import httpx
+import numpy as np
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+)
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+
+
+def seed_job(database_url, n_proteins, seed):
+    """
+    Store a synthetic job with n_proteins covered proteins, each with an AlphaFold-sized structure
+    :return: (job_number, protein ids)
+    """
+    from sqlalchemy.orm import sessionmaker
+
+    from database import Job, ProteinStructure, SequenceCoverageResult
+    from db_engine import create_db_engine
+    from migrations import migrate
+
+    engine = create_db_engine(database_url)
+    migrate(engine)
+    rnd = np.random.default_rng(seed)
+
+    with sessionmaker(bind=engine)() as session:
+        job = Job(
+            species="human",
+            psms={},
+            ptm_annotations={"phospho": [0, 0, 255]},
+            background_color=0,
+        )
+        session.add(job)
+        protein_ids = []
+        for i in range(n_proteins):
+            protein_id = f"LOAD{seed}-{i:05d}"
+            length = int(rnd.integers(200, 1200))
+            atoms_per_residue = rnd.integers(5, 15, size=length)
+            last_atom = np.cumsum(atoms_per_residue)
+            first_atom = last_atom - atoms_per_residue + 1
+            coverage = np.repeat(rnd.integers(0, 3, size=length // 10 + 1), 10)[:length]
+
+            result = SequenceCoverageResult(
+                id=f"load-{seed}-{i}",
+                protein_id=protein_id,
+                coverage=float(np.count_nonzero(coverage)) / length,
+                sequence="".join(rnd.choice(list(AMINO_ACIDS), size=length)),
+                unid=f"GENE{i}",
+                description=f"Synthetic protein {i}",
+                sequence_coverage=coverage,
+                ptms={"phospho": np.flatnonzero(coverage)[:5]},
+                has_pdb=True,
+            )
+            result.jobs.append(job)
+            pdb_lines = [
+                f"ATOM  {serial:5d}  CA  ALA A{residue:4d}    {rnd.normal():8.3f}{rnd.normal():8.3f}{rnd.normal():8.3f}  1.00 90.00           C"
+                for residue in range(1, length + 1)
+                for serial in range(
+                    int(first_atom[residue - 1]), int(last_atom[residue - 1]) + 1
+                )
+            ]
+            structure = ProteinStructure(
+                id=f"load-structure-{seed}-{i}",
+                protein_id=protein_id,
+                species="human",
+                pdb_id=protein_id,
+                amino_ele_pos={},
+                pdb_str="\n".join(pdb_lines),
+                objs_str=f"cartoon:1-{int(last_atom[-1])}\n",
+                view_str="view:0,0,0,-50,40,60,0.45,20,1,0,0,0,1,0,0,0,1\n",
+                residue_first_atom=first_atom.astype(np.int32),
+                residue_last_atom=last_atom.astype(np.int32),
+            )
+            session.add_all([result, structure])
+            protein_ids.append(protein_id)
+        session.commit()
+        return str(job.job_number), protein_ids
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) * 1000 if values else float("nan")
+
+
+async def viewer(client, job_number, protein_ids, clicks, latencies, rnd):
+    """
+    One simulated viewer: load the job page, then click through proteins
+    """
+
+    async def timed(name, request):
+        start = time.perf_counter()
+        response = await request
+        latencies[name].append(time.perf_counter() - start)
+        response.raise_for_status()
+        return response
+
+    form = {"job_number": job_number}
+    await timed("/job_details", client.post("/job_details", data=form))
+    await timed("/protein-list", client.post("/protein-list", data=form))
+    for _ in range(clicks):
+        protein_id = rnd.choice(protein_ids)
+        await timed(
+            "/protein-structure",
+            client.post("/protein-structure", data={**form, "protein_id": protein_id}),
+        )
+        await timed("/job_status", client.post("/job_status", data=form))
+
+
+async def run(url, job_number, protein_ids, clients, clicks, seed):
+    latencies = defaultdict(list)
+    limits = httpx.Limits(max_connections=clients, max_keepalive_connections=clients)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=120) as client:
+        start = time.perf_counter()
+        await asyncio.gather(
+            *(
+                viewer(
+                    client,
+                    job_number,
+                    protein_ids,
+                    clicks,
+                    latencies,
+                    random.Random(seed + i),
+                )
+                for i in range(clients)
+            )
+        )
+        elapsed = time.perf_counter() - start
+    return latencies, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load test of the viewer endpoints with concurrent simulated viewers."
+    )
+    parser.add_argument(
+        "--url", help="Base URL of the API.", default="http://127.0.0.1:8000"
+    )
+    parser.add_argument("-j", "--job", help="Job number to view.")
+    parser.add_argument(
+        "--seed-proteins",
+        help="Store a synthetic job with this many proteins in DATABASE_URL and view it.",
+        type=int,
+    )
+    parser.add_argument(
+        "--database", help="Database to seed.", default=os.getenv("DATABASE_URL")
+    )
+    parser.add_argument(
+        "-c", "--clients", help="Concurrent viewers.", type=int, default=50
+    )
+    parser.add_argument(
+        "--clicks", help="Proteins opened per viewer.", type=int, default=10
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.seed_proteins:
+        job_number, protein_ids = seed_job(args.database, args.seed_proteins, args.seed)
+        print(f"Seeded job {job_number} with {len(protein_ids)} proteins")
+    elif args.job:
+        job_number = args.job
+        response = httpx.post(
+            f"{args.url}/protein-list", data={"job_number": job_number}
+        )
+        response.raise_for_status()
+        protein_ids = [
+            result["protein_id"] for result in response.json() if result["has_pdb"]
+        ]
+    else:
+        parser.error("either --job or --seed-proteins is required")
+
+    latencies, elapsed = asyncio.run(
+        run(args.url, job_number, protein_ids, args.clients, args.clicks, args.seed)
+    )
+
+    total = [value for values in latencies.values() for value in values]
+    print(
+        f"{args.clients} viewers, {len(total)} requests in {elapsed:.1f}s ({len(total) / elapsed:.1f} req/s)"
+    )
+    print(f"{'endpoint':<20}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, values in sorted(latencies.items()) + [("all", total)]:
+        print(
+            f"{name:<20}{len(values):>8}{percentile(values, 50):>10.1f}"
+            f"{percentile(values, 95):>10.1f}{percentile(values, 99):>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
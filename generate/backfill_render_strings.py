@@ -0,0 +1,91 @@
+import os
+import sys
+import argparse
+
+from dotenv import load_dotenv
+from tqdm import tqdm
+from sqlalchemy import select, bindparam
+from sqlalchemy.orm import sessionmaker
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.database import ProteinStructure
+from src.db_engine import create_db_engine
+from src.migrations import migrate
+from src.helpers import pymol_obj_dict_to_str, pymol_view_dict_to_str
+from src.rendering import get_residue_atom_ranges
+
+load_dotenv('../.env')  # load environmental variables from .env
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute render strings and residue atom ranges of protein structures ingested by older versions.")
+    parser.add_argument('--database', help="Database to update.", default=os.getenv('DATABASE_URL'), required=False)
+    parser.add_argument('-b', '--batch-size', help="Structures per batch.", type=int, default=500, required=False)
+
+    args = parser.parse_args()
+
+    engine = create_db_engine(args.database)
+    for version, name, _ in migrate(engine):  # create tables and add missing columns
+        print(f"Applied schema migration {version}: {name}.")
+
+    Session = sessionmaker(bind=engine)
+
+    missing = (
+        ProteinStructure.objs_str.is_(None)
+        | ProteinStructure.view_str.is_(None)
+        | ProteinStructure.residue_first_atom.is_(None)
+        | ProteinStructure.residue_last_atom.is_(None)
+    )
+
+    with Session() as session:
+        total = session.query(ProteinStructure.id).filter(missing).count()
+
+        updated = 0
+        last_id = ''
+        with tqdm(total=total, desc="Backfilling structures", unit="structure") as pbar:
+            while True:
+                # Only load the columns needed, pdb_str is large
+                rows = session.execute(
+                    select(ProteinStructure.id, ProteinStructure.objs, ProteinStructure.view,
+                           ProteinStructure.amino_ele_pos)
+                    .where(missing, ProteinStructure.id > last_id)
+                    .order_by(ProteinStructure.id)
+                    .limit(args.batch_size)
+                ).all()
+                if not rows:
+                    break
+
+                values = []
+                for row in rows:
+                    residue_first_atom, residue_last_atom = get_residue_atom_ranges(row.amino_ele_pos or {})
+                    values.append({
+                        'structure_id': row.id,
+                        'objs_str': pymol_obj_dict_to_str(row.objs),
+                        'view_str': pymol_view_dict_to_str(row.view),
+                        'residue_first_atom': residue_first_atom,
+                        'residue_last_atom': residue_last_atom,
+                    })
+
+                session.execute(
+                    ProteinStructure.__table__.update()
+                    .where(ProteinStructure.__table__.c.id == bindparam('structure_id'))
+                    .values(
+                        objs_str=bindparam('objs_str'),
+                        view_str=bindparam('view_str'),
+                        residue_first_atom=bindparam('residue_first_atom'),
+                        residue_last_atom=bindparam('residue_last_atom'),
+                    ),
+                    values,
+                )
+                session.commit()
+
+                updated += len(rows)
+                last_id = rows[-1].id
+                pbar.update(len(rows))
+
+    print(f"Precomputed render strings and residue atom ranges of {updated} structures.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import os
+import sys
+import argparse
+
+from dotenv import load_dotenv
+from tqdm import tqdm
+from sqlalchemy import text, bindparam, LargeBinary
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.database import CompressedArray
+from src.db_engine import create_db_engine
+from src.migrations import migrate
+
+load_dotenv('../.env')  # load environmental variables from .env
+
+COLUMNS = ('sequence_coverage', 'ptms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert JSON coverage arrays of sequence coverage results to compressed binary.")
+    parser.add_argument('--database', help="Database to migrate.", default=os.getenv('DATABASE_URL'), required=False)
+    parser.add_argument('-b', '--batch-size', help="Rows per batch.", type=int, default=1000, required=False)
+
+    args = parser.parse_args()
+
+    engine = create_db_engine(args.database)
+
+    for version, name, _ in migrate(engine):  # changes the column types to bytea on PostgreSQL
+        print(f"Applied schema migration {version}: {name}.")
+
+    select_batch = text(
+        'SELECT id, sequence_coverage, ptms FROM sequence_coverage_results '
+        'WHERE id > :last_id ORDER BY id LIMIT :limit'
+    )
+    update_row = text(
+        'UPDATE sequence_coverage_results SET sequence_coverage = :sequence_coverage, ptms = :ptms WHERE id = :id'
+    ).bindparams(bindparam('sequence_coverage', type_=LargeBinary), bindparam('ptms', type_=LargeBinary))
+
+    with engine.connect() as conn:
+        total = conn.execute(text('SELECT COUNT(*) FROM sequence_coverage_results')).scalar()
+
+    converted = 0
+    last_id = ''
+    with tqdm(total=total, desc="Converting rows", unit="row") as pbar:
+        while True:
+            with engine.begin() as conn:  # one transaction per batch
+                rows = conn.execute(select_batch, {'last_id': last_id, 'limit': args.batch_size}).all()
+                if not rows:
+                    break
+
+                updates = []
+                for row in rows:
+                    values = {column: getattr(row, column) for column in COLUMNS}
+                    legacy = [column for column, value in values.items()
+                              if value is not None and not CompressedArray.is_encoded(value)]
+                    if legacy:
+                        for column in legacy:
+                            values[column] = CompressedArray.encode(CompressedArray.decode(values[column]))
+                        updates.append({'id': row.id, **values})
+
+                if updates:
+                    conn.execute(update_row, updates)
+                converted += len(updates)
+                last_id = rows[-1].id
+                pbar.update(len(rows))
+
+    print(f"Converted {converted} of {total} rows.")
+    if engine.dialect.name == 'sqlite' and converted > 0:
+        print("Run VACUUM on the database to reclaim the freed space.")
+
+
+if __name__ == "__main__":
+    main()
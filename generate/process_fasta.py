@@ -1,45 +1,71 @@
 import os
 import argparse
+from contextlib import nullcontext
 from dotenv import load_dotenv
-from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
-from src.database import Base, FASTA_Entry
-from src.helpers import fasta_reader
+from tqdm import tqdm
+from src.database import FASTA_Entry
+from src.db_engine import create_db_engine
+from src.migrations import migrate
+from src.fasta import fasta_records
+from src.proteome import ProteomeIndexWriter, proteome_index_dir, proteome_index_path
 
 load_dotenv('../.env')  # load environmental variables from .env
 
-engine = create_engine(os.getenv('DATABASE_URL'))  # create SQLAlchemy engine
-
-Base.metadata.create_all(engine)  # create database tables
-
-Session = sessionmaker(bind=engine)  # create session factory
-
 
 def main():
     parser = argparse.ArgumentParser(description="Process FASTA files into database.")
-    parser.add_argument('-f', '--fasta', help="FASTA file to process.", required=True)
+    parser.add_argument('-f', '--fasta', help="FASTA file to process, plain or gzip/zstd compressed.", required=True)
     parser.add_argument('-n', '--name', help="Desired name.", required=True)
     parser.add_argument('--database', help="Database to add to.", default=os.getenv('DATABASE_URL'), required=False)
+    parser.add_argument('--index-only', action='store_true',
+                        help="Only write the proteome index, don't store the proteins in the database. "
+                             "For proteomes too large to hold in memory (e.g. TrEMBL).")
 
     args = parser.parse_args()
 
-    session = Session()
-    existing_entry = session.query(FASTA_Entry).filter_by(name=args.name).first()
-    if existing_entry:
-        print(f"Entry with name \"{args.name}\" already exists in database.")
-        return
+    index_dir = proteome_index_dir(args.database)
+    if args.index_only and not index_dir:
+        parser.error("--index-only needs a proteome index directory, set PROTEOME_INDEX_DIR.")
+
+    engine = create_db_engine(args.database)  # create SQLAlchemy engine
+
+    migrate(engine)  # create database tables
+
+    Session = sessionmaker(bind=engine)  # create session factory
+
+    with Session() as session:
+        existing_entry = session.query(FASTA_Entry).filter_by(name=args.name).first()
+        if existing_entry:
+            print(f"Entry with name \"{args.name}\" already exists in database.")
+            return
 
-    fasta = fasta_reader(args.fasta)
+    # Stream the records into the proteome index (built once at ingest, so jobs don't have to),
+    # and into the protein dictionary stored in the database unless --index-only
+    data = None if args.index_only else {}
+    index_path = proteome_index_path(index_dir, args.name) if index_dir else None
+    # The unfinished index is removed if reading fails
+    with ProteomeIndexWriter(index_path, args.name) if index_path else nullcontext() as writer:
+        for protein_id, sequence, gene, description in tqdm(fasta_records(args.fasta), desc="Reading proteins",
+                                                            unit=" proteins"):
+            if writer:
+                writer.add(protein_id, sequence, gene, description)
+            if data is not None:
+                data[protein_id] = {"sequence": sequence, "gene": gene, "des": description}
 
-    fasta_entry = FASTA_Entry(
-        name=args.name,
-        source_filename=os.path.basename(args.fasta),
-        data=fasta
-    )
+        with Session() as session:  # the database is only locked once the file is read
+            fasta_entry = FASTA_Entry(
+                name=args.name,
+                source_filename=os.path.basename(args.fasta),
+                data=data
+            )
+            session.add(fasta_entry)
+            session.commit()
+            source_id = fasta_entry.id
 
-    session.add(fasta_entry)
-    session.commit()
-    session.close()
+        if writer:
+            proteins = writer.finish(source_id)
+            print(f"Saved proteome index of {proteins} proteins to {index_path}.")
 
     print(f"Added {args.fasta} to database as \"{args.name}.\"")
 
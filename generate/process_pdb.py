@@ -1,82 +1,222 @@
-import multiprocessing
 import os
 import sys
 import argparse
 import logging
 import time
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, wait
 
-import sqlalchemy
 from dotenv import load_dotenv
 from tqdm import tqdm
-from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
 # Configure logging
 logging.basicConfig(filename="process_pdb_log.txt", format='%(message)s', level=logging.INFO)
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from src.database import Base, ProteinStructure
-from src.rendering import get_db_model_from_pdb
+from src.database import ProteinStructure
+from src.db_engine import create_db_engine
+from src.migrations import migrate
+from src.render_pool import RenderError, RenderPool
+from src.rendering import PIPELINE_VERSION, get_db_model_from_render
+from src.structures import bump_structure_version, get_structure_sources, save_structures, source_file_hash
 
 load_dotenv('../.env')  # load environmental variables from .env
 
+FLUSH_INTERVAL = 30  # seconds, write a partial batch when rendering is slow so an interrupted run loses little
+
 parser = argparse.ArgumentParser(description="Process PDB files into database.")
 parser.add_argument('-d', '--directory', help="Directory of PDB files", required=True)
 parser.add_argument('-s', '--species', help="Desired species.", required=True)
 parser.add_argument('--database', help="Database to add to.", default=os.getenv('DATABASE_URL'), required=False)
+parser.add_argument('-w', '--workers', help="Rendering processes.", type=int, default=os.cpu_count(), required=False)
+parser.add_argument('-t', '--timeout', help="Seconds a file may take to render before its worker is replaced.",
+                    type=float, default=float(os.getenv('RENDER_TIMEOUT', 120)), required=False)
+parser.add_argument('-b', '--batch-size', help="Structures written per transaction.", type=int, default=100,
+                    required=False)
+parser.add_argument('--restart', help="Render all files again, even the ones already rendered by this pipeline "
+                                      "version.", action='store_true')
+
+
+def render_files(pool, pdb_files):
+    """
+    Render PDB files on the render pool. At most two files per worker are read and queued at once.
+    :return: Generator of (pdb_file, render result or None, error message or None), in the order they finish
+    """
+    files = iter(pdb_files)
+    pending = {}
+    while True:
+        while len(pending) < 2 * pool.workers:
+            pdb_file = next(files, None)
+            if pdb_file is None:
+                break
+            try:
+                with open(pdb_file) as f:
+                    pending[pool.submit(f.read(), os.path.basename(pdb_file))] = pdb_file
+            except OSError as e:
+                yield pdb_file, None, f"{type(e).__name__}: {e}"
+        if not pending:
+            return
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            pdb_file = pending.pop(future)
+            try:
+                yield pdb_file, future.result(), None
+            except RenderError as e:
+                yield pdb_file, None, f"{type(e).__name__}: {e}"
+
+
+def protein_id_of(pdb_name):
+    """
+    :return: Protein id in a PDB file name (AF-<protein id>-F1-model_v4.pdb), or None
+    """
+    parts = pdb_name.split('-')
+    return parts[1] if len(parts) > 1 else None
+
+
+def structure_columns(pdb_file, ret, species):
+    """
+    :return: ProteinStructure column dictionary of a rendered PDB file
+    """
+    pdb_name = os.path.basename(pdb_file)
+    protein_id = protein_id_of(pdb_name)
+    if protein_id is None:
+        raise ValueError(f"No protein id in file name {pdb_name}")
+    mdl = get_db_model_from_render(ret, pdb_name, protein_id, species)
+    return {column.name: getattr(mdl, column.name) for column in ProteinStructure.__table__.columns}
+
+
+def source_row(pdb_file, file_hash, stat, species, structure_id):
+    """
+    :return: StructureSource column dictionary of a PDB file
+    """
+    return {'species': species, 'file_hash': file_hash, 'pipeline_version': PIPELINE_VERSION,
+            'filename': os.path.basename(pdb_file), 'file_size': stat.st_size, 'file_mtime': stat.st_mtime,
+            'structure_id': structure_id}
+
+
+def find_changed_files(session, pdb_files, args):
+    """
+    Compare the PDB files to the source files rendered by the current pipeline version.
+    Files with the same name, size and mtime are skipped without being read, others are hashed. A file with the
+    content of a rendered file of the same protein (touched, copied or renamed) is skipped too, and recorded so
+    the next run skips it without reading it. Files of the same content and protein within the directory are
+    rendered once.
+    :return: (List of files to render, {file: (hash, os.stat_result)} of the files to render and their
+             duplicates, {file to render: [duplicate files]}, StructureSource rows to record for the skipped files
+             that were read, number of skipped files)
+    """
+    sources = [] if args.restart else get_structure_sources(session, args.species, PIPELINE_VERSION)
+    by_name = {source.filename: source for source in sources}
+    # The protein id comes from the file name, so content is only shared by files of the same protein
+    by_content = {(source.file_hash, protein_id_of(source.filename)): source.structure_id for source in sources}
+    todo, info, duplicates, known = [], {}, defaultdict(list), []
+    rendering = {}  # (hash, protein id) -> file rendered in this run
+    for pdb_file in tqdm(pdb_files, desc="Checking files", unit="file"):
+        stat = os.stat(pdb_file)
+        name = os.path.basename(pdb_file)
+        source = by_name.get(name)
+        if source is not None and source.file_size == stat.st_size and source.file_mtime == stat.st_mtime:
+            continue
+        file_hash = source_file_hash(pdb_file)
+        content = (file_hash, protein_id_of(name))
+        structure_id = by_content.get(content)
+        if structure_id is not None:  # touched, copied or renamed, but the same content and protein
+            known.append(source_row(pdb_file, file_hash, stat, args.species, structure_id))
+            continue
+        info[pdb_file] = (file_hash, stat)
+        if content in rendering:  # duplicate within the directory, recorded with the rendered file
+            duplicates[rendering[content]].append(pdb_file)
+            continue
+        rendering[content] = pdb_file
+        todo.append(pdb_file)
+    return todo, info, duplicates, known, len(pdb_files) - len(info)
 
-args = parser.parse_args()
-
-engine = create_engine(os.getenv('DATABASE_URL'))
-
-Base.metadata.create_all(engine)  # create database tables
 
+def main():
+    args = parser.parse_args()
 
-def process_pdb_file(pdb_file, max_retries=5, wait_time=5):
-    # Create a new session for this process
-    engine = create_engine(os.getenv('DATABASE_URL'))
-    Session = sessionmaker(bind=engine)
-
-    for attempt in range(
-            max_retries):  # try max_retries times, wait for wait_time seconds between each attempt to reduce contention
-        try:
-            session = Session()
-
-            mdl = get_db_model_from_pdb(pdb_file, os.path.basename(pdb_file), os.path.basename(pdb_file).split('-')[1],
-                                        args.species)
-
-            # Check if entry already exists
-            existing_entry = session.query(ProteinStructure).filter_by(id=mdl.id).first()
-            if existing_entry:
-                session.close()
-                return f"Entry with id \"{mdl.id}\" already exists in database."
-            else:
-                session.merge(mdl)  # merge the object into the session
-                session.commit()
-                session.close()
-                return f"Added {pdb_file} to database as \"{mdl.id}.\""
-        except sqlalchemy.exc.OperationalError as e:
-            if "database is locked" in str(
-                    e) and attempt < max_retries - 1:  # check if it's a locked error and if we haven't exceeded max_retries
-                time.sleep(wait_time)  # wait before retrying
-                continue
-            else:
-                raise  # if it's a different OperationalError, or we've exceeded max_retries, raise the exception
+    engine = create_db_engine(args.database)  # WAL mode on SQLite, writers wait for each other instead of failing
 
+    migrate(engine)  # create database tables, add columns and indexes introduced since the database was created
 
-def main():
     # Get all PDB files in directory
-    pdb_files = [os.path.join(args.directory, f) for f in os.listdir(args.directory) if f.endswith('.pdb')]
+    pdb_files = sorted(os.path.abspath(os.path.join(args.directory, f))
+                       for f in os.listdir(args.directory) if f.endswith('.pdb'))
     if len(pdb_files) == 0:
         print(f"No PDB files found in {args.directory}.")
         return
 
-    # Use a multiprocessing Pool
-    with multiprocessing.Pool() as pool:
-        with tqdm(total=len(pdb_files), desc="Processing files", unit="file") as pbar:
-            for message in pool.imap_unordered(process_pdb_file, pdb_files):
-                logging.info(message)
+    Session = sessionmaker(bind=engine)
+
+    # Only files that are new, changed or rendered by an older pipeline version are rendered
+    with Session() as session:
+        todo, info, duplicates, known, unchanged = find_changed_files(session, pdb_files, args)
+        if known:  # record them, so the next run skips them without reading them
+            save_structures(session, [], known)
+    if unchanged:
+        print(f"Skipping {unchanged} files already rendered by pipeline version {PIPELINE_VERSION}.")
+    if not todo:
+        return
+
+    added = existing = failed = 0
+    batch = []
+    last_flush = time.time()
+
+    def sources(pdb_file, structure):
+        # The rendered file and its duplicates within the directory
+        return [source_row(f, *info[f], args.species, structure['id']) for f in [pdb_file, *duplicates[pdb_file]]]
+
+    def flush(session):
+        # Single writer: one transaction per batch, the structures together with their source files
+        nonlocal added, existing, last_flush
+        if batch:
+            inserted = set(save_structures(session, [structure for _, structure in batch],
+                                           [source for pdb_file, structure in batch
+                                            for source in sources(pdb_file, structure)]))
+            for pdb_file, structure in batch:
+                if structure['id'] in inserted:
+                    logging.info(f"Added {pdb_file} to database as \"{structure['id']}.\"")
+                    inserted.discard(structure['id'])
+                    added += 1
+                else:
+                    logging.info(f"Entry with id \"{structure['id']}\" already exists in database.")
+                    existing += 1
+            batch.clear()
+        last_flush = time.time()
+
+    start_time = time.time()
+    # Long-lived PyMOL workers render, this process writes. Rendering continues while a batch is written.
+    pool = RenderPool.from_env(workers=args.workers, timeout=args.timeout)
+    try:
+        with Session() as session, tqdm(total=len(todo), desc="Processing files", unit="file") as pbar:
+            for pdb_file, ret, error in render_files(pool, todo):
+                if ret is not None:
+                    try:
+                        structure = structure_columns(pdb_file, ret, args.species)
+                    except Exception as e:
+                        error = f"{type(e).__name__}: {e}"
+                if error:
+                    logging.info(f"Could not process {pdb_file}: {error}")
+                    failed += 1
+                else:
+                    batch.append((pdb_file, structure))
+                if len(batch) >= args.batch_size or time.time() - last_flush > FLUSH_INTERVAL:
+                    flush(session)
                 pbar.update()  # manually update the progress bar
+                pbar.set_postfix(added=added, existing=existing, failed=failed)
+            flush(session)
+    finally:
+        pool.shutdown(wait=False)
+
+    elapsed = time.time() - start_time
+    print(f"Processed {len(todo)} files in {elapsed:.1f}s ({len(todo) / elapsed:.2f} files/s): "
+          f"{added} added, {existing} already stored, {failed} failed (see process_pdb_log.txt), "
+          f"{unchanged} unchanged.")
+
+    if added > 0:  # let running servers reload their structure index
+        with Session() as session:
+            bump_structure_version(session, args.species)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,225 @@
+import asyncio
+import logging
+import os
+import threading
+from collections import Counter, deque
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import delete, insert, select
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from starlette.concurrency import run_in_threadpool
+
+from database import Access, AccessDaily
+
+logger = logging.getLogger("uvicorn")
+
+
+class AccessLogSink:
+    """
+    Write-behind sink for Access records.
+    Records are buffered in memory and written in bulk by a background task, either every flush_interval
+    seconds or as soon as batch_size records are waiting. Remaining records are written on stop().
+    At most max_buffer records are kept while the database is unavailable, the oldest are dropped beyond that.
+    """
+
+    def __init__(
+        self,
+        session_factory,
+        flush_interval=2.0,
+        batch_size=500,
+        max_buffer=100000,
+        retention_days=30,
+    ):
+        self.session_factory = session_factory
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_buffer = max_buffer
+        self.retention_days = retention_days
+
+        self._buffer = deque()
+        self._lock = threading.Lock()
+        self._wakeup = None
+        self._task = None
+        self._stopping = False
+        self._last_rollup = None
+
+    @classmethod
+    def from_env(cls, session_factory):
+        """
+        Create a sink configured by ACCESS_LOG_FLUSH_SECONDS, ACCESS_LOG_BATCH_SIZE and ACCESS_LOG_RETENTION_DAYS
+        """
+        return cls(
+            session_factory,
+            flush_interval=float(os.getenv("ACCESS_LOG_FLUSH_SECONDS", 2.0)),
+            batch_size=int(os.getenv("ACCESS_LOG_BATCH_SIZE", 500)),
+            retention_days=int(os.getenv("ACCESS_LOG_RETENTION_DAYS", 30)),
+        )
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def add(self, ip, path, method, job_number=None):
+        """
+        Buffer an access record, timestamped now
+        """
+        with self._lock:
+            if len(self._buffer) >= self.max_buffer:
+                self._buffer.popleft()
+                logger.warning("Access log buffer full, dropping oldest record")
+            self._buffer.append(
+                {
+                    "ip": ip,
+                    "timestamp": datetime.utcnow(),
+                    "path": path,
+                    "method": method,
+                    "job_number": job_number,
+                }
+            )
+            full = len(self._buffer) >= self.batch_size
+        if full and self._wakeup is not None:
+            self._wakeup.set()
+
+    def record(self, request, job_number=None):
+        """
+        Buffer an access record of a request
+        """
+        self.add(request.client.host, request.url.path, request.method, job_number)
+
+    def flush(self):
+        """
+        Write all buffered records in one transaction
+        :return: Number of records written
+        """
+        with self._lock:
+            rows = list(self._buffer)
+            self._buffer.clear()
+        if not rows:
+            return 0
+
+        try:
+            with self.session_factory() as session:
+                session.execute(insert(Access), rows)
+                session.commit()
+        except Exception as e:
+            logger.error(f"Could not write {len(rows)} access records: {e}")
+            with self._lock:  # keep them for the next flush, ahead of newer records
+                self._buffer.extendleft(reversed(rows))
+                while len(self._buffer) > self.max_buffer:
+                    self._buffer.popleft()
+            return 0
+        return len(rows)
+
+    def rollup(self):
+        """
+        Roll up access records older than retention_days, at most once a day
+        """
+        today = date.today()
+        if self.retention_days <= 0 or self._last_rollup == today:
+            return
+        self._last_rollup = today
+        try:
+            with self.session_factory() as session:
+                rolled = rollup_access(
+                    session, datetime.utcnow() - timedelta(days=self.retention_days)
+                )
+            if rolled:
+                logger.info(f"Rolled up {rolled} access records")
+        except Exception as e:
+            logger.error(f"Could not roll up access records: {e}")
+
+    async def run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await run_in_threadpool(self.flush)
+            if not self._stopping:
+                await run_in_threadpool(self.rollup)
+
+    def start(self):
+        """
+        Start the background flush task on the running event loop
+        """
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        """
+        Stop the background task and write the remaining records
+        """
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        self._wakeup = None
+        await run_in_threadpool(self.flush)
+
+
+def rollup_access(session, before):
+    """
+    Aggregate Access rows older than a timestamp into per-day, per-path AccessDaily counts and delete them.
+    Safe to run from several processes at once: the rows are deleted before they are counted, so each row
+    is claimed by one rollup, and the counts are added to AccessDaily with an upsert. Commits the session.
+    :param session:
+    :param before: datetime
+    :return: Number of Access rows rolled up
+    """
+    dialect = session.get_bind().dialect
+    old = Access.timestamp < before
+    if dialect.delete_returning:
+        rows = session.execute(
+            delete(Access)
+            .where(old)
+            .returning(Access.timestamp, Access.path, Access.method)
+        ).all()
+    else:  # lock the rows until they are deleted
+        rows = session.execute(
+            select(Access.timestamp, Access.path, Access.method)
+            .where(old)
+            .with_for_update()
+        ).all()
+        session.execute(delete(Access).where(old))
+
+    counts = Counter(
+        (timestamp.date(), path, method) for timestamp, path, method in rows
+    )
+    if counts:
+        add_daily_counts(
+            session,
+            [
+                {"day": day, "path": path, "method": method, "count": count}
+                for (day, path, method), count in counts.items()
+            ],
+        )
+    session.commit()
+    return len(rows)
+
+
+def add_daily_counts(session, rows):
+    """
+    Add counts to AccessDaily, creating missing (day, path, method) rows
+    :param session:
+    :param rows: List of AccessDaily column dictionaries
+    """
+    dialect = session.get_bind().dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        stmt = (sqlite_insert if dialect == "sqlite" else postgresql_insert)(
+            AccessDaily
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[AccessDaily.day, AccessDaily.path, AccessDaily.method],
+            set_={"count": AccessDaily.count + stmt.excluded["count"]},
+        )
+        session.execute(stmt, rows)
+        return
+    for row in rows:
+        daily = session.get(AccessDaily, (row["day"], row["path"], row["method"]))
+        if daily is None:
+            session.add(AccessDaily(**row))
+        else:
+            daily.count += row["count"]
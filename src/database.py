@@ -4,19 +4,25 @@ from sqlalchemy import (
     Integer,
     String,
     Text,
+    Date,
     DateTime,
     TypeDecorator,
     ForeignKey,
+    Index,
     Double,
     Boolean,
     Table,
     JSON,
+    insert,
 )
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.dialects.postgresql import UUID, insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.mutable import Mutable
 import json
+import struct
 import uuid
+import numpy as np
 import zstd
 from datetime import datetime
 
@@ -27,6 +33,7 @@ Base = declarative_base()
 
 class CompressedText(types.TypeDecorator):
     impl = types.LargeBinary
+    cache_ok = True
 
     def process_bind_param(self, value, dialect):
         if value is not None:
@@ -40,7 +47,128 @@ class CompressedText(types.TypeDecorator):
 
 
 class MutableCompressedText(CompressedText, Mutable):
-    pass
+    cache_ok = True
+
+
+class CompressedArray(types.TypeDecorator):
+    """
+    Stores a 1-D NumPy array, or a dictionary of them, as typed zstd-compressed binary.
+    Integer arrays are narrowed to the smallest dtype that holds their values.
+    Values decode straight to read-only np.ndarray (or a dictionary of them), without going through lists.
+    Rows written as JSON lists by older versions are still read, see generate/migrate_coverage_arrays.py.
+    """
+
+    impl = types.LargeBinary
+    cache_ok = True
+
+    MAGIC = b"SCVA"
+    VERSION = 1
+    ARRAY, DICT = 0, 1
+
+    @staticmethod
+    def _narrow(array):
+        array = np.ravel(np.asarray(array))
+        if array.size == 0:
+            return array.astype(np.uint8)
+        if array.dtype.kind in "iub":
+            low, high = int(array.min()), int(array.max())
+            return array.astype(
+                np.result_type(np.min_scalar_type(low), np.min_scalar_type(high))
+            )
+        return array
+
+    @staticmethod
+    def _pack_array(array):
+        dtype = array.dtype.newbyteorder("<").str.encode("ascii")
+        data = array.astype(dtype.decode("ascii"), copy=False).tobytes()
+        return (
+            struct.pack("<B", len(dtype)) + dtype + struct.pack("<Q", len(data)) + data
+        )
+
+    @staticmethod
+    def _unpack_array(buffer, offset):
+        (dtype_len,) = struct.unpack_from("<B", buffer, offset)
+        offset += 1
+        dtype = bytes(buffer[offset : offset + dtype_len]).decode("ascii")
+        offset += dtype_len
+        (data_len,) = struct.unpack_from("<Q", buffer, offset)
+        offset += 8
+        array = np.frombuffer(
+            buffer,
+            dtype=dtype,
+            count=data_len // np.dtype(dtype).itemsize,
+            offset=offset,
+        )
+        return array, offset + data_len
+
+    @classmethod
+    def encode(cls, value):
+        if isinstance(value, dict):
+            payload = struct.pack("<I", len(value))
+            for key, array in value.items():
+                key = str(key).encode("utf-8")
+                payload += (
+                    struct.pack("<H", len(key))
+                    + key
+                    + cls._pack_array(cls._narrow(array))
+                )
+            kind = cls.DICT
+        else:
+            payload = cls._pack_array(cls._narrow(value))
+            kind = cls.ARRAY
+        return (
+            cls.MAGIC + struct.pack("<BB", cls.VERSION, kind) + zstd.compress(payload)
+        )
+
+    @classmethod
+    def decode(cls, value):
+        if isinstance(value, (list, dict)):  # JSON column decoded by the driver
+            return cls._from_json(value)
+        if isinstance(value, str):
+            return cls._from_json(json.loads(value))
+        value = bytes(value)
+        if not value.startswith(cls.MAGIC):  # JSON text stored by older versions
+            return cls._from_json(json.loads(value.decode("utf-8")))
+
+        version, kind = struct.unpack_from("<BB", value, len(cls.MAGIC))
+        if version != cls.VERSION:
+            raise ValueError(f"Unsupported compressed array version: {version}")
+        buffer = zstd.decompress(value[len(cls.MAGIC) + 2 :])
+        if kind == cls.ARRAY:
+            return cls._unpack_array(buffer, 0)[0]
+
+        result = {}
+        (count,) = struct.unpack_from("<I", buffer, 0)
+        offset = 4
+        for _ in range(count):
+            (key_len,) = struct.unpack_from("<H", buffer, offset)
+            offset += 2
+            key = bytes(buffer[offset : offset + key_len]).decode("utf-8")
+            result[key], offset = cls._unpack_array(buffer, offset + key_len)
+        return result
+
+    @classmethod
+    def _from_json(cls, value):
+        if isinstance(value, dict):
+            return {key: cls._narrow(array) for key, array in value.items()}
+        return cls._narrow(value)
+
+    @classmethod
+    def is_encoded(cls, value):
+        return (
+            isinstance(value, (bytes, bytearray, memoryview))
+            and bytes(value[:4]) == cls.MAGIC
+        )
+
+    def process_bind_param(self, value, dialect):
+        if value is not None:
+            value = self.encode(value)
+        return value
+
+    def process_result_value(self, value, dialect):
+        if value is not None:
+            value = self.decode(value)
+        return value
 
 
 class StringUUID(TypeDecorator):
@@ -52,7 +180,9 @@ class StringUUID(TypeDecorator):
     cache_ok = True  # this type is immutable
 
     def process_bind_param(self, value, dialect):
-        return str(value)
+        if value is not None:
+            value = str(value)
+        return value
 
     def process_result_value(self, value, dialect):
         if value is not None:
@@ -71,9 +201,17 @@ class UploadedPDB(Base):
     filesize = Column(Integer)
     filename = Column(Text)
     pdb_id = Column(Text)
-    job_number = Column(StringUUID, ForeignKey("jobs.job_number"), nullable=True)
+    job_number = Column(
+        StringUUID, ForeignKey("jobs.job_number"), nullable=True, index=True
+    )
     job = relationship("Job", back_populates="pdb_file")
 
+    # Background render, see uploads.UploadRenderer: queued -> rendering -> done | failed
+    file_hash = Column(String, index=True)  # structures.source_hash() of pdb_file
+    render_status = Column(String)
+    render_error = Column(Text)
+    structure_id = Column(String)  # ProteinStructure.id of the rendered upload
+
     @classmethod
     def from_model(cls, model):
         return cls(
@@ -96,6 +234,13 @@ class Job(Base):
 
     usis = Column(JSON)
 
+    # Job state machine: queued -> running -> done | failed
+    status = Column(String, default="queued")
+    stage = Column(String)  # current processing stage while running
+    error = Column(Text)  # error message if failed
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+
     sequence_coverage_results = relationship(
         "SequenceCoverageResult", secondary="job_seq_result", back_populates="jobs"
     )
@@ -122,8 +267,8 @@ class SequenceCoverageResult(Base):
     sequence = Column(Text)
     unid = Column(Text)
     description = Column(Text)
-    sequence_coverage = Column(JSON)
-    ptms = Column(JSON)
+    sequence_coverage = Column(CompressedArray)  # np.ndarray, one entry per residue
+    ptms = Column(CompressedArray)  # dictionary of PTM -> np.ndarray of residue indices
     has_pdb = Column(Boolean)
     jobs = relationship(
         "Job", secondary="job_seq_result", back_populates="sequence_coverage_results"
@@ -150,11 +295,15 @@ job_seq_result = Table(
     Base.metadata,
     Column("job_number", StringUUID, ForeignKey("jobs.job_number")),
     Column("id", String, ForeignKey("sequence_coverage_results.id")),
+    Index("ix_job_seq_result_job_number_id", "job_number", "id"),
 )
 
 
 class ProteinStructure(Base):
     __tablename__ = "protein_structures"
+    __table_args__ = (
+        Index("ix_protein_structures_protein_id_species", "protein_id", "species"),
+    )
 
     id = Column(String, primary_key=True)
     protein_id = Column(Text)
@@ -164,6 +313,11 @@ class ProteinStructure(Base):
     view = Column(JSON)
     amino_ele_pos = Column(JSON)
     pdb_str = Column(MutableCompressedText)
+    objs_str = Column(CompressedText)  # helpers.pymol_obj_dict_to_str(objs)
+    view_str = Column(CompressedText)  # helpers.pymol_view_dict_to_str(view)
+    # residue -> atom serial range, see rendering.get_residue_atom_ranges()
+    residue_first_atom = Column(CompressedArray)
+    residue_last_atom = Column(CompressedArray)
 
     @classmethod
     def from_model(cls, model):
@@ -176,14 +330,43 @@ class ProteinStructure(Base):
             view=model.view,
             amino_ele_pos=model.amino_ele_pos,
             pdb_str=model.pdb_str,
+            objs_str=model.objs_str,
+            view_str=model.view_str,
+            residue_first_atom=model.residue_first_atom,
+            residue_last_atom=model.residue_last_atom,
         )
 
 
+class StructureSource(Base):
+    __tablename__ = "structure_sources"
+
+    # PDB files ingested by generate/process_pdb.py, so unchanged files are skipped on later runs.
+    # One row per file name, files with the same content share the structure of their protein.
+    species = Column(Text, primary_key=True)
+    pipeline_version = Column(Integer, primary_key=True)  # rendering.PIPELINE_VERSION
+    filename = Column(Text, primary_key=True)
+    file_hash = Column(String, index=True)  # structures.source_file_hash()
+    file_size = Column(Integer)
+    file_mtime = Column(Double)
+    structure_id = Column(String)  # ProteinStructure.id, replaced when re-rendered
+    processed_at = Column(DateTime, default=datetime.utcnow)
+
+
+class StructureVersion(Base):
+    __tablename__ = "structure_versions"
+
+    species = Column(Text, primary_key=True)
+    version = Column(
+        Integer, default=0
+    )  # bumped whenever structures of the species are added
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
 class FASTA_Entry(Base):
     __tablename__ = "fasta_entries"
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    name = Column(Text)
+    name = Column(Text, index=True)
     source_filename = Column(Text)
     data = Column(JSON)
 
@@ -199,3 +382,58 @@ class Access(Base):
     job_number = Column(
         StringUUID, nullable=True
     )  # nullable because some requests don't have job number. No relationship in case of invalid job number.
+
+
+class AccessDaily(Base):
+    __tablename__ = "access_daily"
+
+    # Access rows rolled up per day, path and method, see access_log.rollup_access()
+    day = Column(Date, primary_key=True)
+    path = Column(String, primary_key=True)
+    method = Column(String, primary_key=True)
+    count = Column(Integer, default=0)
+
+
+def insert_ignoring_duplicates(session, table, rows):
+    """
+    Bulk insert rows, skipping rows whose primary key already exists where the database supports it.
+    Covers concurrent writers inserting the same row between an existence check and the insert.
+    :param session:
+    :param table: Core table
+    :param rows: List of column dictionaries
+    """
+    dialect = session.get_bind().dialect.name
+    if dialect == "sqlite":
+        stmt = sqlite_insert(table).on_conflict_do_nothing()
+    elif dialect == "postgresql":
+        stmt = postgresql_insert(table).on_conflict_do_nothing()
+    else:
+        stmt = insert(table)
+    session.execute(stmt, rows)
+
+
+def upsert(session, table, rows):
+    """
+    Bulk insert rows, replacing the other columns of rows whose primary key already exists
+    :param session:
+    :param table: Core table
+    :param rows: List of column dictionaries
+    """
+    dialect = session.get_bind().dialect.name
+    key = [column.name for column in table.primary_key]
+    if dialect in ("sqlite", "postgresql"):
+        stmt = (sqlite_insert if dialect == "sqlite" else postgresql_insert)(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=key,
+            set_={
+                column.name: stmt.excluded[column.name]
+                for column in table.columns
+                if column.name not in key
+            },
+        )
+        session.execute(stmt, rows)
+        return
+    for row in rows:
+        where = [table.c[name] == row[name] for name in key]
+        if not session.execute(table.update().where(*where).values(row)).rowcount:
+            session.execute(insert(table).values(row))
@@ -0,0 +1,68 @@
+import os
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+
+
+def pool_options():
+    """
+    Connection pool settings, configured by DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT and DB_POOL_RECYCLE
+    """
+    return {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", 5)),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", 10)),
+        "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", 30)),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", 1800)),
+    }
+
+
+def sqlite_pragmas():
+    """
+    Pragmas set on every SQLite connection.
+    WAL lets readers run alongside a writer, writers wait up to SQLITE_BUSY_TIMEOUT_MS for the lock instead of
+    failing with "database is locked". synchronous=NORMAL is durable in WAL mode, except for the last
+    transactions on power loss. SQLITE_MMAP_MB of the database file are read through memory mapping.
+    """
+    return {
+        "journal_mode": "WAL",
+        "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 30000)),
+        "synchronous": "NORMAL",
+        "mmap_size": int(os.getenv("SQLITE_MMAP_MB", 256)) * 1024 * 1024,
+    }
+
+
+def is_memory_database(url):
+    return url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")
+
+
+def create_db_engine(database_url=None, **kwargs):
+    """
+    Create the SQLAlchemy engine of a database, shared by the API, job workers and ingestion scripts.
+    PostgreSQL connections are pooled, checked before use and recycled. SQLite connections are pooled too,
+    each one in WAL mode (see sqlite_pragmas).
+    :param database_url: Database URL, defaults to DATABASE_URL
+    :param kwargs: Passed to create_engine, overriding the defaults
+    :return: Engine
+    """
+    url = make_url(database_url or os.getenv("DATABASE_URL"))
+
+    options = {}
+    if not is_memory_database(url):  # in-memory SQLite databases live in a single connection
+        options.update(pool_options())
+    if url.get_backend_name() != "sqlite":
+        options["pool_pre_ping"] = True  # replace connections closed by the server
+    options.update(kwargs)
+
+    engine = create_engine(url, **options)
+
+    if url.get_backend_name() == "sqlite" and not is_memory_database(url):
+        pragmas = sqlite_pragmas()
+
+        @event.listens_for(engine, "connect")
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name}={value}")
+            cursor.close()
+
+    return engine
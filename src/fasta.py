@@ -0,0 +1,73 @@
+import gzip
+import io
+
+import zstd
+
+try:  # streaming zstd decompression, optional
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+CHUNK_SIZE = 1024 * 1024  # bytes read from the file at once
+
+
+def open_fasta(fasta_path: str, chunk_size: int = CHUNK_SIZE):
+    """
+    Open a FASTA file for reading as text, plain or gzip/zstd compressed (detected from the file's magic bytes).
+    zstd files are streamed if the zstandard package is installed, otherwise decompressed in memory.
+    :param fasta_path:
+    :param chunk_size: Bytes read from the (decompressed) file at once
+    :return: Text stream
+    """
+    with open(fasta_path, "rb") as f:
+        magic = f.read(4)
+
+    if magic.startswith(GZIP_MAGIC):
+        binary = gzip.open(fasta_path, "rb")
+    elif magic == ZSTD_MAGIC and zstandard is not None:
+        binary = zstandard.ZstdDecompressor().stream_reader(
+            open(fasta_path, "rb"), read_size=chunk_size, closefd=True
+        )
+    elif magic == ZSTD_MAGIC:
+        with open(fasta_path, "rb") as f:
+            binary = io.BytesIO(zstd.decompress(f.read()))
+    else:
+        binary = open(fasta_path, "rb", buffering=0)
+    return io.TextIOWrapper(io.BufferedReader(binary, chunk_size), encoding="utf-8")
+
+
+def parse_fasta_header(header: str):
+    """
+    Parse a UniProt FASTA header (without the leading ">"), e.g. "sp|P12345|NAME_HUMAN Description OS=... GN=GENE"
+    :return: (protein_id, gene, description), gene is "N/A" if the header has none
+    """
+    # Non-UniProt headers: the first word is the id
+    protein_id = header.split("|")[1] if "|" in header else header.split(" ")[0]
+    gene = header.split("GN=")[1].split(" ")[0] if "GN=" in header else "N/A"
+    description = " ".join(header.split(" ")[1:]).split(" OS=")[0]
+    return protein_id, gene, description
+
+
+def fasta_records(fasta_path: str, chunk_size: int = CHUNK_SIZE):
+    """
+    Stream the records of a FASTA file (see open_fasta()), keeping only the current record in memory
+    :return: Generator of (protein_id, sequence, gene, description) tuples
+    """
+    header = None
+    sequence = []
+    with open_fasta(fasta_path, chunk_size) as f:
+        for line in f:
+            line = line.rstrip("\r\n")
+            if line.startswith(">"):
+                if header is not None:
+                    protein_id, gene, description = parse_fasta_header(header)
+                    yield protein_id, "".join(sequence), gene, description
+                header = line[1:]
+                sequence = []
+            elif header is not None:  # text before the first header is ignored
+                sequence.append(line)
+    if header is not None:
+        protein_id, gene, description = parse_fasta_header(header)
+        yield protein_id, "".join(sequence), gene, description
@@ -1,22 +1,22 @@
+import struct
 from hashlib import blake2b
 
+import numpy as np
 import pymol
 
+from fasta import fasta_records
+
 
 def fasta_reader(fasta_path: str):
-    protein_dict = {}
-    with open(fasta_path, "r") as f_o:
-        file_split = f_o.read().split("\n>")
-
-    for each in file_split:
-        first_line, seq = each.split("\n")[0], "".join(each.split("\n")[1:])
-        uniprot_id = first_line.split("|")[1]
-        gene = (
-            first_line.split("GN=")[1].split(" ")[0] if "GN=" in first_line else "N/A"
-        )
-        des = " ".join(first_line.split(" ")[1:]).split(" OS=")[0]
-        protein_dict[uniprot_id] = {"sequence": seq, "gene": gene, "des": des}
-    return protein_dict
+    """
+    Read a FASTA file (plain or gzip/zstd compressed) into a dictionary.
+    Holds the whole proteome in memory, use fasta.fasta_records() to stream it.
+    :return: Dictionary of protein id -> {"sequence", "gene", "des"}
+    """
+    return {
+        protein_id: {"sequence": sequence, "gene": gene, "des": description}
+        for protein_id, sequence, gene, description in fasta_records(fasta_path)
+    }
 
 
 def pymol_obj_extract(obj: list) -> dict:
@@ -167,3 +167,42 @@ def calc_hash_of_dict(target_dict):
 
     # Return hash digest
     return digest
+
+
+def _update_hash_with_bytes(h, data: bytes):
+    """
+    Feed a length-prefixed byte string to a hash object, so that consecutive fields can't run together
+    """
+    h.update(struct.pack("<Q", len(data)))
+    h.update(data)
+
+
+def calc_hash_of_coverage(protein_id, sequence, sequence_coverage, ptms):
+    """
+    Calculate the hash of a single protein's sequence coverage result.
+    Only the protein's own fields are digested, using a fixed binary encoding, so the same
+    protein with the same coverage always hashes to the same value regardless of the job.
+    :param protein_id: Protein ID
+    :param sequence: Protein sequence
+    :param sequence_coverage: Per-residue coverage (list or NumPy array)
+    :param ptms: Dictionary mapping PTM key to a list of residue indices
+    :return: Hash digest
+    """
+    h = blake2b()
+
+    _update_hash_with_bytes(h, (protein_id or "").encode("utf-8"))
+    _update_hash_with_bytes(h, (sequence or "").encode("utf-8"))
+    if sequence_coverage is None:
+        sequence_coverage = []
+    _update_hash_with_bytes(
+        h, np.ascontiguousarray(sequence_coverage, dtype="<i8").tobytes()
+    )
+
+    ptms = ptms or {}
+    for key in sorted(ptms):
+        _update_hash_with_bytes(h, key.encode("utf-8"))
+        _update_hash_with_bytes(
+            h, np.ascontiguousarray(ptms[key], dtype="<i8").tobytes()
+        )
+
+    return h.hexdigest()
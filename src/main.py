@@ -1,43 +1,58 @@
+import anyio
+import asyncio
 import configparser
+import gzip
 import json
 import os
 import logging
-import threading
 import pydantic
+import threading
 import uuid
+import zstd
+from collections import OrderedDict
+from datetime import datetime
+from hashlib import blake2b
 from dotenv import load_dotenv
-from fastapi import FastAPI, Form, HTTPException, Request, UploadFile
+from fastapi import FastAPI, Form, HTTPException, Query, Request, UploadFile
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy import create_engine, and_
+from sqlalchemy import and_, or_, select, update, type_coerce, LargeBinary
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.orm import sessionmaker, joinedload
+from sqlalchemy.orm import sessionmaker, joinedload, defer
+from starlette.concurrency import run_in_threadpool
 from starlette.staticfiles import StaticFiles
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
-from typing import Optional
+from typing import List, Optional
 from configparser import ConfigParser
 
 from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
 from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.responses import Response
+from starlette.responses import JSONResponse, Response, StreamingResponse
 
 from models import JobModel, UploadedPDBModel, SequenceCoverageModel
 from database import (
     Job,
-    Access,
-    Base,
     ProteinStructure,
     UploadedPDB,
     SequenceCoverageResult,
+    job_seq_result,
 )
-from processing import worker
-from rendering import get_annotations
+from access_log import AccessLogSink
+from db_engine import create_db_engine, pool_options
+from migrations import migrate
+from processing import run_job
+from render_pool import RenderPool
+from scheduler import JobScheduler, SchedulerFull, SchedulerClosed
+from structures import get_structure_ids, source_hash
+from uploads import UploadRenderer, get_job_upload
+from rendering import get_annotations, get_residue_atom_ranges
 from helpers import (
     pymol_view_dict_to_str,
     pymol_obj_dict_to_str,
     color_dict_to_str,
-    calc_hash_of_dict,
+    calc_hash_of_coverage,
 )
 
 load_dotenv(".env")  # load environmental variables from .env
@@ -108,12 +123,43 @@ logger.addHandler(file_handler)
 
 # === Configure database === #
 
-engine = create_engine(os.getenv("DATABASE_URL"))  # create SQLAlchemy engine
+engine = create_db_engine()  # create SQLAlchemy engine (pooled, WAL mode on SQLite)
 
-Base.metadata.create_all(engine)  # create database tables
+for version, name, _ in migrate(
+    engine
+):  # create tables, upgrade tables created by older versions
+    logger.info(f"Applied schema migration {version}: {name}")
 
 SessionLocal = sessionmaker(bind=engine)  # create session factory
 
+access_log = AccessLogSink.from_env(SessionLocal)  # buffered access logging
+
+# Sessions and (de)compression block, so endpoints run them on a bounded pool of threads instead of the
+# event loop. By default there is one thread per pooled connection, so threads don't wait for connections.
+db_pool = pool_options()
+db_limiter = anyio.CapacityLimiter(
+    int(os.getenv("DB_THREADS", db_pool["pool_size"] + db_pool["max_overflow"]))
+)
+
+
+async def run_db(func, *args):
+    """
+    Run a blocking function (database access, decompression) on the bounded database threadpool
+    :param func: Function to run
+    :param args: Positional arguments of func
+    :return: Return value of func, exceptions are re-raised in the caller
+    """
+    return await anyio.to_thread.run_sync(func, *args, limiter=db_limiter)
+
+
+# === Configure job scheduler === #
+
+scheduler = JobScheduler.from_env(run_job)  # bounded pool of job workers
+
+# Uploaded PDB files are rendered in the background, on PyMOL workers started on the first upload
+render_pool = RenderPool.from_env()
+upload_renderer = UploadRenderer(SessionLocal, render_pool)
+
 # Add CORS middleware to allow requests from any origin
 app.add_middleware(
     CORSMiddleware,
@@ -132,7 +178,12 @@ REQUEST_LATENCY = Histogram(
 @app.middleware("http")
 async def prometheus_middleware(request: Request, call_next):
     endpoint = request.url.path
-    if endpoint in ["/job", "/external-job", "/protein-structure"]:
+    if endpoint in [
+        "/job",
+        "/external-job",
+        "/protein-structure",
+        "/protein-structures",
+    ]:
         with REQUEST_LATENCY.labels(endpoint=endpoint).time():
             response = await call_next(request)
             REQUEST_COUNTER.labels(endpoint=endpoint).inc()
@@ -167,13 +218,36 @@ def load_limiter_config():
 async def startup_event():
     """
     Runs on app startup.
-    Loads rate limiter configuration and applies it to the API.
+    Loads rate limiter configuration and applies it to the API, starts the access log writer, resumes renders of
+    uploads interrupted by a restart.
     :return:
     """
     load_limiter_config()
+    access_log.start()
+    try:
+        resumed = await run_db(upload_renderer.resume)
+        if resumed:
+            logger.info(f"Resumed {resumed} interrupted upload renders")
+    except Exception:  # the server still starts, the uploads stay pending
+        logger.exception("Could not resume interrupted upload renders")
     logger.info("=== New instance started ===")
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """
+    Runs on app shutdown.
+    Stops accepting jobs and uploads and waits for queued and running jobs and renders to finish, writes buffered
+    access records.
+    :return:
+    """
+    logger.info(f"Draining job queue ({scheduler.queued} queued)")
+    await run_in_threadpool(scheduler.shutdown, True)
+    await run_in_threadpool(upload_renderer.shutdown, True)
+    await run_in_threadpool(render_pool.shutdown, True)
+    await access_log.stop()  # write buffered access records
+
+
 # === Endpoint definitions ===
 
 
@@ -183,16 +257,7 @@ async def echo(request: Request, job: str = Form(None)):
     Basic test to ensure API is responding to requests. Echoes back the job ID that was sent in the request.
     """
     logger.info(f"/test received job ID: {job}")
-    try:
-        access = Access(
-            ip=request.client.host, path=request.url.path, method=request.method
-        )
-        with SessionLocal() as session:
-            session.add(access)
-            session.commit()
-    except SQLAlchemyError as e:
-        logger.error(e)
-        raise HTTPException(status_code=500, detail="Database error")
+    access_log.record(request)
     return {"job": job}
 
 
@@ -202,21 +267,21 @@ async def submit_job(
 ):
     """
     Endpoint for submitting a job to the API. Accepts a JSON string containing the job data, and an optional PDB file.
-    Starts a worker thread to process the job.
+    Queues the job on the job scheduler, responds with 503 if the queue is full.
+    The PDB file is rendered in the background, see the "structure" of the job status.
     """
     try:
         logger.debug(f"Received job: {job}")
 
+        if scheduler.is_full():  # reject before storing anything
+            raise SchedulerFull()
+
         job_dict = json.loads(job)  # convert JSON string to dictionary
 
         job_data = JobModel(**job_dict)  # convert dictionary to JobModel
 
         new_job = Job.from_model(job_data)  # convert JobModel to Job
 
-        access = Access(
-            ip=request.client.host, path=request.url.path, method=request.method
-        )  # store request as access
-
         pdb_file = None
 
         if file:  # if a file was uploaded, store it in the database
@@ -234,45 +299,80 @@ async def submit_job(
 
             # store PDB file in database
             pdb_file = UploadedPDB.from_model(pdb_upload)
-
-        with SessionLocal() as session:  # create session, locks database!
-            session.add(new_job)  # add job to db
-            session.commit()  # commit job to db
-
-            job_number = new_job.job_number  # get job number
-
-            access.job_number = job_number  # add job number to access
-            session.add(access)  # add access to db
-
-            if pdb_file:
-                pdb_file.job_number = job_number
-                session.add(pdb_file)
-
-                # Update job pdb_id
-                new_job.pdb_id = pdb_file.pdb_id
-
-            session.commit()  # commit access and pdb file to db
-
-        # Start worker thread, pass session factory to worker
-        t = threading.Thread(
-            target=worker,
-            args=(
-                job_number,
-                SessionLocal(),
-            ),
-        )
-        t.start()
+            pdb_file.file_hash = source_hash(pdb_upload.pdb_file.encode())
+            pdb_file.render_status = "queued"
+
+        def store_job():
+            with SessionLocal() as session:  # create session, locks database!
+                session.add(new_job)  # add job to db
+                session.commit()  # commit job to db
+
+                job_number = new_job.job_number  # get job number
+
+                if pdb_file:
+                    pdb_file.job_number = job_number
+                    session.add(pdb_file)
+
+                    # Update job pdb_id
+                    new_job.pdb_id = pdb_file.pdb_id
+
+                session.commit()  # commit pdb file to db
+                return job_number, pdb_file.id if pdb_file else None
+
+        def mark_failed(job_number):
+            with SessionLocal() as session:
+                session.execute(
+                    update(Job)
+                    .where(Job.job_number == job_number)
+                    .values(
+                        status="failed",
+                        error="Job queue is full",
+                        finished_at=datetime.utcnow(),
+                    )
+                )
+                session.execute(
+                    update(UploadedPDB)
+                    .where(UploadedPDB.job_number == job_number)
+                    .values(render_status="failed", render_error="Job queue is full")
+                )
+                session.commit()
+
+        job_number, upload_id = await run_db(store_job)
+
+        access_log.record(request, job_number)  # store request as access
+
+        try:
+            scheduler.submit(job_number)  # queue job for a worker
+        except (SchedulerFull, SchedulerClosed):
+            # The job is already stored, mark it failed so clients don't wait for it
+            await run_db(mark_failed, job_number)
+            raise
+
+        if upload_id is not None:
+            try:
+                await run_db(upload_renderer.submit, upload_id)  # queue the render
+            except Exception:  # the job runs without the structure
+                logger.exception(f"Could not queue render of job {job_number}'s PDB")
+                await run_db(
+                    upload_renderer.fail, upload_id, "Could not queue the render"
+                )
 
         return {"job_number": job_number}
 
+    except HTTPException:
+        raise
+    except (SchedulerFull, SchedulerClosed):  # if the job queue is at capacity
+        raise HTTPException(
+            status_code=503,
+            detail="Job queue is full, try again later.",
+            headers={"Retry-After": "30"},
+        )
     except json.JSONDecodeError:  # if JSON is invalid
         raise HTTPException(
             status_code=400, detail=[{"type": "decode_error", "msg": "Invalid JSON"}]
         )
     except pydantic.ValidationError as ve:  # if JobModel or UploadedPDBModel is invalid
         raise HTTPException(status_code=400, detail=json.loads(ve.json()))
-    except threading.ThreadError as te:
-        raise HTTPException(status_code=500, detail="Internal error.")
     except SQLAlchemyError as se:
         raise HTTPException(status_code=500, detail="Internal error.")
     except Exception as e:
@@ -282,143 +382,655 @@ async def submit_job(
 @app.post("/job_details")
 async def get_job_details(request: Request, job_number: str = Form(None)):
     try:
-        access = Access(
-            ip=request.client.host,
-            path=request.url.path,
-            method=request.method,
-            job_number=job_number,
+        access_log.record(request, job_number)
+
+        def load_job():
+            with SessionLocal() as session:
+                job = session.query(Job).filter(Job.job_number == job_number).first()
+                if job is None:
+                    raise HTTPException(status_code=404, detail="Job not found")
+                return JSONResponse(jsonable_encoder(job))
+
+        return await run_db(load_job)
+
+    except SQLAlchemyError as e:
+        logger.error(e)
+        raise HTTPException(status_code=500, detail="Database error")
+
+
+def query_job_status(job_number):
+    """
+    Query the state of a job, without loading its PSMs.
+    :param job_number:
+    :return: Status dictionary, or None if the job doesn't exist
+    """
+    with SessionLocal() as session:
+        job = (
+            session.query(
+                Job.status,
+                Job.stage,
+                Job.error,
+                Job.timestamp,
+                Job.started_at,
+                Job.finished_at,
+            )
+            .filter(Job.job_number == job_number)
+            .first()
         )
-        with SessionLocal() as session:
-            session.add(access)
-            session.commit()
+        upload = get_job_upload(session, job_number) if job is not None else None
+    if job is None:
+        return None
+
+    def seconds(start, end):
+        if start is None or end is None:
+            return None
+        return (end - start).total_seconds()
+
+    return {
+        "job_number": job_number,
+        "status": job.status or "done",  # jobs from before the state machine are done
+        "stage": job.stage,
+        "error": job.error,
+        "submitted_at": job.timestamp,
+        "started_at": job.started_at,
+        "finished_at": job.finished_at,
+        "queued_seconds": seconds(job.timestamp, job.started_at),
+        "run_seconds": seconds(job.started_at, job.finished_at),
+        "structure": upload_status(upload),
+    }
+
+
+def upload_status(upload):
+    """
+    Render state of the PDB file uploaded with a job
+    :param upload: Row of uploads.get_job_upload(), or None
+    :return: Dictionary with the render status and, once rendered, the structure URLs, or None without upload
+    """
+    if upload is None:
+        return None
+    done = upload.render_status == "done" and upload.structure_id is not None
+    return {
+        "protein_id": upload.pdb_id,
+        "status": upload.render_status,
+        "error": upload.render_error,
+        "structure_id": upload.structure_id if done else None,
+        "pdb_url": f"/structure/{upload.structure_id}/pdb" if done else None,
+    }
+
+
+@app.post("/job_status")
+async def get_job_status(request: Request, job_number: str = Form(None)):
+    """
+    Cheap status check of a job: queued, running, done or failed, with the current stage and timings.
+    """
+    try:
+        access_log.record(request, job_number)
 
-        with SessionLocal() as session:
-            job = session.query(Job).filter(Job.job_number == job_number).first()
-            if job is None:
-                raise HTTPException(status_code=404, detail="Job not found")
-            return job
+        status = await run_db(query_job_status, job_number)
+        if status is None:
+            raise HTTPException(status_code=404, detail="Job not found")
+        return status
 
     except SQLAlchemyError as e:
         logger.error(e)
         raise HTTPException(status_code=500, detail="Database error")
 
 
-@app.post("/protein-list")
-async def get_protein_list(request: Request, job_number: str = Form(None)):
+STATUS_POLL_INTERVAL = 0.5  # seconds between database checks of a streamed job
+STATUS_HEARTBEAT_INTERVAL = 15  # seconds between keep-alive comments
+
+
+@app.get("/job_status/stream")
+async def stream_job_status(request: Request, job_number: str):
+    """
+    Server-sent event stream of a job's status.
+    Sends a "status" event whenever the status or stage changes, or the render state of an uploaded PDB file.
+    Closes once the job is done or failed and the upload is rendered or failed.
+    """
     try:
-        access = Access(
-            ip=request.client.host,
-            path=request.url.path,
-            method=request.method,
-            job_number=job_number,
-        )
-        with SessionLocal() as session:
-            session.add(access)
-            session.commit()
-        with SessionLocal() as session:
-            job = session.query(Job).filter(Job.job_number == job_number).first()
-            if job is None:
-                raise HTTPException(status_code=404, detail="Job not found")
+        status = await run_db(query_job_status, job_number)
+    except SQLAlchemyError as e:
+        logger.error(e)
+        raise HTTPException(status_code=500, detail="Database error")
+    if status is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    async def events(status):
+        last = None
+        idle = 0.0
+        while True:
+            structure = status["structure"]
+            current = (
+                status["status"],
+                status["stage"],
+                structure and structure["status"],
+            )
+            if current != last:
+                last = current
+                idle = 0.0
+                yield f"event: status\ndata: {json.dumps(status, default=str)}\n\n"
+            elif idle >= STATUS_HEARTBEAT_INTERVAL:
+                idle = 0.0
+                yield ": keep-alive\n\n"
+
+            rendering = structure is not None and structure["status"] in (
+                "queued",
+                "rendering",
+            )
+            if (
+                status["status"] in ("done", "failed") and not rendering
+            ) or await request.is_disconnected():
+                return
+
+            await asyncio.sleep(STATUS_POLL_INTERVAL)
+            idle += STATUS_POLL_INTERVAL
+            try:
+                status = await run_db(query_job_status, job_number) or status
+            except SQLAlchemyError as e:
+                logger.error(e)
+                return
+
+    return StreamingResponse(
+        events(status),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def seq_result_to_dict(seq_result, **overrides):
+    """
+    JSON-serializable dictionary of a sequence coverage result, NumPy arrays become lists
+    """
+    d = SequenceCoverageModel.to_dict(seq_result)
+    if seq_result.sequence_coverage is not None:
+        d["sequence_coverage"] = seq_result.sequence_coverage.tolist()
+    if seq_result.ptms is not None:
+        d["ptms"] = {ptm: indices.tolist() for ptm, indices in seq_result.ptms.items()}
+    d.update(overrides)
+    return d
 
-            seq_results = job.sequence_coverage_results
 
-            for seq_result in seq_results:
-                structure = (
-                    session.query(ProteinStructure)
-                    .filter(
-                        and_(
-                            ProteinStructure.protein_id == seq_result.protein_id,
-                            ProteinStructure.species == job.species,
+@app.post("/protein-list")
+async def get_protein_list(request: Request, job_number: str = Form(None)):
+    try:
+        access_log.record(request, job_number)
+
+        def load_protein_list():
+            with SessionLocal() as session:
+                job = session.query(Job).filter(Job.job_number == job_number).first()
+                if job is None:
+                    raise HTTPException(status_code=404, detail="Job not found")
+
+                seq_results = job.sequence_coverage_results
+
+                # Results are shared between jobs and structures may have been added since, use the current index
+                structure_ids = get_structure_ids(session, job.species)
+                upload = get_job_upload(session, job_number)
+                if upload is not None and upload.render_status == "done":
+                    structure_ids = structure_ids | {upload.pdb_id}
+                # Serialized here, encoding the coverage arrays is too slow for the event loop
+                return JSONResponse(
+                    [
+                        seq_result_to_dict(
+                            seq_result, has_pdb=seq_result.protein_id in structure_ids
                         )
-                    )
-                    .first()
+                        for seq_result in seq_results
+                    ]
                 )
-                if structure is None:
-                    seq_result.has_pdb = False
-                else:
-                    seq_result.has_pdb = True
 
-            return seq_results
+        return await run_db(load_protein_list)
     except SQLAlchemyError as e:
         logger.error(e)
         raise HTTPException(status_code=500, detail="Database error")
 
 
+def render_string(job, seq_result, structure) -> str:
+    """
+    GLmol representation string of a structure colored by a job's sequence coverage
+    :param job: Job (or row with ptm_annotations and background_color)
+    :param seq_result: SequenceCoverageResult of the protein
+    :param structure: ProteinStructure of the protein
+    """
+    if structure.residue_first_atom is not None:
+        residue_atom_ranges = (
+            structure.residue_first_atom,
+            structure.residue_last_atom,
+        )
+    else:  # structures ingested by older versions
+        residue_atom_ranges = get_residue_atom_ranges(structure.amino_ele_pos)
+
+    annotations = get_annotations(
+        seq_result.sequence_coverage,
+        seq_result.ptms,
+        job.ptm_annotations,
+        *residue_atom_ranges,
+    )
+
+    # Structures ingested by older versions have no precomputed render strings
+    objs_str = structure.objs_str or pymol_obj_dict_to_str(structure.objs)
+    view_str = structure.view_str or pymol_view_dict_to_str(structure.view)
+
+    return (
+        objs_str
+        + color_dict_to_str(annotations)
+        + view_str
+        + f"bgcolor:{job.background_color}"
+    )
+
+
+def content_etag(*hashes) -> str:
+    """
+    Strong ETag derived from content hashes
+    """
+    if len(hashes) == 1:
+        return f'"{hashes[0]}"'
+    h = blake2b(digest_size=32)
+    for value in hashes:
+        h.update(str(value).encode("utf-8") + b"\0")
+    return f'"{h.hexdigest()}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """
+    Check If-None-Match against an ETag.
+    Weak validators match too, nginx turns ETags weak when it compresses a response.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+
 @app.post("/protein-structure")
 async def get_protein_structure(
     request: Request, job_number: str = Form(None), protein_id: str = Form(None)
 ):
     try:
-        access = Access(
-            ip=request.client.host,
-            path=request.url.path,
-            method=request.method,
-            job_number=job_number,
-        )
-        with SessionLocal() as session:
-            session.add(access)
-            session.commit()
-        with SessionLocal() as session:
-            job = session.query(Job).filter(Job.job_number == job_number).first()
-            if protein_id is None:
-                raise HTTPException(
-                    status_code=404, detail="Protein structure not found"
-                )
-            if job_number is None:
-                structure = (
-                    session.query(ProteinStructure)
-                    .filter(protein_id == protein_id)
-                    .first()
-                )
-                return structure
-
-            seq_results = job.sequence_coverage_results
-
-            for seq_result in seq_results:
-                if seq_result.protein_id == protein_id:
+        access_log.record(request, job_number)
+
+        def load_structure():
+            with SessionLocal() as session:
+                job = session.query(Job).filter(Job.job_number == job_number).first()
+                if protein_id is None:
+                    raise HTTPException(
+                        status_code=404, detail="Protein structure not found"
+                    )
+                if job_number is None:
                     structure = (
                         session.query(ProteinStructure)
-                        .filter(
-                            and_(
-                                ProteinStructure.protein_id == protein_id,
-                                ProteinStructure.species == job.species,
-                            )
-                        )
+                        .filter(protein_id == protein_id)
                         .first()
                     )
-                    if structure is None:
-                        raise HTTPException(
-                            status_code=404, detail="Protein structure not found"
+                    return structure
+
+                seq_results = job.sequence_coverage_results
+
+                for seq_result in seq_results:
+                    if seq_result.protein_id == protein_id:
+                        structure = (
+                            session.query(ProteinStructure)
+                            .options(
+                                defer(ProteinStructure.objs),
+                                defer(ProteinStructure.view),
+                                defer(ProteinStructure.amino_ele_pos),
+                            )  # only loaded if the precomputed values are missing
+                            .filter(
+                                and_(
+                                    ProteinStructure.protein_id == protein_id,
+                                    ProteinStructure.species == job.species,
+                                )
+                            )
+                            .first()
                         )
+                        if structure is None:
+                            raise HTTPException(
+                                status_code=404, detail="Protein structure not found"
+                            )
+
+                        ret = render_string(job, seq_result, structure)
+
+                        return {
+                            # "view": structure.view,
+                            # "objs": structure.objs,
+                            # "annotations": annotations,
+                            "pdb_str": structure.pdb_str,
+                            "ret": ret,
+                        }
+
+            raise HTTPException(status_code=404, detail="Protein structure not found")
+
+        return await run_db(load_structure)
+    except SQLAlchemyError as e:
+        logger.error(e)
+        raise HTTPException(status_code=500, detail="Database error")
 
-                    annotations = get_annotations(
-                        seq_result.sequence_coverage,
-                        seq_result.ptms,
-                        job.ptm_annotations,
-                        structure.amino_ele_pos,
+
+@app.get("/protein-structure")
+async def get_protein_structure_cached(
+    request: Request, job_number: str, protein_id: str
+):
+    """
+    Cacheable variant of POST /protein-structure.
+    Returns the render string and the URL of the PDB, which is immutable and cached separately.
+    The rendered PDB file uploaded with the job takes precedence over the species' structure of the protein.
+    The ETag is derived from the job, sequence coverage result and structure hashes, so a matching
+    If-None-Match is answered with 304 before anything is loaded or decompressed.
+    """
+    try:
+        access_log.record(request, job_number)
+
+        def load_render_string():
+            with SessionLocal() as session:
+                job = (
+                    session.query(
+                        Job.job_number,
+                        Job.species,
+                        Job.ptm_annotations,
+                        Job.background_color,
                     )
+                    .filter(Job.job_number == job_number)
+                    .first()
+                )
+                if job is None:
+                    raise HTTPException(status_code=404, detail="Job not found")
 
-                    ret = (
-                        pymol_obj_dict_to_str(structure.objs)
-                        + color_dict_to_str(annotations)
-                        + pymol_view_dict_to_str(structure.view)
-                        + f"bgcolor:{job.background_color}"
+                seq_result_id = (
+                    session.query(SequenceCoverageResult.id)
+                    .join(
+                        job_seq_result, job_seq_result.c.id == SequenceCoverageResult.id
+                    )
+                    .filter(
+                        job_seq_result.c.job_number == job_number,
+                        SequenceCoverageResult.protein_id == protein_id,
+                    )
+                    .scalar()
+                )
+                upload = get_job_upload(session, job_number)
+                if (
+                    upload is not None
+                    and upload.pdb_id == protein_id
+                    and upload.render_status == "done"
+                ):
+                    structure_id = upload.structure_id
+                else:
+                    structure_id = (
+                        session.query(ProteinStructure.id)
+                        .filter(
+                            ProteinStructure.protein_id == protein_id,
+                            ProteinStructure.species == job.species,
+                        )
+                        .order_by(ProteinStructure.id)
+                        .limit(1)
+                        .scalar()
+                    )
+                if seq_result_id is None or structure_id is None:
+                    raise HTTPException(
+                        status_code=404, detail="Protein structure not found"
                     )
 
-                    return {
-                        # "view": structure.view,
-                        # "objs": structure.objs,
-                        # "annotations": annotations,
-                        "pdb_str": structure.pdb_str,
-                        "ret": ret,
-                    }
+                etag = content_etag(job.job_number, seq_result_id, structure_id)
+                headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+                if etag_matches(request, etag):
+                    return Response(status_code=304, headers=headers)
 
-        raise HTTPException(status_code=404, detail="Protein structure not found")
+                seq_result = session.get(SequenceCoverageResult, seq_result_id)
+                structure = (
+                    session.query(ProteinStructure)
+                    .options(
+                        defer(ProteinStructure.pdb_str),
+                        defer(ProteinStructure.objs),
+                        defer(ProteinStructure.view),
+                        defer(ProteinStructure.amino_ele_pos),
+                    )
+                    .filter(ProteinStructure.id == structure_id)
+                    .one()
+                )
+                ret = render_string(job, seq_result, structure)
+
+            return JSONResponse(
+                {
+                    "structure_id": structure_id,
+                    "pdb_url": f"/structure/{structure_id}/pdb",
+                    "ret": ret,
+                },
+                headers=headers,
+            )
+
+        return await run_db(load_render_string)
     except SQLAlchemyError as e:
         logger.error(e)
         raise HTTPException(status_code=500, detail="Database error")
 
 
+STRUCTURE_BATCH_LIMIT = 50  # proteins per /protein-structures request
+
+
+def query_structures(session, job_number, protein_ids):
+    """
+    Render strings and structure references of proteins of a job, with one joined query.
+    Like GET /protein-structure, the rendered PDB file uploaded with the job takes precedence.
+    :return: {protein_id: {"structure_id", "pdb_url", "ret"}}, proteins without a sequence coverage result
+             or structure are left out
+    """
+    rows = session.execute(
+        select(
+            Job.ptm_annotations,
+            Job.background_color,
+            SequenceCoverageResult,
+            ProteinStructure,
+            UploadedPDB.structure_id.label("upload_structure_id"),
+        )
+        .select_from(job_seq_result)
+        .join(Job, Job.job_number == job_seq_result.c.job_number)
+        .join(SequenceCoverageResult, SequenceCoverageResult.id == job_seq_result.c.id)
+        .outerjoin(
+            UploadedPDB,
+            and_(
+                UploadedPDB.job_number == Job.job_number,
+                UploadedPDB.pdb_id == SequenceCoverageResult.protein_id,
+                UploadedPDB.render_status == "done",
+            ),
+        )
+        .join(
+            ProteinStructure,
+            or_(
+                and_(
+                    ProteinStructure.protein_id == SequenceCoverageResult.protein_id,
+                    ProteinStructure.species == Job.species,
+                ),
+                # Uploads are deduplicated by content, the structure may be of another protein id
+                ProteinStructure.id == UploadedPDB.structure_id,
+            ),
+        )
+        .where(
+            job_seq_result.c.job_number == job_number,
+            SequenceCoverageResult.protein_id.in_(protein_ids),
+        )
+        .options(
+            defer(ProteinStructure.pdb_str),
+            defer(ProteinStructure.objs),
+            defer(ProteinStructure.view),
+            defer(ProteinStructure.amino_ele_pos),
+        )  # only loaded if the precomputed values are missing
+        .order_by(ProteinStructure.id)
+    ).all()
+
+    # The upload's structure, else the first structure of the species, as GET /protein-structure picks
+    chosen = {}
+    for row in rows:
+        protein_id = row.SequenceCoverageResult.protein_id
+        if (
+            protein_id not in chosen
+            or row.ProteinStructure.id == row.upload_structure_id
+        ):
+            chosen[protein_id] = row
+
+    return {
+        protein_id: {
+            "structure_id": row.ProteinStructure.id,
+            "pdb_url": f"/structure/{row.ProteinStructure.id}/pdb",
+            "ret": render_string(row, row.SequenceCoverageResult, row.ProteinStructure),
+        }
+        for protein_id, row in chosen.items()
+    }
+
+
+@app.get("/protein-structures")
+async def get_protein_structures(
+    request: Request, job_number: str, protein_id: List[str] = Query(...)
+):
+    """
+    Batch variant of GET /protein-structure, for prefetching: render strings and PDB URLs of several proteins
+    of a job in one round trip. Proteins without a structure are left out of the response.
+    """
+    if len(protein_id) > STRUCTURE_BATCH_LIMIT:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {STRUCTURE_BATCH_LIMIT} proteins per request.",
+        )
+    try:
+        access_log.record(request, job_number)
+
+        def load_structures():
+            with SessionLocal() as session:
+                structures = query_structures(session, job_number, protein_id)
+                if not structures and (
+                    session.query(Job.job_number)
+                    .filter(Job.job_number == job_number)
+                    .first()
+                    is None
+                ):
+                    raise HTTPException(status_code=404, detail="Job not found")
+            return JSONResponse(structures)
+
+        return await run_db(load_structures)
+    except SQLAlchemyError as e:
+        logger.error(e)
+        raise HTTPException(status_code=500, detail="Database error")
+
+
+class TranscodeCache:
+    """
+    Thread-safe LRU cache of transcoded response bodies, bounded by their total size in bytes
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                return
+            self._items[key] = value
+            self._size += len(value)
+            while self._size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._size -= len(evicted)
+
+
+pdb_gzip_cache = TranscodeCache(
+    int(os.getenv("PDB_GZIP_CACHE_MB", 64)) * 1024 * 1024
+)  # gzip bodies for clients without zstd support
+
+
+def accepted_encodings(request: Request) -> set:
+    """
+    Content codings accepted by the client, from Accept-Encoding (codings with q=0 are excluded)
+    """
+    encodings = set()
+    for item in request.headers.get("accept-encoding", "").split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding and q > 0:
+            encodings.add(coding.lower())
+    return encodings
+
+
+@app.get("/structure/{structure_id}/pdb")
+async def get_structure_pdb(request: Request, structure_id: str):
+    """
+    PDB of a structure. The URL is content-addressed (the structure id is a hash of its content),
+    so the response never changes and can be cached forever.
+    The PDB is stored zstd-compressed and sent as stored with Content-Encoding: zstd when the client accepts it.
+    Other clients get gzip, transcoded once and kept in an LRU cache. The PDB is never decoded to a string.
+    """
+    accepted = accepted_encodings(request)
+    if "zstd" in accepted:
+        encoding = "zstd"
+    elif "gzip" in accepted or "*" in accepted:
+        encoding = "gzip"
+    else:
+        encoding = None
+
+    # One strong ETag per representation
+    etag = content_etag(f"{structure_id}-{encoding}" if encoding else structure_id)
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "Vary": "Accept-Encoding",
+    }
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    if etag_matches(request, etag):  # answered without touching the database
+        return Response(status_code=304, headers=headers)
+
+    if encoding == "gzip":
+        body = pdb_gzip_cache.get(structure_id)
+        if body is not None:
+            return Response(content=body, media_type="text/plain", headers=headers)
+
+    def load_pdb():
+        with SessionLocal() as session:
+            return (
+                session.query(type_coerce(ProteinStructure.pdb_str, LargeBinary))
+                .filter(ProteinStructure.id == structure_id)
+                .scalar()
+            )  # stored zstd bytes, CompressedText would decompress and decode them
+
+    try:
+        compressed = await run_db(load_pdb)
+    except SQLAlchemyError as e:
+        logger.error(e)
+        raise HTTPException(status_code=500, detail="Database error")
+    if compressed is None:
+        raise HTTPException(status_code=404, detail="Protein structure not found")
+
+    if encoding == "zstd":
+        body = compressed
+    elif encoding == "gzip":
+        body = await run_db(
+            lambda: gzip.compress(zstd.decompress(compressed), compresslevel=6)
+        )
+        pdb_gzip_cache.put(structure_id, body)
+    else:
+        body = await run_db(zstd.decompress, compressed)
+
+    return Response(content=body, media_type="text/plain", headers=headers)
+
+
 @app.post("/external-job")
 async def external_job(
     request: Request, sequence_model: SequenceCoverageModel, job_model: JobModel
@@ -431,34 +1043,42 @@ async def external_job(
 
         new_job = Job.from_model(job_model)
 
-        with SessionLocal() as session:  # create session, locks database!
-            session.add(new_job)  # add job to db
-            session.commit()  # commit job to db
-
-            job_number = new_job.job_number
+        def store_job():
+            with SessionLocal() as session:  # create session, locks database!
+                session.add(new_job)  # add job to db
+                session.commit()  # commit job to db
 
-            # Convert to dict so that we can make a hash using calc_hash_of_dict()
-            seq_dict = SequenceCoverageModel.to_dict(sequence_model)
-            sequence_model.id = calc_hash_of_dict(seq_dict)
+                job_number = new_job.job_number
 
-            # Check if hash exists. If it does, don't make a new model.
-            seq_cov_res = (
-                session.query(SequenceCoverageResult)
-                .filter(SequenceCoverageResult.id == sequence_model.id)
-                .first()
-            )
+                # Hash the protein's own coverage, so identical results share one row
+                sequence_model.id = calc_hash_of_coverage(
+                    sequence_model.protein_id,
+                    sequence_model.sequence,
+                    sequence_model.sequence_coverage,
+                    sequence_model.ptms,
+                )
 
-            if seq_cov_res is None:
-                new_sequence_coverage = SequenceCoverageResult.from_model(
-                    sequence_model
+                # Check if hash exists. If it does, don't make a new model.
+                seq_cov_res = (
+                    session.query(SequenceCoverageResult)
+                    .filter(SequenceCoverageResult.id == sequence_model.id)
+                    .first()
                 )
-                new_job.sequence_coverage = new_sequence_coverage
-                new_sequence_coverage.jobs.append(new_job)
-                session.add(new_sequence_coverage)
-            else:
-                seq_cov_res.jobs.append(new_job)
 
-            session.commit()
+                if seq_cov_res is None:
+                    new_sequence_coverage = SequenceCoverageResult.from_model(
+                        sequence_model
+                    )
+                    new_job.sequence_coverage = new_sequence_coverage
+                    new_sequence_coverage.jobs.append(new_job)
+                    session.add(new_sequence_coverage)
+                else:
+                    seq_cov_res.jobs.append(new_job)
+
+                session.commit()
+            return job_number
+
+        job_number = await run_db(store_job)
 
         return {"job_number": job_number}
 
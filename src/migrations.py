@@ -0,0 +1,209 @@
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Integer,
+    LargeBinary,
+    MetaData,
+    String,
+    Table,
+    Text,
+    inspect,
+)
+from sqlalchemy.exc import SQLAlchemyError
+
+from database import Base
+
+# Applied migrations, kept out of Base so create_all() and the migrations don't manage it twice
+schema_migrations = Table(
+    "schema_migrations",
+    MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("name", Text),
+    Column("applied_at", DateTime, default=datetime.utcnow),
+)
+
+Migration = namedtuple("Migration", ["version", "name", "apply"])
+
+
+def add_columns(*columns):
+    """
+    Migration step adding nullable columns to existing tables. Columns that already exist are skipped, e.g. in
+    tables that create_all() created with them.
+    :param columns: (table name, column name, SQLAlchemy type) tuples
+    :return: Function applying the step to a connection in a transaction, returning the added "table.column" names
+    """
+
+    def apply(conn):
+        added = []
+        inspector = inspect(conn)
+        existing_tables = inspector.get_table_names()
+        for table, name, column_type in columns:
+            if table not in existing_tables:
+                continue  # created by create_all() with the column
+            if name in {c["name"] for c in inspector.get_columns(table)}:
+                continue
+            conn.exec_driver_sql(
+                f'ALTER TABLE {table} ADD COLUMN "{name}" '
+                f"{column_type.compile(dialect=conn.dialect)}"
+            )
+            added.append(f"{table}.{name}")
+        return added
+
+    return apply
+
+
+def create_indexes(*indexes):
+    """
+    Migration step creating indexes on existing tables. Indexes that already exist are skipped.
+    :param indexes: (index name, table name, column names) tuples
+    :return: Function applying the step to a connection in a transaction, returning the created index names
+    """
+
+    def apply(conn):
+        created = []
+        inspector = inspect(conn)
+        existing_tables = inspector.get_table_names()
+        for name, table, index_columns in indexes:
+            if table not in existing_tables:
+                continue
+            if name in {i["name"] for i in inspector.get_indexes(table)}:
+                continue
+            conn.exec_driver_sql(
+                f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(index_columns)})"
+            )
+            created.append(name)
+        return created
+
+    return apply
+
+
+def json_to_bytea(table, *columns):
+    """
+    Migration step changing JSON columns to bytea holding the JSON text, for columns that now store binary data.
+    Only PostgreSQL enforces the JSON type, other databases store the bytes in the existing columns.
+    :param table: Table name
+    :param columns: Column names
+    :return: Function applying the step to a connection in a transaction, returning the changed "table.column" names
+    """
+
+    def apply(conn):
+        if conn.dialect.name != "postgresql":
+            return []
+        changed = []
+        types = {c["name"]: c["type"] for c in inspect(conn).get_columns(table)}
+        for name in columns:
+            if type(types[name]).__name__.upper() not in ("JSON", "JSONB"):
+                continue
+            conn.exec_driver_sql(
+                f"ALTER TABLE {table} ALTER COLUMN {name} TYPE bytea "
+                f"USING convert_to({name}::text, 'UTF8')"
+            )
+            changed.append(f"{table}.{name}")
+        return changed
+
+    return apply
+
+
+# Append new migrations with the next version, never change or reorder applied ones. Each migration spells out
+# the columns and indexes it adds instead of diffing against the current models, so replaying them in order
+# gives the same schema whatever version the database started from.
+MIGRATIONS = [
+    Migration(
+        1,
+        "add job state and structure render columns",
+        add_columns(
+            ("jobs", "status", String()),
+            ("jobs", "stage", String()),
+            ("jobs", "error", Text()),
+            ("jobs", "started_at", DateTime()),
+            ("jobs", "finished_at", DateTime()),
+            ("protein_structures", "objs_str", LargeBinary()),
+            ("protein_structures", "view_str", LargeBinary()),
+            ("protein_structures", "residue_first_atom", LargeBinary()),
+            ("protein_structures", "residue_last_atom", LargeBinary()),
+        ),
+    ),
+    Migration(
+        2,
+        "add lookup indexes",
+        create_indexes(
+            ("ix_fasta_entries_name", "fasta_entries", ["name"]),
+            ("ix_job_seq_result_job_number_id", "job_seq_result", ["job_number", "id"]),
+            (
+                "ix_protein_structures_protein_id_species",
+                "protein_structures",
+                ["protein_id", "species"],
+            ),
+        ),
+    ),
+    Migration(
+        3,
+        "add upload render columns",
+        add_columns(
+            ("uploaded_pdbs", "file_hash", String()),
+            ("uploaded_pdbs", "render_status", String()),
+            ("uploaded_pdbs", "render_error", Text()),
+            ("uploaded_pdbs", "structure_id", String()),
+        ),
+    ),
+    Migration(
+        4,
+        "add upload indexes",
+        create_indexes(
+            ("ix_uploaded_pdbs_file_hash", "uploaded_pdbs", ["file_hash"]),
+            ("ix_uploaded_pdbs_job_number", "uploaded_pdbs", ["job_number"]),
+        ),
+    ),
+    Migration(
+        5,
+        "store coverage arrays as bytea",
+        json_to_bytea("sequence_coverage_results", "sequence_coverage", "ptms"),
+    ),
+]
+
+
+def applied_versions(conn):
+    schema_migrations.create(conn, checkfirst=True)
+    return {row.version for row in conn.execute(schema_migrations.select())}
+
+
+def migrate(engine, migrations=None):
+    """
+    Bring the schema of a database up to date: create missing tables, then apply pending migrations in order.
+    Each migration runs in its own transaction together with its schema_migrations row. If another process
+    applies the same migration concurrently, this process's attempt fails and is skipped once the migration
+    is recorded.
+    :param engine:
+    :param migrations: Migrations to apply, defaults to MIGRATIONS
+    :return: List of (version, name, result) of the applied migrations
+    """
+    migrations = MIGRATIONS if migrations is None else migrations
+
+    # New tables are created with their columns and indexes
+    Base.metadata.create_all(engine)
+
+    with engine.begin() as conn:
+        done = applied_versions(conn)
+
+    applied = []
+    for migration in sorted(migrations, key=lambda m: m.version):
+        if migration.version in done:
+            continue
+        try:
+            with engine.begin() as conn:
+                result = migration.apply(conn)
+                conn.execute(
+                    schema_migrations.insert().values(
+                        version=migration.version, name=migration.name
+                    )
+                )
+        except SQLAlchemyError:
+            with engine.begin() as conn:
+                if migration.version in applied_versions(conn):
+                    continue  # applied by another process in the meantime
+            raise
+        applied.append((migration.version, migration.name, result))
+    return applied
@@ -1,6 +1,6 @@
 import re
 from pydantic import BaseModel, ValidationError, validator
-from typing import List
+from typing import Any, List
 
 
 class JobModel(BaseModel):
@@ -138,6 +138,12 @@ class ProteinStructureModel(BaseModel):
     view: dict = None
     amino_ele_pos: dict = None
     pdb_str: str = None
+    objs_str: str = None
+    view_str: str = None
+    residue_first_atom: Any = (
+        None  # np.ndarray, see rendering.get_residue_atom_ranges()
+    )
+    residue_last_atom: Any = None
 
     @classmethod
     def from_dict(cls, d):
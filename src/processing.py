@@ -1,12 +1,25 @@
 from collections import defaultdict
+from datetime import datetime
+import os
+import threading
 import time
 import re
 import numpy as np
 import ahocorasick
-
-from database import Job, SequenceCoverageResult, FASTA_Entry
+from sqlalchemy import insert, select, update
+from sqlalchemy.orm import sessionmaker
+
+from database import (
+    Job,
+    SequenceCoverageResult,
+    insert_ignoring_duplicates,
+    job_seq_result,
+)
+from db_engine import create_db_engine
 from models import SequenceCoverageModel
-from helpers import fasta_reader, calc_hash_of_dict
+from helpers import calc_hash_of_coverage
+from proteome import get_proteome_index
+from structures import get_structure_ids
 
 
 def generate_peptide_psm_dict(psm_dict, regex_dict):
@@ -59,18 +72,44 @@ def automaton_trie(peptide_list):
 
 
 def automaton_matching(A, seq_line):
-    result = []
+    """
+    Match all peptides of the automaton against the sequence line
+    :param A: Automaton built by automaton_trie()
+    :param seq_line: Sequence line to search
+    :return: Tuple of (start, end, peptide index) arrays with one element per match.
+        The peptide index is the insertion order of the peptide in automaton_trie().
+    """
+    starts = []
+    ends = []
+    peptides = []
     for end_idx, (insert_order, original_value) in A.iter(seq_line):
-        start_idx = end_idx - len(original_value) + 1
-        result.append((start_idx, end_idx, original_value))
-        assert seq_line[start_idx : start_idx + len(original_value)] == original_value
-    return result
+        starts.append(end_idx - len(original_value) + 1)
+        ends.append(end_idx)
+        peptides.append(insert_order)
+    return (
+        np.array(starts, dtype=np.int64),
+        np.array(ends, dtype=np.int64),
+        np.array(peptides, dtype=np.int64),
+    )
 
 
-def extract_UNID_and_seq(protein_dict):
-    UNID_list = [key for key in protein_dict.keys()]
-    seq_list = [value["sequence"] for value in protein_dict.values()]
-    return UNID_list, seq_list
+def match_proteome(A, proteome, chunk_size=1 << 22):
+    """
+    automaton_matching() over the sequence line of a proteome index, decoded slice by slice
+    :param A: Automaton built by automaton_trie()
+    :param proteome: ProteomeIndex
+    :param chunk_size: Approximate bytes decoded at once, see ProteomeIndex.seq_chunks()
+    :return: see automaton_matching(), positions in the whole sequence line
+    """
+    starts, ends, peptides = [], [], []
+    for offset, chunk in proteome.seq_chunks(chunk_size):
+        chunk_starts, chunk_ends, chunk_peptides = automaton_matching(A, chunk)
+        starts.append(chunk_starts + offset)
+        ends.append(chunk_ends + offset)
+        peptides.append(chunk_peptides)
+    if not starts:  # empty proteome
+        return automaton_matching(A, "")
+    return np.concatenate(starts), np.concatenate(ends), np.concatenate(peptides)
 
 
 def zero_line_for_seq(seq_line):
@@ -87,79 +126,236 @@ def separator_pos(seq_line):
     sep_pos_array = np.array(
         [m.start() for m in re.finditer("\|", seq_line)], dtype=np.int32
     )
-    sep_pos_array = np.insert(sep_pos_array, 0, 0)
+    sep_pos_array = np.insert(sep_pos_array, 0, -1)  # first protein starts at 0
     sep_pos_array = np.append(sep_pos_array, len(seq_line))
     return sep_pos_array
 
 
+ptm_mass_pattern = re.compile(r"\[(.*?)\]")
+
+
+def parse_psm_ptm_sites(psm, ptm_patterns):
+    """
+    Parse a PSM into its PTM sites, relative to the stripped peptide sequence
+    :param psm: PSM string including PTM masses, e.g. "PEPS[79.9663]TIDE"
+    :param ptm_patterns: List of (PTM key, compiled pattern) tuples
+    :return: List of (stripped offset, PTM key index) tuples
+    """
+    # Cumulative length of all bracketed masses ending at or before a position
+    bracket_ends = []
+    bracket_shifts = []
+    if "[" in psm:
+        shift = 0
+        for m in ptm_mass_pattern.finditer(psm):
+            shift += m.end() - m.start()
+            bracket_ends.append(m.end())
+            bracket_shifts.append(shift)
+
+    sites = []
+    for key_idx, (ptm, pattern) in enumerate(ptm_patterns):
+        if ptm not in psm:  # cheap substring check before running the regex
+            continue
+        for m in pattern.finditer(psm):
+            pos = m.start()
+            current_shift = 0
+            for end, end_shift in zip(bracket_ends, bracket_shifts):
+                if end > pos:
+                    break
+                current_shift = end_shift
+            sites.append((pos - current_shift, key_idx))
+    return sites
+
+
+def build_ptm_site_table(peptide_psm_dict, psm_group_dict, ptm_keys):
+    """
+    Build compact per-peptide PTM tables, parsing every distinct PSM once.
+    Peptides are numbered in the iteration order of peptide_psm_dict, which is the
+    insertion order used by automaton_trie().
+    :param peptide_psm_dict: Maps stripped peptide to its PSMs
+    :param psm_group_dict: Maps PSM to its group
+    :param ptm_keys: List of PTM keys (keys of ptm_index_line_dict)
+    :return: Tuple of (site_ptr, site_offset, site_key, group_ptr, group_key, group_count).
+        Sites of peptide i are site_offset/site_key[site_ptr[i]:site_ptr[i + 1]], its groups
+        (with the number of PSMs in each group) are group_key/group_count[group_ptr[i]:group_ptr[i + 1]].
+    """
+    ptm_patterns = [(ptm, re.compile(re.escape(ptm))) for ptm in ptm_keys]
+    key_index = {ptm: idx for idx, ptm in enumerate(ptm_keys)}
+    n_peptides = len(peptide_psm_dict)
+
+    # Parse each distinct PSM once
+    psm_sites = {}
+    for psms in peptide_psm_dict.values():
+        for psm in psms:
+            if psm not in psm_sites:
+                psm_sites[psm] = parse_psm_ptm_sites(psm, ptm_patterns)
+
+    site_lists = [
+        [site for psm in psms for site in psm_sites[psm]]
+        for psms in peptide_psm_dict.values()
+    ]
+    site_ptr = np.zeros(n_peptides + 1, dtype=np.int64)
+    site_ptr[1:] = np.cumsum([len(sites) for sites in site_lists])
+    sites = np.array(
+        [site for sites in site_lists for site in sites], dtype=np.int64
+    ).reshape(-1, 2)
+
+    # Count PSMs per (peptide, group)
+    pairs = np.array(
+        [
+            pep_idx * len(ptm_keys) + key_index[psm_group_dict[psm]]
+            for pep_idx, psms in enumerate(peptide_psm_dict.values())
+            for psm in psms
+            if psm in psm_group_dict
+        ],
+        dtype=np.int64,
+    )
+    pairs, group_count = np.unique(pairs, return_counts=True)
+    group_ptr = np.searchsorted(
+        pairs, np.arange(n_peptides + 1, dtype=np.int64) * len(ptm_keys)
+    )
+
+    return (
+        site_ptr,
+        sites[:, 0],
+        sites[:, 1],
+        group_ptr,
+        pairs % max(len(ptm_keys), 1),
+        group_count.astype(np.int64),
+    )
+
+
+def expand_hits(hit_peptide, ptr):
+    """
+    Expand every hit into the per-peptide table entries of its peptide
+    :param hit_peptide: Peptide index of every hit
+    :param ptr: Row pointer of a per-peptide table (see build_ptm_site_table())
+    :return: Tuple of (hit index, entry index) arrays with one element per expanded entry
+    """
+    count = ptr[hit_peptide + 1] - ptr[hit_peptide]
+    total = int(count.sum())
+    hit_idx = np.repeat(np.arange(len(hit_peptide)), count)
+    entry_idx = np.repeat(
+        ptr[hit_peptide] - (np.cumsum(count) - count), count
+    ) + np.arange(total)
+    return hit_idx, entry_idx
+
+
+def accumulate_coverage(line, starts, ends, weights):
+    """
+    Add weights[i] to line[starts[i] : ends[i] + 1] for every interval at once,
+    using a scatter add on a difference array followed by a cumulative sum
+    :param line: Coverage line, updated in place
+    :param starts: Start index of every interval
+    :param ends: End index (inclusive) of every interval
+    :param weights: Weight of every interval
+    :return: line
+    """
+    diff = np.zeros(len(line) + 1, dtype=line.dtype)
+    np.add.at(diff, starts, weights)
+    np.add.at(diff, ends + 1, -weights)
+    line += np.cumsum(diff[:-1], dtype=line.dtype)
+    return line
+
+
 def process_aho_result(
     aho_result, ptm_index_line_dict, peptide_psm_dict, psm_group_dict, zero_line
 ):
-    for tp in aho_result:
-        matched_pep = tp[2]  # without ptm site
-        zero_line[tp[0] : tp[1] + 1] += len(peptide_psm_dict[matched_pep])
-
-        # ptm assign might need to be optimized
-        if ptm_index_line_dict:  # if ptm enabled
-            for psm in peptide_psm_dict[matched_pep]:
-                # first label group PTM
-                if psm in psm_group_dict:
-                    group_ptm = psm_group_dict[psm]
-                    ptm_index_line_dict[group_ptm][tp[0] : tp[1] + 1] += 1
-
-                # then label each PTM inside each PSM
-                for ptm in ptm_index_line_dict:
-                    # Create a pattern for regex operation
-                    ptm_pattern = re.escape(ptm)
-
-                    # Find all occurrences of ptm in psm
-                    ptm_occurrences = [m.start() for m in re.finditer(ptm_pattern, psm)]
-
-                    # FIX: find other ptm positions as well
-                    ptm_positions = [m.span() for m in re.finditer(r"\[(.*?)\]", psm)]
-                    ptm_end_pos = [i[1] for i in ptm_positions]
-                    ptm_len = [i[1] - i[0] for i in ptm_positions]
-                    ptm_offset = [
-                        sum(ptm_len[: idx + 1]) for idx, value in enumerate(ptm_len)
-                    ]
-                    pos_shift_dict = dict(zip(ptm_end_pos, ptm_offset))
-                    ptm_shift_dict = {}
-                    current_shift = 0
-                    for i in range(len(psm)):
-                        if i in pos_shift_dict:
-                            current_shift = pos_shift_dict[i]
-                        ptm_shift_dict[i] = current_shift
-
-                    # Adjust the index for occurrences
-                    adjusted_occurrences = [
-                        ind - ptm_shift_dict[ind] for ind in ptm_occurrences
-                    ]
-
-                    # Increment the count in ptm_index_line_dict
-                    for indx in adjusted_occurrences:
-                        ptm_index_line_dict[ptm][tp[0] + indx] += 1
+    hit_start, hit_end, hit_peptide = aho_result
+
+    psm_count = np.fromiter(
+        (len(psms) for psms in peptide_psm_dict.values()),
+        dtype=np.int64,
+        count=len(peptide_psm_dict),
+    )
+    zero_line = accumulate_coverage(
+        zero_line, hit_start, hit_end, psm_count[hit_peptide]
+    )
+
+    if ptm_index_line_dict:  # if ptm enabled
+        ptm_keys = list(ptm_index_line_dict)
+        (
+            site_ptr,
+            site_offset,
+            site_key,
+            group_ptr,
+            group_key,
+            group_count,
+        ) = build_ptm_site_table(peptide_psm_dict, psm_group_dict, ptm_keys)
+
+        # first label group PTM over the whole matched range
+        hit_idx, entry_idx = expand_hits(hit_peptide, group_ptr)
+        keys = group_key[entry_idx]
+        for key_idx, ptm in enumerate(ptm_keys):
+            mask = keys == key_idx
+            accumulate_coverage(
+                ptm_index_line_dict[ptm],
+                hit_start[hit_idx[mask]],
+                hit_end[hit_idx[mask]],
+                group_count[entry_idx[mask]],
+            )
+
+        # then label each PTM inside each PSM
+        hit_idx, entry_idx = expand_hits(hit_peptide, site_ptr)
+        positions = hit_start[hit_idx] + site_offset[entry_idx]
+        keys = site_key[entry_idx]
+        for key_idx, ptm in enumerate(ptm_keys):
+            np.add.at(ptm_index_line_dict[ptm], positions[keys == key_idx], 1)
+
     return zero_line, ptm_index_line_dict
 
 
-def calculate_coverage(zero_line_slice):
+def protein_bounds(sep_pos_array):
     """
-    Calculate the coverage of a slice by counting the number of non-zero elements
-    :param zero_line_slice:
-    :return:
+    Return the [start, end) interval of each protein in the sequence line
+    :param sep_pos_array: Separator positions returned by separator_pos()
+    :return: Tuple of (starts, ends) arrays
     """
-    length = len(zero_line_slice)
-    if length > 0 and np.any(zero_line_slice):
-        percentage_cov = np.count_nonzero(zero_line_slice) / length
-    else:
-        percentage_cov = 0.0
-    return percentage_cov
+    starts = sep_pos_array[:-1].astype(np.int64) + 1
+    ends = sep_pos_array[1:].astype(np.int64)
+    return starts, ends
+
+
+def count_nonzero_by_protein(line, starts, ends):
+    """
+    Count the non-zero elements of every protein interval at once
+    :param line: Array with one element per position of the sequence line
+    :param starts: Start index of every protein
+    :param ends: End index (exclusive) of every protein
+    :return: Array with the number of non-zero elements of each protein
+    """
+    bounds = np.empty(2 * len(starts), dtype=np.int64)
+    bounds[0::2] = starts
+    bounds[1::2] = ends
+    # reduceat needs every index to be valid, pad with a trailing zero
+    nonzero = np.append(line != 0, False)
+    counts = np.add.reduceat(nonzero, bounds, dtype=np.int64)[0::2]
+    counts[ends <= starts] = 0  # reduceat returns the element itself for empty intervals
+    return counts
+
+
+def nonzero_offsets_by_protein(line, starts, ends, proteins):
+    """
+    Find the offsets of the non-zero elements of the selected proteins
+    :param line: Array with one element per position of the sequence line
+    :param starts: Start index of every protein
+    :param ends: End index (exclusive) of every protein
+    :param proteins: Sorted indices of the proteins to report
+    :return: Tuple of (offsets, lo, hi); the offsets of proteins[j] are offsets[lo[j]:hi[j]]
+    """
+    positions = np.flatnonzero(line)
+    owner = np.searchsorted(starts, positions, side="right") - 1
+    valid = (owner >= 0) & (positions < ends[owner])
+    positions = positions[valid]
+    owner = owner[valid]
+    offsets = positions - starts[owner]
+    lo = np.searchsorted(owner, proteins, side="left")
+    hi = np.searchsorted(owner, proteins, side="right")
+    return offsets, lo, hi
 
 
 def calculate_coverage_and_ptm(
-    sep_pos_array,
-    id_list,
+    proteome,
     zero_line,
-    protein_dict,
     pdbs,
     ptm_index_line_dict,
     regex_dict,
@@ -168,42 +364,44 @@ def calculate_coverage_and_ptm(
 
     start_time = time.time()
 
-    for i in range(len(sep_pos_array) - 1):
-        zero_line_slice = zero_line[sep_pos_array[i] + 1 : sep_pos_array[i + 1]]
-        percentage_cov = calculate_coverage(zero_line_slice)
-        if percentage_cov != 0.0:  # only add if the coverage is not 0
-            identified[id_list[i]] = {
-                "coverage": percentage_cov,
-                "protein_id": id_list[i],
-                "sequence": protein_dict[id_list[i]]["sequence"],
-                "unid": protein_dict[id_list[i]]["gene"],
-                "description": protein_dict[id_list[i]]["des"],
-                "sequence_coverage": zero_line_slice.tolist(),
-                "has_pdb": id_list[i] in pdbs,
-                "ptms": {},  # will be filled later
-            }
-
-            if regex_dict and ptm_index_line_dict:  # if ptm enabled
-                for ptm in ptm_index_line_dict:  # for each ptm
-                    idx_list = np.array(
-                        np.nonzero(
-                            ptm_index_line_dict[ptm][
-                                sep_pos_array[i] + 1 : sep_pos_array[i + 1]
-                            ]
-                        )
-                    )[0].tolist()
-                    identified[id_list[i]]["ptms"].update({ptm: idx_list})
-
-            # Store the sequence coverage hash
-            hsh = calc_hash_of_dict(identified)
-            identified[id_list[i]]["id"] = hsh
+    starts, ends = protein_bounds(proteome.sep_pos_array)
+    covered_counts = count_nonzero_by_protein(zero_line, starts, ends)
+    covered = np.flatnonzero(covered_counts)  # only add if the coverage is not 0
+
+    ptm_offsets = {}
+    if regex_dict and ptm_index_line_dict:  # if ptm enabled
+        for ptm in ptm_index_line_dict:
+            ptm_offsets[ptm] = nonzero_offsets_by_protein(
+                ptm_index_line_dict[ptm], starts, ends, covered
+            )
+
+    for j, i in enumerate(covered):
+        protein_id = proteome.ids[i]
+        sequence = proteome.sequence(i)
+        sequence_coverage = zero_line[starts[i] : ends[i]]
+        ptms = {
+            ptm: offsets[lo[j] : hi[j]].tolist()
+            for ptm, (offsets, lo, hi) in ptm_offsets.items()
+        }
+        identified[protein_id] = {
+            "id": calc_hash_of_coverage(protein_id, sequence, sequence_coverage, ptms),
+            "coverage": int(covered_counts[i]) / int(ends[i] - starts[i]),
+            "protein_id": protein_id,
+            "sequence": sequence,
+            "unid": proteome.genes[i],
+            "description": proteome.descriptions[i],
+            "sequence_coverage": sequence_coverage.tolist(),
+            "has_pdb": protein_id in pdbs,
+            "ptms": ptms,
+        }
 
     print("Time used for calculating coverage and ptm: ", time.time() - start_time)
 
     return identified
 
 
-def freq_ptm_index_gen_batch(psms, ptm_annotations, protein_dict, pdbs):
+def freq_ptm_index_gen_batch(psms, ptm_annotations, proteome, pdbs, progress=None):
+    progress = progress or (lambda stage: None)
 
     regex_pat = "\w{1}\[\d+\.?\d+\]"  # universal ptm pattern
 
@@ -214,31 +412,28 @@ def freq_ptm_index_gen_batch(psms, ptm_annotations, protein_dict, pdbs):
         psm_list, regex_pat, my_replace, peptide_psm_dict
     )
 
-    # aho mapping
-    id_list, seq_list = extract_UNID_and_seq(protein_dict)
-    seq_line = "|".join(seq_list)
-    zero_line = zero_line_for_seq(seq_line)
+    # aho mapping, the sequence line is only decoded slice by slice
+    zero_line = zero_line_for_seq(proteome.seq)
 
     ptm_index_line_dict = (
-        {each: zero_line_for_seq(seq_line) for each in ptm_annotations}
+        {each: zero_line_for_seq(proteome.seq) for each in ptm_annotations}
         if ptm_annotations
         else False
     )
 
-    sep_pos_array = separator_pos(seq_line)
-    aho_result = automaton_matching(
-        automaton_trie([pep for pep in peptide_psm_dict]), seq_line
+    progress("matching peptides")
+    aho_result = match_proteome(
+        automaton_trie([pep for pep in peptide_psm_dict]), proteome
     )
 
     zero_line, ptm_index_line_dict = process_aho_result(
         aho_result, ptm_index_line_dict, peptide_psm_dict, psm_group_dict, zero_line
     )
 
+    progress("calculating coverage")
     identified = calculate_coverage_and_ptm(
-        sep_pos_array,
-        id_list,
+        proteome,
         zero_line,
-        protein_dict,
         pdbs,
         ptm_index_line_dict,
         ptm_annotations,
@@ -272,52 +467,160 @@ def gen_sequence_cov_models(identified_dict):
     return mdls
 
 
-def worker(job_number, session):
+def result_batch_size():
+    """
+    Number of sequence coverage results persisted per batch, set by RESULT_BATCH_SIZE
+    """
+    return max(1, int(os.getenv("RESULT_BATCH_SIZE", 500)))
+
+
+def save_sequence_coverage_results(
+    session, job_number, seq_cov_models, batch_size=None
+):
+    """
+    Persist the sequence coverage results of a job and link them to the job.
+    Per batch, existing results are found with a single IN query, new results and all job links are bulk inserted.
+    Everything is committed once at the end.
+    :param session:
+    :param job_number:
+    :param seq_cov_models: List of SequenceCoverageModel
+    :param batch_size: Results per batch, defaults to result_batch_size()
+    :return: Number of newly inserted results
+    """
+    batch_size = batch_size or result_batch_size()
+    results_table = SequenceCoverageResult.__table__
+    columns = [column.name for column in results_table.columns]
+
+    # Identical results hash to the same id, keep one of each
+    models = list({model.id: model for model in seq_cov_models}.values())
+
+    inserted = 0
+    for batch_start in range(0, len(models), batch_size):
+        start_time = time.time()
+        batch = models[batch_start : batch_start + batch_size]
+
+        existing = set(
+            session.scalars(
+                select(results_table.c.id).where(
+                    results_table.c.id.in_([model.id for model in batch])
+                )
+            )
+        )
+        new_rows = [
+            model.dict(include=set(columns))
+            for model in batch
+            if model.id not in existing
+        ]
+        if new_rows:
+            insert_ignoring_duplicates(session, results_table, new_rows)
+        session.execute(
+            insert(job_seq_result),
+            [{"job_number": job_number, "id": model.id} for model in batch],
+        )
+        inserted += len(new_rows)
 
-    # Get the job
-    job = session.query(Job).filter(Job.job_number == job_number).first()
+        print(
+            f"Time used for saving results {batch_start}-{batch_start + len(batch)} "
+            f"({len(new_rows)} new): ",
+            time.time() - start_time,
+        )
 
-    # Get protein dictionary
-    fasta = session.query(FASTA_Entry).filter(FASTA_Entry.name == job.species).first()
-    if fasta is None:
-        raise ValueError("No fasta entry found for species: {}".format(job.species))
-    protein_dict = fasta.data
+    session.commit()
+    return inserted
 
-    # Identify sequence coverage
-    identified = freq_ptm_index_gen_batch(
-        job.psms, job.ptm_annotations, protein_dict, pdbs={}
-    )  # TODO: add pdbs
 
-    # Generate sequence coverage models
-    seq_cov_models = gen_sequence_cov_models(identified)
+_session_factory = None
+_session_factory_lock = threading.Lock()
 
-    # Add the sequence coverage models to the database
-    for seq_cov_model in seq_cov_models:
-        # First check if the sequence coverage model already exists
-        seq_cov_res = (
-            session.query(SequenceCoverageResult)
-            .filter(SequenceCoverageResult.id == seq_cov_model.id)
-            .first()
-        )
 
-        if seq_cov_res is None:
-            # If the sequence coverage model does not exist, add it to the database
-            seq_cov_res = SequenceCoverageResult.from_model(seq_cov_model)
-            session.add(seq_cov_res)
+def get_session_factory():
+    """
+    Session factory for job workers, created once per process from DATABASE_URL
+    """
+    global _session_factory
+    with _session_factory_lock:
+        if _session_factory is None:
+            _session_factory = sessionmaker(bind=create_db_engine())
+    return _session_factory
 
-            # Get all jobs with job_number == job_number
-            jobs = session.query(Job).filter(Job.job_number == job_number).all()
 
-            # Add the job to the sequence coverage model
-            for job in jobs:
-                seq_cov_res.jobs.append(job)
+def run_job(job_number):
+    """
+    Entry point for the job scheduler, works in worker threads and worker processes alike
+    """
+    worker(job_number, get_session_factory())
 
-        else:
-            # If the sequence coverage model does exist, add the job to the sequence coverage model
-            seq_cov_res.jobs.append(job)
 
-    # Commit the changes
+def update_job_status(session, job_number, **values):
+    """
+    Update the state of a job and commit immediately, so that status requests see it
+    :param session:
+    :param job_number:
+    :param values: Job columns to set (status, stage, error, started_at, finished_at)
+    """
+    session.execute(update(Job).where(Job.job_number == job_number).values(**values))
     session.commit()
 
-    # Close the session
-    session.close()
\ No newline at end of file
+
+def worker(job_number, session_factory):
+    with session_factory() as session:
+        update_job_status(
+            session,
+            job_number,
+            status="running",
+            stage="starting",
+            started_at=datetime.utcnow(),
+        )
+        try:
+            process_job(
+                job_number,
+                session,
+                progress=lambda stage: update_job_status(
+                    session, job_number, stage=stage
+                ),
+            )
+        except Exception as e:
+            session.rollback()
+            update_job_status(
+                session,
+                job_number,
+                status="failed",
+                error=str(e) or type(e).__name__,
+                finished_at=datetime.utcnow(),
+            )
+            raise
+        update_job_status(
+            session,
+            job_number,
+            status="done",
+            stage=None,
+            finished_at=datetime.utcnow(),
+        )
+
+
+def process_job(job_number, session, progress=None):
+    progress = progress or (lambda stage: None)
+
+    # Get the job
+    job = session.query(Job).filter(Job.job_number == job_number).first()
+    if job is None:
+        raise ValueError("No job found with job number: {}".format(job_number))
+
+    # Get the proteome index, built once per species
+    progress("loading proteome")
+    proteome = get_proteome_index(session, job.species)
+
+    # Proteins with a structure available, for has_pdb
+    pdbs = get_structure_ids(session, job.species)
+
+    # Identify sequence coverage
+    identified = freq_ptm_index_gen_batch(
+        job.psms, job.ptm_annotations, proteome, pdbs=pdbs, progress=progress
+    )
+
+    # Generate sequence coverage models
+    progress("saving results")
+    seq_cov_models = gen_sequence_cov_models(identified)
+
+    # Add the sequence coverage models to the database
+    save_sequence_coverage_results(session, job_number, seq_cov_models)
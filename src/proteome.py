@@ -0,0 +1,402 @@
+import json
+import logging
+import os
+import shutil
+import struct
+import threading
+
+import numpy as np
+from sqlalchemy.engine import make_url
+
+from database import FASTA_Entry
+
+logger = logging.getLogger("uvicorn")
+
+INDEX_VERSION = 1  # bump when the on-disk layout changes
+SEPARATOR = ord("|")
+
+
+class StringTable:
+    """
+    Immutable list of strings stored as one UTF-8 byte array plus offsets, so it can be memory-mapped.
+    """
+
+    def __init__(self, data: np.ndarray, offsets: np.ndarray):
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def from_list(cls, strings: list):
+        encoded = [s.encode("utf-8") for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(b) for b in encoded])
+        data = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        return cls(data, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i) -> str:
+        return (
+            self.data[self.offsets[i] : self.offsets[i + 1]].tobytes().decode("utf-8")
+        )
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class ProteomeIndex:
+    """
+    Concatenated proteome of one species, ready for Aho-Corasick matching.
+    Holds the "|"-joined sequence line as bytes, the separator offsets and the id/gene/description tables.
+    Indexes loaded from disk are memory-mapped, so several processes share the same pages.
+    """
+
+    _tables = ("ids", "genes", "descriptions")
+
+    def __init__(
+        self,
+        name: str,
+        source_id: int,
+        seq: np.ndarray,
+        sep_pos_array: np.ndarray,
+        ids: StringTable,
+        genes: StringTable,
+        descriptions: StringTable,
+    ):
+        self.name = name
+        self.source_id = source_id  # FASTA_Entry.id the index was built from
+        self.seq = seq  # uint8 array of the sequence line
+        self.sep_pos_array = sep_pos_array  # see processing.separator_pos()
+        self.ids = ids
+        self.genes = genes
+        self.descriptions = descriptions
+
+    @classmethod
+    def from_records(cls, name: str, source_id: int, records):
+        """
+        Build an index from (protein_id, sequence, gene, description) records
+        """
+        ids, seqs, genes, descriptions = [], [], [], []
+        for protein_id, sequence, gene, description in records:
+            ids.append(protein_id)
+            seqs.append(sequence)
+            genes.append(gene)
+            descriptions.append(description)
+
+        seq = np.frombuffer("|".join(seqs).encode("ascii"), dtype=np.uint8)
+        sep_pos_array = np.concatenate(
+            ([-1], np.flatnonzero(seq == SEPARATOR), [len(seq)] if ids else [])
+        ).astype(np.int64)
+
+        return cls(
+            name,
+            source_id,
+            seq,
+            sep_pos_array,
+            StringTable.from_list(ids),
+            StringTable.from_list(genes),
+            StringTable.from_list(descriptions),
+        )
+
+    @classmethod
+    def from_protein_dict(cls, name: str, source_id: int, protein_dict: dict):
+        """
+        Build an index from a protein dictionary as returned by helpers.fasta_reader()
+        """
+        return cls.from_records(
+            name,
+            source_id,
+            (
+                (protein_id, value["sequence"], value["gene"], value["des"])
+                for protein_id, value in protein_dict.items()
+            ),
+        )
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def seq_line(self) -> str:
+        """
+        The "|"-joined sequence line. Decoded on every access, the index only keeps the bytes.
+        """
+        return self.seq.tobytes().decode("ascii")
+
+    def seq_chunks(self, size=1 << 22):
+        """
+        The sequence line decoded in slices of whole proteins of about size bytes, so a job never holds the whole
+        line as a string. Peptides don't span separators, matching the slices finds the matches of the whole line.
+        :return: Generator of (offset of the slice in the sequence line, slice)
+        """
+        length = len(self.seq)
+        start = 0
+        while start < length:
+            k = np.searchsorted(
+                self.sep_pos_array, start + size
+            )  # first separator past the size
+            end = int(self.sep_pos_array[k]) if k < len(self.sep_pos_array) else length
+            yield start, self.seq[start:end].tobytes().decode("ascii")
+            start = end
+
+    def sequence(self, i) -> str:
+        return (
+            self.seq[self.sep_pos_array[i] + 1 : self.sep_pos_array[i + 1]]
+            .tobytes()
+            .decode("ascii")
+        )
+
+    def save(self, directory: str):
+        """
+        Persist the index as a directory of .npy files that can be memory-mapped.
+        The directory is written next to its final location and renamed into place.
+        """
+        tmp_directory = f"{directory}.tmp-{os.getpid()}"
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        os.makedirs(tmp_directory)
+
+        np.save(os.path.join(tmp_directory, "seq.npy"), self.seq)
+        np.save(os.path.join(tmp_directory, "sep.npy"), self.sep_pos_array)
+        for table in self._tables:
+            np.save(
+                os.path.join(tmp_directory, f"{table}.npy"), getattr(self, table).data
+            )
+            np.save(
+                os.path.join(tmp_directory, f"{table}_offsets.npy"),
+                getattr(self, table).offsets,
+            )
+        with open(os.path.join(tmp_directory, "meta.json"), "w") as f:
+            json.dump(
+                {
+                    "version": INDEX_VERSION,
+                    "name": self.name,
+                    "source_id": self.source_id,
+                    "proteins": len(self),
+                },
+                f,
+            )
+
+        shutil.rmtree(directory, ignore_errors=True)
+        os.replace(tmp_directory, directory)
+
+    @classmethod
+    def load(cls, directory: str):
+        """
+        Load a persisted index with memory-mapped arrays
+        :return: ProteomeIndex, or None if the directory doesn't hold a valid index
+        """
+        try:
+            with open(os.path.join(directory, "meta.json")) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if meta.get("version") != INDEX_VERSION:
+            return None
+
+        def load_array(filename):
+            return np.load(os.path.join(directory, filename), mmap_mode="r")
+
+        tables = {
+            table: StringTable(
+                load_array(f"{table}.npy"), load_array(f"{table}_offsets.npy")
+            )
+            for table in cls._tables
+        }
+        return cls(
+            meta["name"],
+            meta["source_id"],
+            load_array("seq.npy"),
+            load_array("sep.npy"),
+            **tables,
+        )
+
+
+class ProteomeIndexWriter:
+    """
+    Writes a proteome index to disk one record at a time, with constant memory.
+    Produces the same files as ProteomeIndex.save(). Records are appended to raw files in a temporary
+    directory, which becomes the index on finish(). Use as a context manager to remove it on errors.
+    """
+
+    def __init__(self, directory: str, name: str):
+        self.directory = directory
+        self.name = name
+        self.tmp_directory = f"{directory}.tmp-{os.getpid()}"
+        shutil.rmtree(self.tmp_directory, ignore_errors=True)
+        os.makedirs(self.tmp_directory)
+
+        # file name -> dtype, for the .npy files written by finish()
+        self._dtypes = {"seq": np.uint8, "sep": np.int64}
+        for table in ProteomeIndex._tables:
+            self._dtypes[table] = np.uint8
+            self._dtypes[f"{table}_offsets"] = np.int64
+        self._files = {
+            filename: open(self._raw_path(filename), "wb", buffering=1024 * 1024)
+            for filename in self._dtypes
+        }
+        self._seq_length = 0
+        self._table_lengths = dict.fromkeys(ProteomeIndex._tables, 0)
+        self.count = 0
+
+        self._write_int("sep", -1)
+        for table in ProteomeIndex._tables:
+            self._write_int(f"{table}_offsets", 0)
+
+    def _raw_path(self, filename):
+        return os.path.join(self.tmp_directory, f"{filename}.raw")
+
+    def _write_int(self, filename, value):
+        self._files[filename].write(struct.pack("=q", value))  # native int64
+
+    def add(self, protein_id: str, sequence: str, gene: str, description: str):
+        """
+        Append a record, see ProteomeIndex.from_records()
+        """
+        if self.count:
+            self._files["seq"].write(b"|")
+            self._write_int("sep", self._seq_length)
+            self._seq_length += 1
+        encoded = sequence.encode("ascii")
+        self._files["seq"].write(encoded)
+        self._seq_length += len(encoded)
+
+        for table, value in zip(ProteomeIndex._tables, (protein_id, gene, description)):
+            encoded = value.encode("utf-8")
+            self._files[table].write(encoded)
+            self._table_lengths[table] += len(encoded)
+            self._write_int(f"{table}_offsets", self._table_lengths[table])
+        self.count += 1
+
+    def _close_files(self):
+        for f in self._files.values():
+            f.close()
+
+    def finish(self, source_id: int):
+        """
+        Write the .npy files and metadata, and move the index into place
+        :param source_id: FASTA_Entry.id the index was built from
+        :return: Number of records
+        """
+        if self.count:
+            self._write_int("sep", self._seq_length)
+        self._close_files()
+
+        for filename, dtype in self._dtypes.items():
+            dtype = np.dtype(dtype)
+            raw_path = self._raw_path(filename)
+            with open(raw_path, "rb") as raw, open(
+                os.path.join(self.tmp_directory, f"{filename}.npy"), "wb"
+            ) as f:
+                np.lib.format.write_array_header_1_0(
+                    f,
+                    {
+                        "descr": np.lib.format.dtype_to_descr(dtype),
+                        "fortran_order": False,
+                        "shape": (os.path.getsize(raw_path) // dtype.itemsize,),
+                    },
+                )
+                shutil.copyfileobj(raw, f, 1024 * 1024)
+            os.remove(raw_path)
+
+        with open(os.path.join(self.tmp_directory, "meta.json"), "w") as f:
+            json.dump(
+                {
+                    "version": INDEX_VERSION,
+                    "name": self.name,
+                    "source_id": source_id,
+                    "proteins": self.count,
+                },
+                f,
+            )
+
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.replace(self.tmp_directory, self.directory)
+        return self.count
+
+    def abort(self):
+        """
+        Discard the records written so far
+        """
+        self._close_files()
+        shutil.rmtree(self.tmp_directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if os.path.isdir(self.tmp_directory):  # not finished
+            self.abort()
+
+
+def proteome_index_dir(database_url=None):
+    """
+    Directory where proteome indexes are persisted.
+    Set by PROTEOME_INDEX_DIR, or defaults to "proteome_index" next to a SQLite database file.
+    :return: Directory path, or None if indexes should only be kept in memory
+    """
+    directory = os.getenv("PROTEOME_INDEX_DIR")
+    if directory:
+        return directory
+
+    database_url = database_url or os.getenv("DATABASE_URL")
+    if not database_url:
+        return None
+    url = make_url(database_url)
+    if url.get_backend_name() != "sqlite" or url.database in (None, "", ":memory:"):
+        return None
+    return os.path.join(
+        os.path.dirname(os.path.abspath(url.database)), "proteome_index"
+    )
+
+
+def proteome_index_path(directory, name):
+    return os.path.join(directory, name)
+
+
+_cache = {}  # process-level cache, name -> ProteomeIndex
+_locks = {}  # name -> lock held while the species' index is loaded or built
+_locks_lock = threading.Lock()
+
+
+def _species_lock(name):
+    with _locks_lock:
+        return _locks.setdefault(name, threading.Lock())
+
+
+def get_proteome_index(session, name: str) -> ProteomeIndex:
+    """
+    Get the proteome index of a species, from the process cache, from disk, or built from its FASTA entry.
+    Indexes built here are persisted for other processes when an index directory is configured.
+    """
+    fasta = session.query(FASTA_Entry.id).filter(FASTA_Entry.name == name).first()
+    if fasta is None:
+        raise ValueError("No fasta entry found for species: {}".format(name))
+
+    # Building one species' index doesn't hold up jobs of other species
+    with _species_lock(name):
+        index = _cache.get(name)
+        if index is not None and index.source_id == fasta.id:
+            return index
+
+        directory = proteome_index_dir()
+        if directory:
+            index = ProteomeIndex.load(proteome_index_path(directory, name))
+
+        if index is None or index.source_id != fasta.id:
+            data = (
+                session.query(FASTA_Entry.data)
+                .filter(FASTA_Entry.id == fasta.id)
+                .scalar()
+            )
+            if data is None:  # ingested with process_fasta.py --index-only
+                raise ValueError("No proteome index found for species: {}".format(name))
+            index = ProteomeIndex.from_protein_dict(name, fasta.id, data)
+            if directory:
+                try:
+                    index.save(proteome_index_path(directory, name))
+                except OSError as e:
+                    logger.warning(f"Could not persist proteome index for {name}: {e}")
+
+        _cache[name] = index
+        return index
@@ -0,0 +1,279 @@
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from prometheus_client import Counter, Histogram
+
+logger = logging.getLogger("uvicorn")
+
+RENDER_TIME = Histogram("render_seconds", "Time spent rendering a PDB file")
+RENDER_FAILED = Counter(
+    "render_failed_count", "Renders that failed, timed out or lost their worker"
+)
+RENDER_WORKER_RESTARTS = Counter(
+    "render_worker_restart_count", "Render workers replaced, by reason", ["reason"]
+)
+
+
+class RenderError(Exception):
+    """
+    Raised when PyMOL fails to render a PDB file.
+    """
+
+
+class RenderTimeout(RenderError):
+    """
+    Raised when a render takes longer than the timeout. The worker is replaced.
+    """
+
+
+class RenderWorkerError(RenderError):
+    """
+    Raised when a render worker exits during a render. The worker is replaced.
+    """
+
+
+class RenderPoolClosed(Exception):
+    """
+    Raised when a render is submitted after the pool was shut down.
+    """
+
+
+def _serve(conn):
+    """
+    Render worker loop: answers (operation, args) requests with ("ok", result) or ("error", message)
+    until it receives None or the pool's end of the pipe is closed.
+    """
+    import rendering  # PyMOL is only imported and launched in the worker
+
+    rendering.launch_pymol()
+    operations = {
+        "ping": os.getpid,
+        "render": rendering.render_3d_from_pdb_str,  # cleans up PyMOL, also on errors
+    }
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        operation, args = request
+        try:
+            conn.send(("ok", operations[operation](*args)))
+        except Exception as e:
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+
+
+class _Worker:
+    def __init__(self, context):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_serve, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.renders = 0
+
+    def request(self, operation, args, timeout):
+        """
+        Send a request and wait for the response
+        :raises RenderTimeout: if there is no response within timeout seconds
+        :raises RenderWorkerError: if the worker exited
+        :raises RenderError: if the operation failed in the worker
+        """
+        try:
+            self.conn.send((operation, args))
+            if not self.conn.poll(timeout):
+                raise RenderTimeout(f"No response within {timeout}s")
+            status, result = self.conn.recv()
+        except (EOFError, OSError):
+            raise RenderWorkerError(
+                f"Render worker exited with code {self.process.exitcode}"
+            )
+        if status == "error":
+            raise RenderError(result)
+        return result
+
+    def stop(self, timeout=5):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout)
+        self.kill()
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class RenderPool:
+    """
+    Pool of long-lived PyMOL worker processes.
+    PyMOL keeps global state, so each worker renders one PDB file at a time and cleans up after it; callers in
+    any thread submit renders concurrently without loading PyMOL themselves. Workers are started on first use,
+    processes that never render don't load PyMOL. Renders that exceed the timeout have their worker killed and
+    replaced, workers are recycled after max_renders renders and idle workers are pinged every health_interval
+    seconds.
+    """
+
+    def __init__(self, workers=2, timeout=120, max_renders=1000, health_interval=60):
+        self.workers = workers
+        self.timeout = timeout
+        self.max_renders = max_renders
+
+        self._context = multiprocessing.get_context("spawn")
+        self._idle = queue.Queue()
+        self._closed = threading.Event()
+        self._lock = threading.Lock()
+        self._started = 0  # workers are started on first use
+
+        # Dispatch threads: one per worker, each takes an idle worker for the render it runs
+        self._dispatch = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="render-worker"
+        )
+        self._monitor = None
+        if health_interval:
+            self._monitor = threading.Thread(
+                target=self._monitor_health,
+                args=(health_interval,),
+                name="render-health",
+                daemon=True,
+            )
+            self._monitor.start()
+
+    @classmethod
+    def from_env(cls, **kwargs):
+        """
+        Create a pool configured by RENDER_WORKERS, RENDER_TIMEOUT and RENDER_WORKER_MAX_RENDERS
+        """
+        options = dict(
+            workers=int(os.getenv("RENDER_WORKERS", 2)),
+            timeout=float(os.getenv("RENDER_TIMEOUT", 120)),
+            max_renders=int(os.getenv("RENDER_WORKER_MAX_RENDERS", 1000)),
+        )
+        options.update(kwargs)
+        return cls(**options)
+
+    def submit(self, pdb_str: str, pdb_name: str):
+        """
+        Queue a render
+        :return: Future of the render, see rendering.render_3d_from_pdb(). Raises RenderError if rendering fails.
+        :raises RenderPoolClosed: if the pool was shut down
+        """
+        if self._closed.is_set():
+            raise RenderPoolClosed()
+        try:
+            return self._dispatch.submit(self._render, pdb_str, pdb_name)
+        except RuntimeError:  # executor shut down in the meantime
+            raise RenderPoolClosed()
+
+    def render(self, pdb_str: str, pdb_name: str) -> dict:
+        """
+        Render a PDB file and wait for the result, see submit()
+        """
+        return self.submit(pdb_str, pdb_name).result()
+
+    def _render(self, pdb_str, pdb_name):
+        worker = self._checkout()
+        started_at = time.time()
+        try:
+            result = worker.request("render", (pdb_str, pdb_name), self.timeout)
+        except (RenderTimeout, RenderWorkerError) as e:
+            RENDER_FAILED.inc()
+            reason = "timeout" if isinstance(e, RenderTimeout) else "exited"
+            logger.warning(f"Replacing render worker rendering {pdb_name}: {e}")
+            self._replace(worker, reason)
+            raise
+        except RenderError:
+            RENDER_FAILED.inc()
+            self._checkin(worker)
+            raise
+        finally:
+            RENDER_TIME.observe(time.time() - started_at)
+        self._checkin(worker)
+        return result
+
+    def _checkout(self):
+        while True:
+            if self._closed.is_set():
+                raise RenderPoolClosed()
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    if self._started < self.workers:
+                        self._started += 1
+                        return _Worker(self._context)
+                try:
+                    worker = self._idle.get(timeout=1)
+                except queue.Empty:
+                    continue
+            if worker.process.is_alive():
+                return worker
+            self._replace(worker, "exited")
+
+    def _checkin(self, worker):
+        worker.renders += 1
+        if self._closed.is_set():
+            worker.stop()
+        elif self.max_renders and worker.renders >= self.max_renders:
+            worker.stop()
+            self._replace(worker, "recycled")
+        else:
+            self._idle.put(worker)
+
+    def _replace(self, worker, reason):
+        worker.kill()
+        RENDER_WORKER_RESTARTS.labels(reason).inc()
+        if not self._closed.is_set():
+            self._idle.put(_Worker(self._context))
+
+    def health_check(self, timeout=10) -> int:
+        """
+        Ping the idle workers, replacing those that don't answer. Busy workers are covered by the render timeout.
+        :return: Number of workers replaced
+        """
+        idle = []
+        while True:
+            try:
+                idle.append(self._idle.get_nowait())
+            except queue.Empty:
+                break
+        replaced = 0
+        for worker in idle:
+            try:
+                worker.request("ping", (), timeout)
+            except RenderError as e:
+                logger.warning(f"Replacing unhealthy render worker: {e}")
+                self._replace(worker, "unhealthy")
+                replaced += 1
+                continue
+            if self._closed.is_set():
+                worker.stop()
+            else:
+                self._idle.put(worker)
+        return replaced
+
+    def _monitor_health(self, interval):
+        while not self._closed.wait(interval):
+            self.health_check()
+
+    def shutdown(self, wait=True):
+        """
+        Stop accepting renders. With wait=True, finish the queued renders first. Stops the workers.
+        """
+        if wait:
+            self._dispatch.shutdown(wait=True)
+        self._closed.set()
+        self._dispatch.shutdown(wait=wait, cancel_futures=not wait)
+        while True:
+            try:
+                self._idle.get_nowait().stop()
+            except queue.Empty:
+                break
@@ -2,18 +2,14 @@ import os
 
 import numpy as np
 import pymol  # must be installed on system (see README.md)
-import re
 import time
 import sys
 
-from collections import defaultdict
-
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
 from database import Base, Job, SequenceCoverageResult, ProteinStructure
 from helpers import (
-    pymol_obj_extract,
     pymol_obj_dict_to_str,
     pymol_view_dict_to_str,
     color_dict_to_str,
@@ -21,42 +17,72 @@ from helpers import (
 )
 from models import ProteinStructureModel
 
+# Version of the PDB rendering output, bump it whenever a change affects what is stored for a structure,
+# so that generate/process_pdb.py re-renders files that were rendered by an older version
+PIPELINE_VERSION = 3
+
+PDB_LINE_LENGTH = 80
+PDB_ATOM_DTYPE = np.dtype(
+    [
+        ("serial", np.int32),
+        ("name", "U4"),
+        ("resn", "U3"),
+        ("chain", "U1"),
+        ("resi", np.int32),
+        ("coords", np.float64, 3),
+        ("element", "U2"),
+        ("segment", np.int32),
+    ]
+)
+
 default_covered = [255, 62, 62]
 default_non_covered = [221, 221, 221]
 
 
-def setup_pymol_from_file(pdb_file, pdb_name):
+def launch_pymol():
+    pymol.pymol_argv = [
+        "pymol",
+        "-qc",
+    ]  # pymol launching: quiet (-q), without GUI (-c)
+    pymol.finish_launching()
+
+
+def show_pymol_object():
+    # Show only the cartoon, with the settings the render output depends on
+    pymol.cmd.disable("all")
+    pymol.cmd.enable()
+    pymol.cmd.hide("all")
+    pymol.cmd.show("cartoon")
+    pymol.cmd.set("ray_opaque_background", 0)
+    pymol.cmd.bg_color("black")
+    pymol.cmd.set(
+        "pse_export_version", 1.74
+    )  # set the version of the PyMOL session file to 1.74 (needed for pymol 2.0)
+    pymol.cmd.set(
+        "pdb_retain_ids", 1
+    )  # keep the original residue ids, not sure if this is necessary
+
+
+def load_pymol_from_file(pdb_file, pdb_name):
     # Load the PDB file
     try:
         original_stdout = sys.stdout
         null_device = open(os.devnull, "w")
         sys.stdout = null_device
 
-        pymol.pymol_argv = [
-            "pymol",
-            "-qc",
-        ]  # pymol launching: quiet (-q), without GUI (-c)
-        pymol.finish_launching()
+        launch_pymol()
         pymol.cmd.load(pdb_file, pdb_name)
-        pymol.cmd.disable("all")
-        pymol.cmd.enable()
-        pymol.cmd.hide("all")
-        pymol.cmd.show("cartoon")
-        pymol.cmd.set("ray_opaque_background", 0)
-        pymol.cmd.bg_color("black")
-        pymol.cmd.set(
-            "pse_export_version", 1.74
-        )  # set the version of the PyMOL session file to 1.74 (needed for pymol 2.0)
-        pymol.cmd.set(
-            "pdb_retain_ids", 1
-        )  # keep the original residue ids, not sure if this is necessary
-        session = pymol.cmd.get_session(pdb_name, partial=0)  # get PDB session
+        show_pymol_object()
 
         sys.stdout = original_stdout
         null_device.close()
     except pymol.CmdException as e:
         print(f"A pymol error occurred: {e}")
-    return session
+
+
+def setup_pymol_from_file(pdb_file, pdb_name):
+    load_pymol_from_file(pdb_file, pdb_name)
+    return pymol.cmd.get_session(pdb_name, partial=0)  # get PDB session
 
 
 def get_pdb_str_from_file(pdb_file):
@@ -65,122 +91,181 @@ def get_pdb_str_from_file(pdb_file):
     return pdb_str
 
 
-def setup_pymol_from_string(pdb_str, pdb_name) -> dict:
+def load_pymol_from_string(pdb_str, pdb_name):
     # Load the PDB file from string
     try:
-        pymol.pymol_argv = [
-            "pymol",
-            "-qc",
-        ]  # pymol launching: quiet (-q), without GUI (-c)
-        pymol.finish_launching()
+        launch_pymol()
         pymol.cmd.read_pdbstr(pdb_str, pdb_name)
-        pymol.cmd.disable("all")
-        pymol.cmd.enable()
-        pymol.cmd.hide("all")
-        pymol.cmd.show("cartoon")
-        pymol.cmd.set("ray_opaque_background", 0)
-        pymol.cmd.bg_color("black")
-        pymol.cmd.set(
-            "pse_export_version", 1.74
-        )  # set the version of the PyMOL session file to 1.74 (needed for pymol 2.0)
-        pymol.cmd.set(
-            "pdb_retain_ids", 1
-        )  # keep the original residue ids, not sure if this is necessary
-        session = pymol.cmd.get_session(pdb_name, partial=0)  # get PDB session
+        show_pymol_object()
     except pymol.CmdException as e:
         print(f"A pymol error occurred: {e}")
-    return session
+
+
+def setup_pymol_from_string(pdb_str, pdb_name) -> dict:
+    load_pymol_from_string(pdb_str, pdb_name)
+    return pymol.cmd.get_session(pdb_name, partial=0)  # get PDB session
 
 
 def clean_pymol():
     pymol.cmd.delete("all")
+    # Reset the view too, get_view() leaves rounding errors in the rotation that would carry over to the next structure
+    pymol.cmd.reset()
     # pymol.cmd.quit()
 
 
-def get_amino_ele_pos_dict(pdb_str) -> dict:
-    # from pdb_str get element pos to amino acid pos
-    pdb_str = pdb_str.split("\nTER")[0].split("\n")
-    amino_ele_pos_dict = defaultdict(list)
-    for line in pdb_str:
-        amino_ele_pos_dict[int(re.search("\d+(?=\s+[+-]?\d+\.)", line).group())].append(
-            int(re.search("\d+", line).group())
-        )
-    amino_ele_pos_dict = {
-        each: sorted(amino_ele_pos_dict[each]) for each in amino_ele_pos_dict
-    }
+def parse_pdb_atoms(pdb_str: str) -> np.ndarray:
+    """
+    Parse the ATOM and HETATM records of a PDB string by their fixed columns, in one pass over all lines
+    :param pdb_str:
+    :return: Structured array of the atoms in file order, see PDB_ATOM_DTYPE.
+    "segment" is the number of TER records before the atom.
+    """
+    lines = np.array(pdb_str.encode().split(b"\n"), dtype=f"S{PDB_LINE_LENGTH}")
+    record = lines.astype("S6")
+    is_atom = (record == b"ATOM  ") | (record == b"HETATM")
+    segment = np.cumsum(record.astype("S3") == b"TER")[is_atom]
+    columns = lines[is_atom].view("S1").reshape(-1, PDB_LINE_LENGTH)
+
+    def field(start, end):
+        return np.ascontiguousarray(columns[:, start:end]).view(f"S{end - start}")[:, 0]
+
+    atoms = np.zeros(len(columns), dtype=PDB_ATOM_DTYPE)
+    atoms["serial"] = field(6, 11).astype(np.int64)
+    atoms["name"] = np.char.strip(field(12, 16).astype("U4"))
+    atoms["resn"] = np.char.strip(field(17, 20).astype("U3"))
+    atoms["chain"] = field(21, 22).astype("U1")
+    atoms["resi"] = field(22, 26).astype(np.int64)
+    for i, (start, end) in enumerate(((30, 38), (38, 46), (46, 54))):
+        atoms["coords"][:, i] = field(start, end).astype(np.float64)
+    atoms["element"] = np.char.strip(field(76, 78).astype("U2"))
+    atoms["segment"] = segment
+    return atoms
+
+
+def get_amino_ele_pos_dict(atoms: np.ndarray) -> dict:
+    """
+    Residue number to atom serials of the first chain, i.e. the atoms before the first TER record
+    :param atoms: see parse_pdb_atoms()
+    :return: {residue number: sorted atom serials}, residues in order of appearance
+    """
+    atoms = atoms[atoms["segment"] == 0]
+    resi, serial = atoms["resi"], atoms["serial"]
+    order = np.lexsort((serial, resi))
+    residues, first = np.unique(resi, return_index=True)
+    groups = np.split(serial[order], np.flatnonzero(np.diff(resi[order])) + 1)
+    amino_ele_pos_dict = dict(zip(residues.tolist(), (g.tolist() for g in groups)))
+    return {each: amino_ele_pos_dict[each] for each in resi[np.sort(first)].tolist()}
 
-    return amino_ele_pos_dict
+
+def get_residue_atom_ranges(amino_ele_pos_dict: dict) -> tuple:
+    """
+    Residue to (first atom, last atom) serial ranges, as two int32 arrays indexed by residue number - 1.
+    Residues without atoms map to (0, 0).
+    :param amino_ele_pos_dict: Residue number (int or str) -> atom serials, as returned by get_amino_ele_pos_dict()
+    :return: (first_atom, last_atom)
+    """
+    residues = {int(residue): atoms for residue, atoms in amino_ele_pos_dict.items()}
+    size = max(residues, default=0)
+    first_atom = np.zeros(size, dtype=np.int32)
+    last_atom = np.zeros(size, dtype=np.int32)
+    for residue, atoms in residues.items():
+        if residue > 0 and atoms:
+            first_atom[residue - 1] = min(atoms)
+            last_atom[residue - 1] = max(atoms)
+    return first_atom, last_atom
 
 
 def get_annotations(
-    sequence_coverage: list, ptms: dict, ptm_annotations: dict, amino_ele_pos_dict
+    sequence_coverage: np.ndarray,
+    ptms: dict,
+    ptm_annotations: dict,
+    residue_first_atom: np.ndarray,
+    residue_last_atom: np.ndarray,
 ) -> dict:
-    # get index of zeros and nonzeros
-    np_cov = np.array(sequence_coverage).astype(np.int32)  # convert to numpy array
-    non_zero_index = np.nonzero(np_cov)[0]
-    zero_index = np.nonzero(np_cov == 0)[0]
-
-    # get index blocks of zeros and nonzeros
-    cov_pos_block = np.split(
-        non_zero_index, np.where(np.diff(non_zero_index) != 1)[0] + 1
-    )
-    non_cov_pos_block = np.split(zero_index, np.where(np.diff(zero_index) != 1)[0] + 1)
-
-    # convert keys of amino_ele_pos_dict to int
-    amino_ele_pos_dict = {int(key): value for key, value in amino_ele_pos_dict.items()}
-
-    # add zeros to amino_ele_pos_dict for amino acids not in pdb_str
-    for kpos in range(len(sequence_coverage)):
-        if kpos + 1 not in amino_ele_pos_dict:
-            amino_ele_pos_dict[kpos + 1] = [0]
-    amino_ele_pos_dict = {
-        each: sorted(amino_ele_pos_dict[each]) for each in amino_ele_pos_dict
-    }
-
-    non_cov = [
-        (amino_ele_pos_dict[each[0] + 1][0], amino_ele_pos_dict[each[-1] + 1][-1])
-        for each in non_cov_pos_block
-    ]
-    cov = [
-        (amino_ele_pos_dict[each[0] + 1][0], amino_ele_pos_dict[each[-1] + 1][-1])
-        for each in cov_pos_block
-    ]
-
-    ptm_color_dict = {}
-
-    if ptms:
-        for ptm in ptms:
-            # color = [int(each) / 256 for each in ptm_annotations[ptm]]  # List of color values
-            ptm_color_dict[ptm] = {}
-            ptm_color_dict[ptm]["color"] = ptm_annotations[ptm]
-
-            ptm_color_dict[ptm]["indices"] = [
-                (amino_ele_pos_dict[idx + 1][0], amino_ele_pos_dict[idx + 1][-1])
-                for idx in ptms[ptm]
-            ]  # List of indices
+    """
+    Map covered and non-covered residue runs and PTM residues to atom serial ranges
+    :param sequence_coverage: Per-residue coverage
+    :param ptms: PTM -> residue indices
+    :param ptm_annotations: PTM -> color
+    :param residue_first_atom: see get_residue_atom_ranges()
+    :param residue_last_atom: see get_residue_atom_ranges()
+    :return: Color dictionary, see helpers.color_dict_to_str()
+    """
+    covered = np.asarray(sequence_coverage) != 0
+    n = len(covered)
+
+    # pad for residues not in the structure
+    first_atom = np.zeros(n, dtype=np.int32)
+    last_atom = np.zeros(n, dtype=np.int32)
+    overlap = min(n, len(residue_first_atom))
+    first_atom[:overlap] = residue_first_atom[:overlap]
+    last_atom[:overlap] = residue_last_atom[:overlap]
+
+    # runs of covered and non-covered residues
+    run_starts = np.flatnonzero(np.diff(covered, prepend=~covered[:1]))
+    run_ends = np.append(run_starts[1:], n)[: len(run_starts)] - 1
+    runs = np.stack((first_atom[run_starts], last_atom[run_ends]), axis=1)
+    run_covered = covered[run_starts]
 
     res = {
-        "covered": {"color": default_covered, "indices": cov},
-        "non_covered": {"color": default_non_covered, "indices": non_cov},
+        "covered": {
+            "color": default_covered,
+            "indices": [tuple(r) for r in runs[run_covered].tolist()],
+        },
+        "non_covered": {
+            "color": default_non_covered,
+            "indices": [tuple(r) for r in runs[~run_covered].tolist()],
+        },
     }
 
-    res.update(ptm_color_dict)
+    if ptms:
+        for ptm in ptms:
+            indices = np.asarray(ptms[ptm], dtype=np.int64)
+            res[ptm] = {
+                "color": ptm_annotations[ptm],
+                "indices": list(
+                    zip(first_atom[indices].tolist(), last_atom[indices].tolist())
+                ),
+            }
 
     return res
 
 
-def get_objs(session: dict, pdb_name: str) -> dict:
-    # get objects from PDB session
-    obj = session["names"][0]
+def get_secondary_structure(pdb_name: str, serials: np.ndarray, ss: str) -> list:
+    """
+    Serials of the atoms PyMOL assigns a secondary structure to, in PyMOL's atom order
+    :param pdb_name:
+    :param serials: Atom serials in PyMOL's atom order, i.e. as written by get_pdbstr()
+    :param ss: "H" (helix) or "S" (sheet)
+    """
+    indices = [index for _, index in pymol.cmd.index(f"{pdb_name} and ss {ss}")]
+    return serials[np.sort(np.array(indices, dtype=np.int64)) - 1].tolist()
 
-    if obj is None:  # PDB not loaded
-        raise Exception("No objects found.")
-    if obj[2] == 0:  # not visible
-        raise Exception("Object not visible.")
-    if obj[1] == 0 and obj[4] == 1 and obj[0] == pdb_name:
-        return pymol_obj_extract(obj)
 
-    raise Exception("Unknown error")
+def get_objs(pdb_name: str, atoms: np.ndarray) -> dict:
+    """
+    Atom serials per representation, the same as helpers.pymol_obj_extract() on the PyMOL session
+    of a structure set up by load_pymol_from_file(), without building the session.
+    Only the cartoon is shown, so every atom is in "ribbon".
+    :param pdb_name:
+    :param atoms: see parse_pdb_atoms(), parsed from PyMOL's get_pdbstr()
+    """
+    if len(atoms) == 0:
+        raise Exception("No atoms found.")
+    ret = {
+        "name": pdb_name,
+        "sphere": [],
+        "trace": [],
+        "ribbon": atoms["serial"].tolist(),
+        "stick": [],
+        "surface": [],
+        "line": [],
+        "cross": [],
+        "smallSphere": [],
+        "helix": get_secondary_structure(pdb_name, atoms["serial"], "H"),
+        "sheet": get_secondary_structure(pdb_name, atoms["serial"], "S"),
+    }
+    return ret
 
 
 def get_view() -> dict:
@@ -217,70 +302,28 @@ def get_view() -> dict:
     return ret
 
 
-def pdb_to_protein_atom_dict(pdb_str: str):
-    protein = defaultdict(dict)
-    atoms = {}
-    lines = pdb_str.split("\n")
-    for line in lines:
-        line = line.lstrip()  # remove leading whitespace
-        record_name = line[:6]
-        if record_name == "ATOM  ":
-            serial = int(line[6:11])
-            atom = line[12:16].strip()
-            alt_loc = line[16:17]
-            if alt_loc not in ["A", " "]:
-                continue
-            resn = line[17:20]
-            chain = line[21:22]
-            resi = int(line[22:27])
-            x = float(line[30:38])
-            y = float(line[38:46])
-            z = float(line[46:54])
-            b = float(line[60:68])
-            elem = line[76:78].strip()
-            if not elem:
-                elem = line[12:14].strip()
-            hetflag = True if line[0] == "H" else False
-            if chain not in protein:
-                protein[chain] = {"residues": []}
-            atoms[serial] = {
-                "resn": resn,
-                "x": x,
-                "y": y,
-                "z": z,
-                "elem": elem,
-                "hetflag": hetflag,
-                "chain": chain,
-                "resi": resi,
-                "serial": serial,
-                "atom": atom,
-                "bonds": [],
-                "ss": "c",
-                "color": 0xFFFFFF,
-                "b": b,
-            }
-
-    return {"atoms": atoms, "protein": protein}
-
-
-def render_3d_from_pdb(pdb_file: str, pdb_name: str) -> dict:
+def render_loaded_pdb(pdb_name: str) -> dict:
     """
-    Generate GLmol string for 3D visualization of protein coverage
+    Generate GLmol string for 3D visualization of protein coverage from a structure loaded into PyMOL.
+    PyMOL is only used for loading, secondary structure and the view, the atoms are parsed with NumPy.
+    Cleans up PyMOL afterwards, also if rendering fails.
     """
-    pymol_session = setup_pymol_from_file(pdb_file, pdb_name)  # setup pymol + load pdb
-    pdb_str = pymol.cmd.get_pdbstr(pdb_name)  # get pdb string
-
-    objs = get_objs(pymol_session, pdb_name)
+    try:
+        pdb_str = pymol.cmd.get_pdbstr(pdb_name)  # get pdb string
+        if pdb_str is None:  # PDB not loaded
+            raise Exception("No objects found.")
 
-    view = get_view()
+        atoms = parse_pdb_atoms(pdb_str)
 
-    amino_ele_pos = get_amino_ele_pos_dict(pdb_str)
+        objs = get_objs(pdb_name, atoms)
 
-    # annotations = get_annotations(sequence_coverage, ptms, ptm_annotations, amino_ele_pos)
+        view = get_view()
 
-    # test = pdb_to_protein_atom_dict(pdb_str)
+        amino_ele_pos = get_amino_ele_pos_dict(atoms)
 
-    clean_pymol()  # clean up pymol session
+        # annotations = get_annotations(sequence_coverage, ptms, ptm_annotations, amino_ele_pos)
+    finally:
+        clean_pymol()  # clean up pymol session
 
     return {
         "objs": objs,
@@ -291,11 +334,36 @@ def render_3d_from_pdb(pdb_file: str, pdb_name: str) -> dict:
     }
 
 
-def get_db_model_from_pdb(pdb_file, pdb_name, protein_id, species) -> ProteinStructure:
-    ret = render_3d_from_pdb(pdb_file, pdb_name)
+def render_3d_from_pdb(pdb_file: str, pdb_name: str) -> dict:
+    load_pymol_from_file(pdb_file, pdb_name)  # setup pymol + load pdb
+    return render_loaded_pdb(pdb_name)
+
+
+def render_3d_from_pdb_str(pdb_str: str, pdb_name: str) -> dict:
+    load_pymol_from_string(pdb_str, pdb_name)
+    return render_loaded_pdb(pdb_name)
+
+
+def get_db_model_from_render(ret, pdb_name, protein_id, species) -> ProteinStructure:
+    """
+    Build the ProteinStructure of a rendered PDB file
+    :param ret: see render_3d_from_pdb()
+    """
     protein_model = ProteinStructureModel.from_dict(ret)
     protein_model.protein_id = protein_id
     protein_model.pdb_id = pdb_name.split(".")[0]
     protein_model.id = calc_hash_of_dict(ret)
     protein_model.species = species
-    return ProteinStructure.from_model(protein_model)
\ No newline at end of file
+    # Render strings don't depend on the job, build them once here
+    protein_model.objs_str = pymol_obj_dict_to_str(ret["objs"])
+    protein_model.view_str = pymol_view_dict_to_str(ret["view"])
+    (
+        protein_model.residue_first_atom,
+        protein_model.residue_last_atom,
+    ) = get_residue_atom_ranges(ret["amino_ele_pos"])
+    return ProteinStructure.from_model(protein_model)
+
+
+def get_db_model_from_pdb(pdb_file, pdb_name, protein_id, species) -> ProteinStructure:
+    ret = render_3d_from_pdb(pdb_file, pdb_name)
+    return get_db_model_from_render(ret, pdb_name, protein_id, species)
@@ -0,0 +1,140 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from prometheus_client import Counter, Gauge, Histogram
+
+logger = logging.getLogger("uvicorn")
+
+JOB_QUEUE_DEPTH = Gauge("job_queue_depth", "Number of jobs waiting for a worker")
+JOB_RUNNING = Gauge("job_running", "Number of jobs currently running")
+JOB_REJECTED = Counter("job_rejected_count", "Jobs rejected because the queue was full")
+JOB_WAIT_TIME = Histogram(
+    "job_wait_seconds", "Time jobs spent in the queue before starting"
+)
+JOB_RUN_TIME = Histogram("job_run_seconds", "Time jobs spent running")
+
+
+class SchedulerFull(Exception):
+    """
+    Raised when a job is submitted while the queue is at capacity.
+    """
+
+
+class SchedulerClosed(Exception):
+    """
+    Raised when a job is submitted after the scheduler was shut down.
+    """
+
+
+class JobScheduler:
+    """
+    Bounded job scheduler.
+    Runs target(*args) on a fixed pool of workers, either threads or processes ("mode").
+    At most max_workers jobs run at once and at most max_queue more wait; further submissions raise SchedulerFull.
+    In process mode, target and its arguments must be picklable.
+    """
+
+    def __init__(self, target, max_workers=2, max_queue=32, mode="thread"):
+        if mode not in ("thread", "process"):
+            raise ValueError(f"Unknown scheduler mode: {mode}")
+        self.target = target
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.mode = mode
+
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._closed = False
+
+        # Dispatch threads: run the job themselves, or hand it to the process pool and wait for it.
+        # Either way, a job leaves the queue exactly when a dispatch thread picks it up.
+        self._dispatch = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="job-worker"
+        )
+        self._processes = (
+            ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            if mode == "process"
+            else None
+        )
+
+    @classmethod
+    def from_env(cls, target):
+        """
+        Create a scheduler configured by JOB_WORKERS, JOB_QUEUE_SIZE and JOB_EXECUTOR (thread or process)
+        """
+        return cls(
+            target,
+            max_workers=int(os.getenv("JOB_WORKERS", 2)),
+            max_queue=int(os.getenv("JOB_QUEUE_SIZE", 32)),
+            mode=os.getenv("JOB_EXECUTOR", "thread"),
+        )
+
+    @property
+    def queued(self):
+        return self._queued
+
+    def is_full(self):
+        return self._queued >= self.max_queue
+
+    def submit(self, *args):
+        """
+        Queue a job
+        :return: Future of the job
+        :raises SchedulerFull: if the queue is at capacity
+        :raises SchedulerClosed: if the scheduler was shut down
+        """
+        if self._closed:
+            raise SchedulerClosed()
+        if not self._slots.acquire(blocking=False):
+            JOB_REJECTED.inc()
+            raise SchedulerFull()
+
+        with self._lock:
+            self._queued += 1
+        JOB_QUEUE_DEPTH.inc()
+
+        try:
+            return self._dispatch.submit(self._run, time.time(), args)
+        except RuntimeError:  # executor shut down in the meantime
+            self._dequeue()
+            self._slots.release()
+            raise SchedulerClosed()
+
+    def _dequeue(self):
+        with self._lock:
+            self._queued -= 1
+        JOB_QUEUE_DEPTH.dec()
+
+    def _run(self, submitted_at, args):
+        self._dequeue()
+        started_at = time.time()
+        JOB_WAIT_TIME.observe(started_at - submitted_at)
+        JOB_RUNNING.inc()
+        try:
+            if self._processes is not None:
+                return self._processes.submit(self.target, *args).result()
+            return self.target(*args)
+        except Exception:
+            logger.exception(f"Job {args} failed")
+            raise
+        finally:
+            JOB_RUN_TIME.observe(time.time() - started_at)
+            JOB_RUNNING.dec()
+            self._slots.release()
+
+    def shutdown(self, wait=True):
+        """
+        Stop accepting jobs. With wait=True, drain the queue and wait for running jobs to finish.
+        """
+        self._closed = True
+        self._dispatch.shutdown(wait=wait)
+        if self._processes is not None:
+            self._processes.shutdown(wait=wait)
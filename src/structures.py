@@ -0,0 +1,149 @@
+import threading
+from collections import defaultdict
+from hashlib import blake2b
+
+from sqlalchemy import delete, select, update
+from sqlalchemy.exc import IntegrityError
+
+from database import (
+    ProteinStructure,
+    StructureSource,
+    StructureVersion,
+    insert_ignoring_duplicates,
+    upsert,
+)
+
+_cache = {}  # process-level cache, species -> (version, frozenset of protein ids)
+_cache_lock = threading.Lock()
+
+
+def get_structure_version(session, species: str) -> int:
+    version = session.scalar(
+        select(StructureVersion.version).where(StructureVersion.species == species)
+    )
+    return version or 0
+
+
+def bump_structure_version(session, species: str):
+    """
+    Mark the structures of a species as changed, so that processes reload their structure index.
+    Commits the session.
+    :param session:
+    :param species:
+    """
+    result = session.execute(
+        update(StructureVersion)
+        .where(StructureVersion.species == species)
+        .values(version=StructureVersion.version + 1)
+    )
+    if result.rowcount == 0:
+        try:
+            session.add(StructureVersion(species=species, version=1))
+            session.commit()
+            return
+        except IntegrityError:  # created by another process in the meantime
+            session.rollback()
+            return bump_structure_version(session, species)
+    session.commit()
+
+
+def source_hash(data: bytes) -> str:
+    """
+    Hash of a file's content, to recognize files that were already ingested or uploaded
+    """
+    return blake2b(data, digest_size=32).hexdigest()
+
+
+def source_file_hash(path: str) -> str:
+    """
+    source_hash() of a file, read in chunks
+    """
+    h = blake2b(digest_size=32)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def get_structure_sources(session, species: str, pipeline_version: int):
+    """
+    Source files of a species' structures that were rendered by a pipeline version
+    :return: List of StructureSource rows
+    """
+    return session.scalars(
+        select(StructureSource).where(
+            StructureSource.species == species,
+            StructureSource.pipeline_version == pipeline_version,
+        )
+    ).all()
+
+
+def save_structures(session, structures, sources=()):
+    """
+    Store protein structures in one transaction, skipping structures that are already stored.
+    Existing ids are found with a single IN query, new structures are bulk inserted. Commits the session.
+    :param session:
+    :param structures: List of ProteinStructure column dictionaries
+    :param sources: List of StructureSource column dictionaries of the files the structures were rendered from,
+    replacing the stored rows of the same file names. Structures rendered from the same files by older pipeline
+    versions are replaced.
+    :return: Ids of the inserted structures
+    """
+    ids = {structure["id"] for structure in structures}
+    stored = set(
+        session.scalars(select(ProteinStructure.id).where(ProteinStructure.id.in_(ids)))
+    )
+
+    new = []
+    for structure in structures:
+        if structure["id"] not in stored:
+            stored.add(structure["id"])  # identical files within the batch
+            new.append(structure)
+    if new:
+        insert_ignoring_duplicates(session, ProteinStructure.__table__, new)
+
+    groups = defaultdict(list)
+    for source in sources:
+        groups[(source["species"], source["pipeline_version"])].append(source)
+    for (species, pipeline_version), group in groups.items():
+        outdated = select(StructureSource.structure_id).where(
+            StructureSource.species == species,
+            StructureSource.file_hash.in_([source["file_hash"] for source in group]),
+            StructureSource.pipeline_version < pipeline_version,
+        )
+        session.execute(
+            delete(ProteinStructure).where(
+                ProteinStructure.id.in_(outdated),
+                ProteinStructure.id.not_in(
+                    [source["structure_id"] for source in group]
+                ),
+            )
+        )
+    if sources:
+        upsert(session, StructureSource.__table__, list(sources))
+
+    session.commit()
+    return [structure["id"] for structure in new]
+
+
+def get_structure_ids(session, species: str) -> frozenset:
+    """
+    Set of protein ids with a structure in the database for a species.
+    Loaded once per process and reloaded when the species' structure version changes.
+    """
+    version = get_structure_version(session, species)
+
+    with _cache_lock:
+        cached = _cache.get(species)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        protein_ids = frozenset(
+            session.scalars(
+                select(ProteinStructure.protein_id)
+                .where(ProteinStructure.species == species)
+                .distinct()
+            )
+        )
+        _cache[species] = (version, protein_ids)
+        return protein_ids
@@ -0,0 +1,118 @@
+import asyncio
+import threading
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from access_log import AccessLogSink, rollup_access
+from database import Access, AccessDaily, Base
+
+
+def make_session_factory(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'scv.db'}")
+    Base.metadata.create_all(engine)
+    return sessionmaker(bind=engine)
+
+
+def test_sink_writes_batches_and_flushes_on_stop(tmp_path):
+    session_factory = make_session_factory(tmp_path)
+    sink = AccessLogSink(session_factory, flush_interval=60, batch_size=3)
+
+    async def serve():
+        sink.start()
+        for i in range(3):  # reaching batch_size wakes the writer
+            sink.add("127.0.0.1", "/job_details", "POST", f"job-{i}")
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if len(sink) == 0:
+                break
+        assert len(sink) == 0
+
+        sink.add("127.0.0.1", "/test", "POST")  # below batch_size, written on stop
+        await sink.stop()
+
+    asyncio.run(serve())
+
+    with session_factory() as session:
+        assert session.query(Access).count() == 4
+        assert session.query(Access).filter(Access.job_number.is_(None)).count() == 1
+
+
+def test_sink_keeps_records_when_write_fails(tmp_path):
+    # No tables, so writing fails
+    sink = AccessLogSink(
+        sessionmaker(bind=create_engine(f"sqlite:///{tmp_path / 'empty.db'}"))
+    )
+    sink.add("127.0.0.1", "/test", "POST")
+    assert sink.flush() == 0
+    assert len(sink) == 1
+
+
+def test_rollup_access(tmp_path):
+    session_factory = make_session_factory(tmp_path)
+    old = datetime(2024, 1, 2, 12, 0)
+    with session_factory() as session:
+        session.add_all(
+            [
+                Access(ip="a", path="/job", method="POST", timestamp=old),
+                Access(ip="b", path="/job", method="POST", timestamp=old),
+                Access(ip="c", path="/test", method="POST", timestamp=old),
+                Access(ip="d", path="/job", method="POST", timestamp=datetime.utcnow()),
+            ]
+        )
+        session.commit()
+
+        cutoff = datetime.utcnow() - timedelta(days=30)
+        assert rollup_access(session, cutoff) == 3
+        session.add(Access(ip="e", path="/job", method="POST", timestamp=old))
+        session.commit()
+        assert rollup_access(session, cutoff) == 1
+
+        assert session.query(Access).count() == 1
+        daily = session.get(AccessDaily, (date(2024, 1, 2), "/job", "POST"))
+        assert daily.count == 3
+        assert session.get(AccessDaily, (date(2024, 1, 2), "/test", "POST")).count == 1
+
+
+def test_concurrent_rollups_count_each_record_once(tmp_path):
+    session_factory = make_session_factory(tmp_path)
+    old = datetime(2024, 1, 2, 12, 0)
+    with session_factory() as session:
+        session.add(
+            AccessDaily(day=date(2024, 1, 2), path="/job", method="POST", count=5)
+        )
+        session.add_all(
+            [
+                Access(ip="a", path=path, method="POST", timestamp=old)
+                for path in ["/job", "/test"] * 200
+            ]
+        )
+        session.commit()
+
+    cutoff = datetime.utcnow() - timedelta(days=30)
+    barrier = threading.Barrier(4)
+    rolled, errors = [], []
+
+    def rollup():
+        barrier.wait()
+        try:
+            with session_factory() as session:
+                rolled.append(rollup_access(session, cutoff))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=rollup) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert sum(rolled) == 400
+    with session_factory() as session:
+        assert session.query(Access).count() == 0
+        assert session.get(AccessDaily, (date(2024, 1, 2), "/job", "POST")).count == 205
+        assert (
+            session.get(AccessDaily, (date(2024, 1, 2), "/test", "POST")).count == 200
+        )
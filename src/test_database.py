@@ -0,0 +1,26 @@
+import json
+import numpy as np
+
+from database import CompressedArray
+
+
+def test_compressed_array_round_trip():
+    coverage = np.array([0, 0, 3, 3, 300, 0], dtype=np.int64)
+    decoded = CompressedArray.decode(CompressedArray.encode(coverage))
+    assert isinstance(decoded, np.ndarray)
+    assert decoded.dtype == np.uint16  # narrowed to the smallest dtype
+    assert decoded.tolist() == coverage.tolist()
+
+    ptms = {"S[79.9663]": [4, 17], "phospho": np.array([], dtype=np.int64)}
+    decoded = CompressedArray.decode(CompressedArray.encode(ptms))
+    assert list(decoded) == ["S[79.9663]", "phospho"]
+    assert decoded["S[79.9663]"].tolist() == [4, 17]
+    assert decoded["phospho"].tolist() == []
+
+
+def test_compressed_array_reads_legacy_json():
+    assert CompressedArray.decode(json.dumps([0, 1, 2])).tolist() == [0, 1, 2]
+    assert CompressedArray.decode(b"[5]").tolist() == [5]
+    assert CompressedArray.decode({"phospho": [1]})["phospho"].tolist() == [1]
+    assert not CompressedArray.is_encoded(b"[5]")
+    assert CompressedArray.is_encoded(CompressedArray.encode([5]))
@@ -0,0 +1,40 @@
+from sqlalchemy import text
+
+from db_engine import create_db_engine
+
+
+def test_sqlite_pragmas(tmp_path, monkeypatch):
+    monkeypatch.setenv("SQLITE_BUSY_TIMEOUT_MS", "1234")
+    engine = create_db_engine(f"sqlite:///{tmp_path / 'scv.db'}")
+    with engine.connect() as conn:
+        assert conn.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        assert conn.execute(text("PRAGMA busy_timeout")).scalar() == 1234
+        assert conn.execute(text("PRAGMA synchronous")).scalar() == 1  # NORMAL
+        assert conn.execute(text("PRAGMA mmap_size")).scalar() > 0
+
+
+def test_writer_not_blocked_by_reader(tmp_path, monkeypatch):
+    monkeypatch.setenv("SQLITE_BUSY_TIMEOUT_MS", "100")
+    engine = create_db_engine(f"sqlite:///{tmp_path / 'scv.db'}")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE t (x INTEGER)"))
+        conn.execute(text("INSERT INTO t VALUES (1), (2)"))
+
+    with engine.connect() as reader:
+        rows = reader.execute(text("SELECT x FROM t"))
+        assert rows.fetchone() == (1,)  # read in progress
+
+        # Without WAL the commit would fail with "database is locked" while the read is in progress
+        with engine.begin() as writer:
+            writer.execute(text("INSERT INTO t VALUES (3)"))
+
+        assert rows.fetchall() == [(2,)]  # the reader keeps its snapshot
+
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT COUNT(*) FROM t")).scalar() == 3
+
+
+def test_memory_database():
+    engine = create_db_engine("sqlite://")
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT 1")).scalar() == 1
@@ -0,0 +1,57 @@
+import gzip
+
+import pytest
+import zstd
+
+import fasta
+from fasta import fasta_records, parse_fasta_header
+
+FASTA = (
+    ">sp|P1|ONE_HUMAN First protein OS=Homo sapiens OX=9606 GN=G1 PE=1 SV=1\n"
+    "PEPT\n"
+    "IDEK\n"
+    ">tr|P2|TWO_HUMAN Second protein OS=Homo sapiens OX=9606 PE=4 SV=1\n"
+    "AAAK\n"
+    ">P3 Plain header\n"
+    "\n"
+)
+RECORDS = [
+    ("P1", "PEPTIDEK", "G1", "First protein"),
+    ("P2", "AAAK", "N/A", "Second protein"),
+    ("P3", "", "N/A", "Plain header"),
+]
+
+
+def test_parse_fasta_header():
+    assert parse_fasta_header("sp|P1|ONE_HUMAN First protein OS=Homo GN=G1") == (
+        "P1",
+        "G1",
+        "First protein",
+    )
+    assert parse_fasta_header("P3") == ("P3", "N/A", "")
+
+
+@pytest.mark.parametrize(
+    "compress",
+    [lambda b: b, gzip.compress, zstd.compress],
+    ids=["plain", "gzip", "zstd"],
+)
+def test_fasta_records(tmp_path, compress):
+    path = tmp_path / "test.fasta"
+    path.write_bytes(compress(FASTA.encode()))
+    assert list(fasta_records(str(path), chunk_size=16)) == RECORDS
+
+
+def test_fasta_records_without_zstandard(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        fasta, "zstandard", None
+    )  # falls back to in-memory decompression
+    path = tmp_path / "test.fasta.zst"
+    path.write_bytes(zstd.compress(FASTA.encode()))
+    assert list(fasta_records(str(path))) == RECORDS
+
+
+def test_fasta_records_line_endings(tmp_path):
+    path = tmp_path / "test.fasta"
+    path.write_bytes(("Preamble\n" + FASTA).replace("\n", "\r\n").encode())
+    assert list(fasta_records(str(path))) == RECORDS
@@ -1,6 +1,10 @@
+import json
 import uuid
+import zstd
 from fastapi.testclient import TestClient
-from main import app
+import main
+from main import app, SessionLocal
+from database import Job, ProteinStructure, SequenceCoverageResult, UploadedPDB
 
 client = TestClient(app)
 
@@ -101,3 +105,295 @@ def test_get_invalid_protein_list():
     )
     assert response.status_code == 404
     assert response.json() == {"detail": "Job not found"}
+
+
+def test_get_invalid_job_status():
+    response = client.post(
+        "/job_status", data={"job_number": "00000000-0000-0000-0000-000000000000"}
+    )
+    assert response.status_code == 404
+    assert response.json() == {"detail": "Job not found"}
+    response = client.get(
+        "/job_status/stream",
+        params={"job_number": "00000000-0000-0000-0000-000000000000"},
+    )
+    assert response.status_code == 404
+
+
+def add_structure_job():
+    """
+    Store a job with one covered protein that has a structure
+    :return: (job_number, protein_id, structure_id)
+    """
+    protein_id = f"TEST-{uuid.uuid4()}"
+    structure_id = str(uuid.uuid4())
+    with SessionLocal() as session:
+        job = Job(species="human", ptm_annotations={}, background_color=0)
+        result = SequenceCoverageResult(
+            id=str(uuid.uuid4()),
+            protein_id=protein_id,
+            sequence="PEPT",
+            sequence_coverage=[0, 1, 1, 0],
+            ptms={},
+        )
+        result.jobs.append(job)
+        session.add_all(
+            [
+                job,
+                result,
+                ProteinStructure(
+                    id=structure_id,
+                    protein_id=protein_id,
+                    species="human",
+                    amino_ele_pos={"1": [1, 2], "2": [3], "3": [4, 5], "4": [6]},
+                    pdb_str="ATOM",
+                    objs_str="cartoon:1-6\n",
+                    view_str="view:0\n",
+                ),  # objs and view are not needed
+            ]
+        )
+        session.commit()
+        return str(job.job_number), protein_id, structure_id
+
+
+def test_protein_structure_uses_cached_render_strings():
+    job_number, protein_id, _ = add_structure_job()
+
+    response = client.post(
+        "/protein-structure", data={"job_number": job_number, "protein_id": protein_id}
+    )
+    assert response.status_code == 200
+    ret = response.json()["ret"]
+    assert ret.startswith("cartoon:1-6\n")
+    assert "view:0\nbgcolor:0" in ret
+
+
+def test_protein_structure_etag():
+    job_number, protein_id, structure_id = add_structure_job()
+    params = {"job_number": job_number, "protein_id": protein_id}
+
+    response = client.get("/protein-structure", params=params)
+    assert response.status_code == 200
+    assert response.json()["pdb_url"] == f"/structure/{structure_id}/pdb"
+    assert response.json()["ret"].startswith("cartoon:1-6\n")
+    etag = response.headers["etag"]
+
+    for if_none_match in [etag, f"W/{etag}", f'"other", {etag}']:
+        response = client.get(
+            "/protein-structure",
+            params=params,
+            headers={"If-None-Match": if_none_match},
+        )
+        assert response.status_code == 304
+        assert response.headers["etag"] == etag
+
+    response = client.get(
+        "/protein-structure",
+        params={**params, "protein_id": "unknown"},
+        headers={"If-None-Match": etag},
+    )
+    assert response.status_code == 404
+
+
+def test_protein_structures_batch():
+    job_number, protein_id, structure_id = add_structure_job()
+
+    single = client.get(
+        "/protein-structure",
+        params={"job_number": job_number, "protein_id": protein_id},
+    ).json()
+    response = client.get(
+        "/protein-structures",
+        params={"job_number": job_number, "protein_id": [protein_id, "unknown"]},
+    )
+    assert response.status_code == 200
+    assert response.json() == {protein_id: single}
+    assert single["structure_id"] == structure_id
+
+    response = client.get(
+        "/protein-structures",
+        params={"job_number": str(uuid.uuid4()), "protein_id": [protein_id]},
+    )
+    assert response.status_code == 404
+    response = client.get(
+        "/protein-structures",
+        params={"job_number": job_number, "protein_id": ["P"] * 51},
+    )
+    assert response.status_code == 400
+
+
+def test_structure_pdb_is_immutable():
+    _, _, structure_id = add_structure_job()
+
+    response = client.get(
+        f"/structure/{structure_id}/pdb", headers={"Accept-Encoding": "identity"}
+    )
+    assert response.status_code == 200
+    assert response.text == "ATOM"
+    assert "immutable" in response.headers["cache-control"]
+    assert response.headers["etag"] == f'"{structure_id}"'
+
+    # The ETag is derived from the id, so this is answered without looking the structure up
+    response = client.get(
+        "/structure/unknown/pdb",
+        headers={"Accept-Encoding": "identity", "If-None-Match": '"unknown"'},
+    )
+    assert response.status_code == 304
+    assert client.get("/structure/unknown/pdb").status_code == 404
+
+
+def test_structure_pdb_content_encoding():
+    _, _, structure_id = add_structure_job()
+
+    # Stored zstd bytes are passed through
+    response = client.get(
+        f"/structure/{structure_id}/pdb", headers={"Accept-Encoding": "zstd, gzip"}
+    )
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "zstd"
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert zstd.decompress(response.content) == b"ATOM"
+    zstd_etag = response.headers["etag"]
+
+    # gzip for clients without zstd support, the client decodes it
+    for _ in range(2):  # transcoded, then cached
+        response = client.get(
+            f"/structure/{structure_id}/pdb",
+            headers={"Accept-Encoding": "gzip, zstd;q=0"},
+        )
+        assert response.headers["content-encoding"] == "gzip"
+        assert response.text == "ATOM"
+        assert response.headers["etag"] != zstd_etag
+
+    response = client.get(
+        f"/structure/{structure_id}/pdb",
+        headers={"Accept-Encoding": "zstd", "If-None-Match": zstd_etag},
+    )
+    assert response.status_code == 304
+
+
+def test_protein_structure_prefers_rendered_upload():
+    job_number, protein_id, structure_id = add_structure_job()
+    upload_structure_id = str(uuid.uuid4())
+    with SessionLocal() as session:
+        session.add(
+            ProteinStructure(
+                id=upload_structure_id,
+                protein_id=protein_id,
+                species="upload",
+                amino_ele_pos={"1": [1], "2": [2], "3": [3], "4": [4]},
+                pdb_str="ATOM",
+                objs_str="cartoon:1-4\n",
+                view_str="view:0\n",
+            )
+        )
+        upload = UploadedPDB(
+            job_number=uuid.UUID(job_number),
+            pdb_id=protein_id,
+            render_status="rendering",
+        )
+        session.add(upload)
+        session.commit()
+        upload_id = upload.id
+    params = {"job_number": job_number, "protein_id": protein_id}
+
+    structure = client.post("/job_status", data={"job_number": job_number}).json()[
+        "structure"
+    ]
+    assert structure["status"] == "rendering"
+    assert structure["pdb_url"] is None
+    assert client.get("/protein-structure", params=params).json()["structure_id"] == (
+        structure_id
+    )
+
+    with SessionLocal() as session:
+        upload = session.get(UploadedPDB, upload_id)
+        upload.render_status = "done"
+        upload.structure_id = upload_structure_id
+        session.commit()
+
+    structure = client.post("/job_status", data={"job_number": job_number}).json()[
+        "structure"
+    ]
+    assert structure == {
+        "protein_id": protein_id,
+        "status": "done",
+        "error": None,
+        "structure_id": upload_structure_id,
+        "pdb_url": f"/structure/{upload_structure_id}/pdb",
+    }
+    response = client.get("/protein-structure", params=params).json()
+    assert response["structure_id"] == upload_structure_id
+    assert response["ret"].startswith("cartoon:1-4\n")
+    structures = client.get("/protein-structures", params=params).json()
+    assert structures == {protein_id: response}
+
+
+def test_protein_structures_batch_uses_deduplicated_upload():
+    job_number, protein_id, _ = add_structure_job()
+    # Rendered from an upload of the same content under another accession
+    upload_structure_id = str(uuid.uuid4())
+    with SessionLocal() as session:
+        session.add(
+            ProteinStructure(
+                id=upload_structure_id,
+                protein_id="OTHER",
+                species="upload",
+                amino_ele_pos={"1": [1], "2": [2], "3": [3], "4": [4]},
+                pdb_str="ATOM",
+                objs_str="cartoon:1-4\n",
+                view_str="view:0\n",
+            )
+        )
+        for upload_job, pdb_id in [
+            (None, "OTHER"),
+            (uuid.UUID(job_number), protein_id),
+        ]:
+            session.add(
+                UploadedPDB(
+                    job_number=upload_job,
+                    pdb_id=pdb_id,
+                    file_hash="same content",
+                    render_status="done",
+                    structure_id=upload_structure_id,
+                )
+            )
+        session.commit()
+    params = {"job_number": job_number, "protein_id": protein_id}
+
+    single = client.get("/protein-structure", params=params).json()
+    assert single["structure_id"] == upload_structure_id
+    assert client.get("/protein-structures", params=params).json() == {
+        protein_id: single
+    }
+
+
+def test_submit_job_fails_upload_that_cant_be_queued(monkeypatch):
+    def broken_submit(upload_id):
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(main.scheduler, "submit", lambda job_number: None)
+    monkeypatch.setattr(main.upload_renderer, "submit", broken_submit)
+    job = {
+        "psms": {"group1": ["PEPTIDE"]},
+        "ptm_annotations": {},
+        "background_color": 0,
+        "species": "human",
+    }
+    response = client.post(
+        "/job",
+        data={"job": json.dumps(job)},
+        files={"file": ("AF-P12345-F1-model_v4.pdb", b"ATOM", "text/plain")},
+    )
+    assert response.status_code == 200
+    job_number = response.json()["job_number"]
+
+    # The job runs without the structure, clients don't wait for its render
+    with SessionLocal() as session:
+        upload = (
+            session.query(UploadedPDB)
+            .filter(UploadedPDB.job_number == uuid.UUID(job_number))
+            .one()
+        )
+        assert upload.render_status == "failed"
+        assert upload.render_error == "Could not queue the render"
@@ -0,0 +1,119 @@
+import uuid
+
+from sqlalchemy import create_engine, inspect, select
+from sqlalchemy.orm import sessionmaker, with_parent
+
+from database import (
+    FASTA_Entry,
+    Job,
+    ProteinStructure,
+    SequenceCoverageResult,
+    job_seq_result,
+)
+from migrations import MIGRATIONS, migrate
+
+INDEXES = [
+    "ix_fasta_entries_name",
+    "ix_job_seq_result_job_number_id",
+    "ix_protein_structures_protein_id_species",
+]
+
+
+def test_migrate_old_database(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'scv.db'}")
+    migrate(engine)
+    with engine.begin() as conn:  # turn it into a database created by an older version
+        conn.exec_driver_sql("DROP TABLE schema_migrations")
+        for index in INDEXES:
+            conn.exec_driver_sql(f"DROP INDEX {index}")
+        conn.exec_driver_sql("ALTER TABLE protein_structures DROP COLUMN objs_str")
+
+    applied = migrate(engine)
+    assert [version for version, _, _ in applied] == [m.version for m in MIGRATIONS]
+    assert applied[0][2] == ["protein_structures.objs_str"]
+    assert sorted(applied[1][2]) == INDEXES
+
+    inspector = inspect(engine)
+    indexes = {
+        index["name"]
+        for table in inspector.get_table_names()
+        for index in inspector.get_indexes(table)
+    }
+    assert set(INDEXES) <= indexes
+    assert migrate(engine) == []  # nothing left to apply
+
+
+def test_migrate_from_version(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'scv.db'}")
+    migrate(engine)
+    with engine.begin() as conn:  # a database migrated before the upload columns existed
+        conn.exec_driver_sql("DELETE FROM schema_migrations WHERE version > 2")
+        for index in ["ix_uploaded_pdbs_file_hash", "ix_uploaded_pdbs_job_number"]:
+            conn.exec_driver_sql(f"DROP INDEX {index}")
+        for column in ["file_hash", "render_status", "render_error", "structure_id"]:
+            conn.exec_driver_sql(f"ALTER TABLE uploaded_pdbs DROP COLUMN {column}")
+
+    applied = migrate(engine)
+    assert [version for version, _, _ in applied] == [3, 4, 5]
+    assert applied[0][2] == [
+        "uploaded_pdbs.file_hash",
+        "uploaded_pdbs.render_status",
+        "uploaded_pdbs.render_error",
+        "uploaded_pdbs.structure_id",
+    ]
+    assert applied[1][2] == [
+        "ix_uploaded_pdbs_file_hash",
+        "ix_uploaded_pdbs_job_number",
+    ]
+    assert applied[2][2] == []  # SQLite stores the coverage arrays in the existing columns
+
+
+def test_migrate_new_database(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'scv.db'}")
+    applied = migrate(engine)
+    # create_all() already made the tables up to date, the migrations have nothing to do
+    assert [result for _, _, result in applied] == [[]] * len(MIGRATIONS)
+
+
+def query_plan(conn, statement):
+    compiled = statement.compile(dialect=conn.dialect)
+    params = compiled.construct_params()
+    values = []
+    for name in compiled.positiontup:
+        process = compiled.binds[name].type.bind_processor(conn.dialect)
+        values.append(process(params[name]) if process else params[name])
+    rows = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}", tuple(values))
+    return " / ".join(row[-1] for row in rows)
+
+
+def test_hot_queries_use_indexes(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'scv.db'}")
+    migrate(engine)
+    job_number = str(uuid.uuid4())
+
+    with sessionmaker(bind=engine)() as session:
+        job = Job(job_number=uuid.UUID(job_number), species="human")
+        session.add(job)
+        session.commit()
+
+        structure = select(ProteinStructure.id).where(
+            ProteinStructure.protein_id == "P1", ProteinStructure.species == "human"
+        )
+        fasta = select(FASTA_Entry.id).where(FASTA_Entry.name == "human")
+        job_results = (
+            select(SequenceCoverageResult.id)
+            .join(job_seq_result, job_seq_result.c.id == SequenceCoverageResult.id)
+            .where(job_seq_result.c.job_number == job_number)
+        )
+        # Lazy load of Job.sequence_coverage_results
+        relationship = select(SequenceCoverageResult).where(
+            with_parent(job, Job.sequence_coverage_results)
+        )
+
+        conn = session.connection()
+        assert "ix_protein_structures_protein_id_species" in query_plan(conn, structure)
+        assert "ix_fasta_entries_name" in query_plan(conn, fasta)
+        for statement in (job_results, relationship):
+            plan = query_plan(conn, statement)
+            assert "ix_job_seq_result_job_number_id" in plan
+            assert "SCAN" not in plan
@@ -0,0 +1,209 @@
+import re
+import numpy as np
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from database import Base, FASTA_Entry, Job, SequenceCoverageResult
+from models import SequenceCoverageModel
+
+from processing import (
+    accumulate_coverage,
+    automaton_matching,
+    automaton_trie,
+    count_nonzero_by_protein,
+    match_proteome,
+    freq_ptm_index_gen_batch,
+    nonzero_offsets_by_protein,
+    parse_psm_ptm_sites,
+    process_aho_result,
+    protein_bounds,
+    save_sequence_coverage_results,
+    separator_pos,
+    worker,
+)
+from proteome import ProteomeIndex
+
+
+def test_parse_psm_ptm_sites():
+    patterns = [
+        (ptm, re.compile(re.escape(ptm))) for ptm in ["S[79.9663]", "[15.9949]"]
+    ]
+    sites = parse_psm_ptm_sites("PEPS[79.9663]TM[15.9949]IDE", patterns)
+    # S[79.9663] sits on S (offset 3), [15.9949] is reported on the residue after M
+    assert sorted(sites) == [(3, 0), (6, 1)]
+    assert parse_psm_ptm_sites("PEPTIDE", patterns) == []
+
+
+def test_match_proteome_in_slices():
+    proteome = ProteomeIndex.from_protein_dict(
+        "test",
+        1,
+        {
+            f"P{i}": {"sequence": sequence, "gene": "", "des": ""}
+            for i, sequence in enumerate(["AAPEPTIDEK", "", "PEPTIDEPEPTIDE", "KPEP"])
+        },
+    )
+    A = automaton_trie(["PEPTIDE", "KPEP", "EPEP"])
+    expected = automaton_matching(A, proteome.seq_line)
+    for chunk_size in (1, 7, 1 << 22):
+        result = match_proteome(A, proteome, chunk_size)
+        assert [r.tolist() for r in result] == [e.tolist() for e in expected]
+
+
+def test_process_aho_result_ptm_lines():
+    seq_line = "AAPEPSTIDEKK|PEPSTIDE"
+    peptide_psm_dict = {
+        "PEPSTIDE": ["PEPS[79.9663]TIDE", "PEPSTIDE"],
+    }
+    psm_group_dict = {"PEPS[79.9663]TIDE": "phospho"}
+    ptm_index_line_dict = {
+        "phospho": np.zeros(len(seq_line), dtype=np.int32),
+        "S[79.9663]": np.zeros(len(seq_line), dtype=np.int32),
+    }
+    zero_line = np.zeros(len(seq_line), dtype=np.int32)
+    aho_result = automaton_matching(automaton_trie(["PEPSTIDE"]), seq_line)
+
+    zero_line, ptm_index_line_dict = process_aho_result(
+        aho_result, ptm_index_line_dict, peptide_psm_dict, psm_group_dict, zero_line
+    )
+
+    assert zero_line.tolist() == [0, 0] + [2] * 8 + [0, 0, 0] + [2] * 8
+    assert (
+        ptm_index_line_dict["phospho"].tolist() == [0, 0] + [1] * 8 + [0] * 3 + [1] * 8
+    )
+    assert np.nonzero(ptm_index_line_dict["S[79.9663]"])[0].tolist() == [5, 16]
+
+
+def test_accumulate_coverage():
+    line = np.zeros(8, dtype=np.int32)
+    starts = np.array([0, 2, 2, 7])
+    ends = np.array([3, 4, 2, 7])
+    weights = np.array([1, 2, 3, 1])
+    accumulate_coverage(line, starts, ends, weights)
+    assert line.tolist() == [1, 1, 6, 3, 2, 0, 0, 1]
+
+
+def test_per_protein_reduction():
+    seq_line = "ABC||DEFG|H"
+    sep_pos_array = separator_pos(seq_line)
+    starts, ends = protein_bounds(sep_pos_array)
+    line = np.array([0, 1, 1, 0, 0, 2, 0, 3, 0, 0, 0], dtype=np.int32)
+
+    counts = count_nonzero_by_protein(line, starts, ends)
+    assert starts.tolist() == [0, 4, 5, 10]
+    assert counts.tolist() == [2, 0, 2, 0]
+
+    offsets, lo, hi = nonzero_offsets_by_protein(line, starts, ends, np.array([0, 2]))
+    assert offsets[lo[0] : hi[0]].tolist() == [1, 2]
+    assert offsets[lo[1] : hi[1]].tolist() == [0, 2]
+
+
+def test_coverage_hash_is_per_protein():
+    protein_dict = {
+        "P1": {"sequence": "PEPTIDEK", "gene": "G1", "des": "first"},
+        "P2": {"sequence": "AAAPEPTIDE", "gene": "G2", "des": "second"},
+    }
+    psms = {"group": ["PEPTIDE"]}
+
+    both = freq_ptm_index_gen_batch(
+        dict(psms),
+        {"group": [0, 0, 0]},
+        ProteomeIndex.from_protein_dict("test", 1, protein_dict),
+        {},
+    )
+    only_p2 = freq_ptm_index_gen_batch(
+        dict(psms),
+        {"group": [0, 0, 0]},
+        ProteomeIndex.from_protein_dict("test", 2, {"P2": protein_dict["P2"]}),
+        {},
+    )
+
+    assert both["P1"]["id"] != both["P2"]["id"]
+    assert both["P2"]["id"] == only_p2["P2"]["id"]
+
+
+def test_worker_job_status(tmp_path, monkeypatch):
+    monkeypatch.setenv("PROTEOME_INDEX_DIR", str(tmp_path / "proteome_index"))
+    engine = create_engine(f"sqlite:///{tmp_path / 'scv.db'}")
+    Base.metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+
+    with session_factory() as session:
+        session.add(
+            FASTA_Entry(
+                name="status-test",
+                data={"P1": {"sequence": "PEPTIDEK", "gene": "G1", "des": "first"}},
+            )
+        )
+        done = Job(
+            psms={"group": ["PEPTIDE"]},
+            ptm_annotations={"group": [0, 0, 0]},
+            species="status-test",
+        )
+        failed = Job(
+            psms={"group": ["PEPTIDE"]},
+            ptm_annotations={"group": [0, 0, 0]},
+            species="unknown-species",
+        )
+        session.add_all([done, failed])
+        session.commit()
+        done_number, failed_number = done.job_number, failed.job_number
+        assert done.status == "queued"
+
+    worker(done_number, session_factory)
+    with pytest.raises(ValueError):
+        worker(failed_number, session_factory)
+
+    with session_factory() as session:
+        done = session.get(Job, done_number)
+        assert done.status == "done"
+        assert done.started_at <= done.finished_at
+        assert len(done.sequence_coverage_results) == 1
+
+        failed = session.get(Job, failed_number)
+        assert failed.status == "failed"
+        assert "unknown-species" in failed.error
+        assert failed.finished_at is not None
+
+
+def test_save_sequence_coverage_results(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'scv.db'}")
+    Base.metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+
+    def model(i):
+        return SequenceCoverageModel(
+            id=f"hash{i}",
+            protein_id=f"P{i}",
+            coverage=0.5,
+            sequence="PEPTIDEK",
+            sequence_coverage=[1, 1, 0, 0, 0, 0, 0, 0],
+            ptms={"phospho": [0]},
+        )
+
+    with session_factory() as session:
+        first, second = Job(species="human"), Job(species="human")
+        session.add_all([first, second])
+        session.commit()
+        first_number, second_number = first.job_number, second.job_number
+
+        models = [model(i) for i in range(5)]
+        assert save_sequence_coverage_results(session, first_number, models, 2) == 5
+        # Overlapping results are shared, duplicates within a job are stored once
+        models = [model(i) for i in range(3, 7)] + [model(6)]
+        assert save_sequence_coverage_results(session, second_number, models, 2) == 2
+
+    with session_factory() as session:
+        assert session.query(SequenceCoverageResult).count() == 7
+        first = session.get(Job, first_number)
+        second = session.get(Job, second_number)
+        assert sorted(r.id for r in first.sequence_coverage_results) == [
+            f"hash{i}" for i in range(5)
+        ]
+        assert sorted(r.id for r in second.sequence_coverage_results) == [
+            f"hash{i}" for i in range(3, 7)
+        ]
+        result = second.sequence_coverage_results[0]
+        assert result.sequence_coverage.tolist() == [1, 1, 0, 0, 0, 0, 0, 0]
+        assert result.ptms["phospho"].tolist() == [0]
@@ -0,0 +1,107 @@
+import threading
+
+import numpy as np
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from database import Base, FASTA_Entry
+
+import proteome
+from proteome import (
+    ProteomeIndex,
+    ProteomeIndexWriter,
+    get_proteome_index,
+    proteome_index_dir,
+)
+
+protein_dict = {
+    "P1": {"sequence": "PEPTIDEK", "gene": "G1", "des": "First protein"},
+    "P2": {"sequence": "", "gene": "N/A", "des": "Empty"},
+    "P3": {"sequence": "AAAK", "gene": "G3", "des": "Ünicode description"},
+}
+
+
+def test_proteome_index_layout():
+    index = ProteomeIndex.from_protein_dict("test", 1, protein_dict)
+    assert index.seq_line == "PEPTIDEK||AAAK"
+    assert index.sep_pos_array.tolist() == [-1, 8, 9, 14]
+    assert list(index.ids) == ["P1", "P2", "P3"]
+    assert [index.sequence(i) for i in range(len(index))] == ["PEPTIDEK", "", "AAAK"]
+
+    # Slices of whole proteins, whatever the slice size
+    for size in (1, 5, 9, 100):
+        chunks = list(index.seq_chunks(size))
+        assert "".join(chunk for _, chunk in chunks) == index.seq_line
+        for offset, chunk in chunks:
+            assert index.seq_line[offset : offset + len(chunk)] == chunk
+            assert offset == 0 or chunk.startswith("|")
+
+
+def test_proteome_index_save_load(tmp_path):
+    index = ProteomeIndex.from_protein_dict("test", 7, protein_dict)
+    index.save(str(tmp_path / "test"))
+
+    loaded = ProteomeIndex.load(str(tmp_path / "test"))
+    assert isinstance(loaded.seq, np.memmap)
+    assert loaded.source_id == 7
+    assert loaded.seq_line == index.seq_line
+    assert list(loaded.descriptions) == list(index.descriptions)
+    assert ProteomeIndex.load(str(tmp_path / "missing")) is None
+
+
+def test_proteome_index_writer(tmp_path):
+    index = ProteomeIndex.from_protein_dict("test", 7, protein_dict)
+    index.save(str(tmp_path / "saved"))
+
+    with ProteomeIndexWriter(str(tmp_path / "written"), "test") as writer:
+        for protein_id, value in protein_dict.items():
+            writer.add(protein_id, value["sequence"], value["gene"], value["des"])
+        assert writer.finish(7) == 3
+
+    for filename in sorted(p.name for p in (tmp_path / "saved").iterdir()):
+        assert (tmp_path / "written" / filename).read_bytes() == (
+            tmp_path / "saved" / filename
+        ).read_bytes()
+    assert not list(tmp_path.glob("*.tmp-*"))
+
+    with pytest.raises(RuntimeError):
+        with ProteomeIndexWriter(str(tmp_path / "failed"), "test") as writer:
+            writer.add("P1", "PEPTIDEK", "G1", "First protein")
+            raise RuntimeError()
+    assert not list(tmp_path.glob("failed*"))
+
+
+def test_proteome_index_dir(monkeypatch):
+    monkeypatch.delenv("PROTEOME_INDEX_DIR", raising=False)
+    assert proteome_index_dir("sqlite:////db/example.db") == "/db/proteome_index"
+    assert proteome_index_dir("postgresql://user@host/scv") is None
+    monkeypatch.setenv("PROTEOME_INDEX_DIR", "/tmp/indexes")
+    assert proteome_index_dir("postgresql://user@host/scv") == "/tmp/indexes"
+
+
+def test_proteome_index_build_locks_one_species(tmp_path, monkeypatch):
+    monkeypatch.setenv("PROTEOME_INDEX_DIR", str(tmp_path / "indexes"))
+    engine = create_engine(f"sqlite:///{tmp_path / 'scv.db'}")
+    Base.metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+    with session_factory() as session:
+        session.add_all(
+            [
+                FASTA_Entry(name="locked", data=protein_dict),
+                FASTA_Entry(name="other", data=protein_dict),
+            ]
+        )
+        session.commit()
+
+    loaded = []
+
+    def load():
+        with session_factory() as session:
+            loaded.append(get_proteome_index(session, "other"))
+
+    with proteome._species_lock("locked"):  # as while building the index of "locked"
+        thread = threading.Thread(target=load)
+        thread.start()
+        thread.join(10)
+    assert [index.seq_line for index in loaded] == ["PEPTIDEK||AAAK"]
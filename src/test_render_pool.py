@@ -0,0 +1,47 @@
+import pytest
+
+from render_pool import (
+    RenderError,
+    RenderPool,
+    RenderPoolClosed,
+    RenderTimeout,
+)
+from rendering import render_3d_from_pdb_str
+from test_rendering import PDB
+
+
+def test_render_pool_matches_in_process_render():
+    pool = RenderPool(workers=1, health_interval=0)
+    try:
+        expected = render_3d_from_pdb_str(PDB, "pept")
+        futures = [pool.submit(PDB, "pept") for _ in range(3)]
+        # The same worker renders each time, nothing carries over between renders
+        assert [future.result(60) for future in futures] == [expected] * 3
+
+        with pytest.raises(RenderError, match="No atoms found"):
+            pool.render("not a PDB file", "empty")
+        assert pool.render(PDB, "pept") == expected
+    finally:
+        pool.shutdown()
+
+    with pytest.raises(RenderPoolClosed):
+        pool.submit(PDB, "pept")
+
+
+def test_render_pool_replaces_workers():
+    pool = RenderPool(workers=1, timeout=0.001, health_interval=0)
+    try:
+        with pytest.raises(RenderTimeout):
+            pool.render(PDB, "pept")
+        pool.timeout = 60
+        assert pool.render(PDB, "pept")["objs"]["name"] == "pept"
+
+        worker = pool._idle.queue[0]
+        assert pool.health_check() == 0
+        worker.process.kill()
+        worker.process.join()
+        assert pool.health_check() == 1
+        assert pool._idle.queue[0] is not worker
+        assert pool.render(PDB, "pept")["objs"]["name"] == "pept"
+    finally:
+        pool.shutdown()
@@ -0,0 +1,90 @@
+import numpy as np
+import pymol
+
+from helpers import pymol_obj_extract
+from rendering import (
+    clean_pymol,
+    get_amino_ele_pos_dict,
+    get_annotations,
+    get_objs,
+    get_residue_atom_ranges,
+    load_pymol_from_file,
+    parse_pdb_atoms,
+)
+
+PDB = """\
+CRYST1    1.000    1.000    1.000  90.00  90.00  90.00 P 1           1
+ATOM      1  N   ASP E   1       4.868 -17.809  25.188  1.00 34.37           N
+ATOM      2  CA  ASP E   1       3.984 -16.723  25.698  1.00 33.85           C
+ATOM      3  CB  ASP E   1       4.633 -16.020  26.888  1.00 35.91           C
+ATOM      4  CG  ASP E   1       6.016 -15.468  26.567  1.00 39.23           C
+ATOM      5  OD1 ASP E   1       6.340 -14.367  27.058  1.00 42.40           O
+ATOM      6  OD2 ASP E   1       6.787 -16.131  25.836  1.00 39.28           O
+ATOM      7  C   ASP E   1       3.789 -15.753  24.546  1.00 33.96           C
+ATOM      8  O   ASP E   1       4.456 -15.889  23.517  1.00 35.44           O
+ATOM      9  N   CYS E   2       2.908 -14.771  24.711  1.00 31.94           N
+ATOM     10  CA  CYS E   2       2.638 -13.825  23.633  1.00 29.67           C
+ATOM     11  CB  CYS E   2       1.198 -13.996  23.132  1.00 28.73           C
+ATOM     12  SG  CYS E   2       0.725 -15.681  22.638  1.00 25.85           S
+ATOM     13  C   CYS E   2       2.842 -12.366  24.012  1.00 30.31           C
+ATOM     14  O   CYS E   2       3.025 -12.039  25.188  1.00 30.74           O
+TER
+HETATM   15  O   HOH W   1      10.000  10.000  10.000  1.00 20.00           O
+END
+"""
+
+
+def test_residue_atom_ranges():
+    first_atom, last_atom = get_residue_atom_ranges({"1": [3, 1, 2], "3": [7, 8]})
+    assert first_atom.tolist() == [1, 0, 7]
+    assert last_atom.tolist() == [3, 0, 8]
+
+
+def test_get_annotations():
+    first_atom, last_atom = get_residue_atom_ranges(
+        {1: [1, 2], 2: [3, 4], 3: [5], 4: [6, 7], 5: [8]}
+    )
+    annotations = get_annotations(
+        np.array([0, 2, 1, 0, 0, 3]),  # residue 6 has no atoms
+        {"phospho": np.array([1, 4])},
+        {"phospho": [0, 0, 255]},
+        first_atom,
+        last_atom,
+    )
+    assert annotations["covered"]["indices"] == [(3, 5), (0, 0)]
+    assert annotations["non_covered"]["indices"] == [(1, 2), (6, 8)]
+    assert annotations["phospho"] == {"color": [0, 0, 255], "indices": [(3, 4), (8, 8)]}
+
+
+def test_get_annotations_fully_covered():
+    first_atom, last_atom = get_residue_atom_ranges({1: [1], 2: [2]})
+    annotations = get_annotations(np.array([1, 1]), {}, {}, first_atom, last_atom)
+    assert annotations["covered"]["indices"] == [(1, 2)]
+    assert annotations["non_covered"]["indices"] == []
+
+
+def test_parse_pdb_atoms():
+    atoms = parse_pdb_atoms(PDB)
+    assert atoms["serial"].tolist() == list(range(1, 16))
+    assert atoms[0]["name"] == "N" and atoms[0]["resn"] == "ASP"
+    assert atoms[-1]["chain"] == "W" and atoms[-1]["element"] == "O"
+    assert atoms["coords"][1].tolist() == [3.984, -16.723, 25.698]
+    assert atoms["segment"].tolist() == [0] * 14 + [1]
+
+    # The CRYST1 record and the atoms after TER aren't counted
+    assert get_amino_ele_pos_dict(atoms) == {
+        1: [1, 2, 3, 4, 5, 6, 7, 8],
+        2: [9, 10, 11, 12, 13, 14],
+    }
+
+
+def test_objs_match_pymol_session(tmp_path):
+    pdb_file = tmp_path / "pept.pdb"
+    pdb_file.write_text(PDB)
+    load_pymol_from_file(str(pdb_file), "pept")
+    try:
+        session = pymol.cmd.get_session("pept", partial=0)
+        atoms = parse_pdb_atoms(pymol.cmd.get_pdbstr("pept"))
+        assert get_objs("pept", atoms) == pymol_obj_extract(session["names"][0])
+    finally:
+        clean_pymol()
@@ -0,0 +1,40 @@
+import threading
+
+import pytest
+
+from scheduler import JobScheduler, SchedulerFull, SchedulerClosed
+
+
+def test_scheduler_rejects_when_full():
+    release = threading.Event()
+    started = threading.Event()
+
+    def target(n):
+        started.set()
+        release.wait(5)
+        return n
+
+    scheduler = JobScheduler(target, max_workers=1, max_queue=1)
+    running = scheduler.submit(1)
+    started.wait(5)
+    queued = scheduler.submit(2)
+    assert scheduler.is_full()
+    with pytest.raises(SchedulerFull):
+        scheduler.submit(3)
+
+    release.set()
+    assert running.result(5) == 1
+    assert queued.result(5) == 2
+    scheduler.shutdown()
+
+
+def test_scheduler_drains_on_shutdown():
+    done = []
+    scheduler = JobScheduler(done.append, max_workers=2, max_queue=10)
+    for i in range(10):
+        scheduler.submit(i)
+    scheduler.shutdown(wait=True)
+
+    assert sorted(done) == list(range(10))
+    with pytest.raises(SchedulerClosed):
+        scheduler.submit(11)
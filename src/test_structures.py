@@ -0,0 +1,118 @@
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from database import Base, ProteinStructure
+from structures import (
+    bump_structure_version,
+    get_structure_ids,
+    get_structure_sources,
+    save_structures,
+    source_file_hash,
+)
+
+
+def test_structure_ids_reload_on_version_bump(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'scv.db'}")
+    Base.metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+
+    with session_factory() as session:
+        session.add_all(
+            [
+                ProteinStructure(id="a", protein_id="P1", species="structure-test"),
+                ProteinStructure(id="b", protein_id="P2", species="other-species"),
+            ]
+        )
+        session.commit()
+
+        structure_ids = get_structure_ids(session, "structure-test")
+        assert structure_ids == {"P1"}
+
+        # Not visible until the version is bumped
+        session.add(ProteinStructure(id="c", protein_id="P3", species="structure-test"))
+        session.commit()
+        assert get_structure_ids(session, "structure-test") is structure_ids
+
+        bump_structure_version(session, "structure-test")
+        assert get_structure_ids(session, "structure-test") == {"P1", "P3"}
+
+        bump_structure_version(session, "structure-test")
+        assert get_structure_ids(session, "unknown-species") == frozenset()
+
+
+def test_save_structures(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'scv.db'}")
+    Base.metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+
+    def structure(i):
+        return {
+            "id": f"hash{i}",
+            "protein_id": f"P{i}",
+            "species": "human",
+            "pdb_str": f"ATOM {i}",
+        }
+
+    with session_factory() as session:
+        assert save_structures(session, [structure(1), structure(2)]) == [
+            "hash1",
+            "hash2",
+        ]
+        # Stored and repeated structures are skipped
+        batch = [structure(2), structure(3), structure(3)]
+        assert save_structures(session, batch) == ["hash3"]
+
+    with session_factory() as session:
+        assert session.query(ProteinStructure).count() == 3
+        assert session.get(ProteinStructure, "hash3").pdb_str == "ATOM 3"
+
+
+def test_save_structure_sources(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'scv.db'}")
+    Base.metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+
+    pdb_file = tmp_path / "AF-P1-F1-model_v4.pdb"
+    pdb_file.write_text("ATOM 1")
+    file_hash = source_file_hash(str(pdb_file))
+    assert file_hash == source_file_hash(str(pdb_file))
+
+    def structure(structure_id):
+        return {"id": structure_id, "protein_id": "P1", "species": "human"}
+
+    def source(structure_id, pipeline_version):
+        return {
+            "species": "human",
+            "file_hash": file_hash,
+            "pipeline_version": pipeline_version,
+            "filename": pdb_file.name,
+            "structure_id": structure_id,
+        }
+
+    with session_factory() as session:
+        save_structures(session, [structure("old")], [source("old", 1)])
+        assert [s.structure_id for s in get_structure_sources(session, "human", 1)] == [
+            "old"
+        ]
+        assert get_structure_sources(session, "human", 2) == []
+
+        # Rendered again by a newer pipeline version, the outdated structure is replaced
+        assert save_structures(session, [structure("new")], [source("new", 2)]) == [
+            "new"
+        ]
+        assert [s.structure_id for s in get_structure_sources(session, "human", 2)] == [
+            "new"
+        ]
+        assert [s.id for s in session.query(ProteinStructure)] == ["new"]
+
+        # One row per file name: a copy is recorded next to it, a changed file replaces its row
+        save_structures(session, [], [{**source("new", 2), "filename": "copy.pdb"}])
+        save_structures(
+            session,
+            [structure("changed")],
+            [{**source("changed", 2), "file_hash": "changed"}],
+        )
+        assert sorted(
+            (s.filename, s.structure_id)
+            for s in get_structure_sources(session, "human", 2)
+        ) == [("AF-P1-F1-model_v4.pdb", "changed"), ("copy.pdb", "new")]
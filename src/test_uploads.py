@@ -0,0 +1,99 @@
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from database import Base, ProteinStructure, StructureSource, UploadedPDB
+from render_pool import RenderPool
+from structures import source_hash
+from test_rendering import PDB
+from uploads import UPLOAD_SPECIES, UploadRenderer
+
+
+def add_upload(session_factory, pdb_str, filename="AF-P12345-F1-model_v4.pdb"):
+    with session_factory() as session:
+        upload = UploadedPDB(
+            pdb_file=pdb_str,
+            filesize=len(pdb_str),
+            filename=filename,
+            pdb_id=filename.split("-")[1],
+            file_hash=source_hash(pdb_str.encode()),
+            render_status="queued",
+        )
+        session.add(upload)
+        session.commit()
+        return upload.id
+
+
+def test_uploads_render_once_per_content(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'scv.db'}")
+    Base.metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+    pool = RenderPool(workers=1, health_interval=0)
+    renderer = UploadRenderer(session_factory, pool)
+    try:
+        # Identical uploads submitted together share one render
+        first = add_upload(session_factory, PDB)
+        second = add_upload(session_factory, PDB, "AF-P12345-F1-copy.pdb")
+        assert renderer.submit(first) == "queued"
+        assert renderer.submit(second) == "queued"
+        renderer._executor.submit(lambda: None).result(60)  # wait for the render
+
+        with session_factory() as session:
+            uploads = [session.get(UploadedPDB, id) for id in (first, second)]
+            assert [upload.render_status for upload in uploads] == ["done", "done"]
+            structure_id = uploads[0].structure_id
+            assert uploads[1].structure_id == structure_id
+            structure = session.get(ProteinStructure, structure_id)
+            assert (structure.protein_id, structure.species) == (
+                "P12345",
+                UPLOAD_SPECIES,
+            )
+            assert structure.amino_ele_pos and structure.objs_str and structure.pdb_str
+            assert session.query(StructureSource).count() == 1
+
+        # Uploads of a rendered file are linked right away
+        third = add_upload(session_factory, PDB)
+        assert renderer.submit(third) == "done"
+
+        failed = add_upload(session_factory, "not a PDB file")
+        assert renderer.submit(failed) == "queued"
+        renderer._executor.submit(lambda: None).result(60)
+        with session_factory() as session:
+            upload = session.get(UploadedPDB, failed)
+            assert upload.render_status == "failed"
+            assert "No atoms found" in upload.render_error
+            assert upload.structure_id is None
+    finally:
+        renderer.shutdown()
+        pool.shutdown()
+
+
+def test_resume_interrupted_uploads(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'scv.db'}")
+    Base.metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+    pool = RenderPool(workers=1, health_interval=0)
+    renderer = UploadRenderer(session_factory, pool)
+    try:
+        # Left behind by a server that stopped while rendering them
+        queued = add_upload(session_factory, PDB)
+        rendering = add_upload(session_factory, PDB, "AF-P12345-F1-copy.pdb")
+        missing = add_upload(session_factory, PDB, "AF-P12345-F1-gone.pdb")
+        with session_factory() as session:
+            session.get(UploadedPDB, rendering).render_status = "rendering"
+            session.get(UploadedPDB, missing).file_hash = None
+            session.get(UploadedPDB, missing).pdb_file = None
+            session.commit()
+
+        assert renderer.resume() == 3
+        renderer._executor.submit(lambda: None).result(60)  # wait for the render
+
+        with session_factory() as session:
+            for upload_id in (queued, rendering):
+                upload = session.get(UploadedPDB, upload_id)
+                assert upload.render_status == "done"
+                assert upload.structure_id is not None
+            assert session.get(UploadedPDB, missing).render_status == "failed"
+        assert renderer.resume() == 0
+    finally:
+        renderer.shutdown()
+        pool.shutdown()
@@ -0,0 +1,227 @@
+import logging
+import re
+import threading
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from functools import partial
+
+from sqlalchemy import select, update
+
+from database import ProteinStructure, StructureSource, UploadedPDB
+from render_pool import RenderPoolClosed
+from rendering import PIPELINE_VERSION, get_db_model_from_render
+from structures import save_structures
+
+logger = logging.getLogger("uvicorn")
+
+# Species of uploaded structures, keeps them out of the structure indexes of the real species
+UPLOAD_SPECIES = "upload"
+
+
+def find_rendered_upload(session, file_hash: str):
+    """
+    Structure rendered by the current pipeline version from an upload with the same content
+    :return: ProteinStructure id, or None
+    """
+    return session.scalar(
+        select(StructureSource.structure_id)
+        .join(ProteinStructure, ProteinStructure.id == StructureSource.structure_id)
+        .where(
+            StructureSource.species == UPLOAD_SPECIES,
+            StructureSource.file_hash == file_hash,
+            StructureSource.pipeline_version == PIPELINE_VERSION,
+        )
+    )
+
+
+def get_job_upload(session, job_number):
+    """
+    Render state of the PDB file uploaded with a job, without loading the file
+    :return: Row with pdb_id, render_status, render_error and structure_id, or None if the job has no upload
+    """
+    return (
+        session.query(
+            UploadedPDB.pdb_id,
+            UploadedPDB.render_status,
+            UploadedPDB.render_error,
+            UploadedPDB.structure_id,
+        )
+        .filter(UploadedPDB.job_number == job_number)
+        .first()
+    )
+
+
+class UploadRenderer:
+    """
+    Background render stage of uploaded PDB files.
+    Renders run on the render pool and produce a ProteinStructure linked to the upload. Uploads are deduplicated
+    by content hash: an upload of a file that was rendered before is linked to its structure right away, an
+    upload of a file that is being rendered waits for that render.
+    """
+
+    def __init__(self, session_factory, render_pool):
+        self.session_factory = session_factory
+        self.render_pool = render_pool
+
+        # Reentrant: done callbacks added to a finished render run right away, in the caller's thread
+        self._lock = threading.RLock()
+        self._in_flight = {}  # file hash -> Future of the structure id
+        self._executor = ThreadPoolExecutor(
+            max_workers=render_pool.workers, thread_name_prefix="upload-render"
+        )
+
+    def submit(self, upload_id) -> str:
+        """
+        Queue the render of an uploaded PDB file. Queries the database, call it off the event loop.
+        :return: Render status of the upload: "done" if it was linked to an existing structure, else "queued"
+        """
+        with self.session_factory() as session:
+            upload = session.get(UploadedPDB, upload_id)
+            file_hash = upload.file_hash
+            structure_id = find_rendered_upload(session, file_hash)
+            if structure_id is not None:
+                upload.render_status = "done"
+                upload.structure_id = structure_id
+                session.commit()
+                return "done"
+            pdb_str, filename, pdb_id = upload.pdb_file, upload.filename, upload.pdb_id
+
+        with self._lock:
+            future = self._in_flight.get(file_hash)
+            if future is None:
+                try:
+                    future = self._executor.submit(
+                        self._render, file_hash, pdb_str, filename, pdb_id
+                    )
+                except RuntimeError:  # shut down
+                    future = None
+                else:
+                    self._in_flight[file_hash] = future
+                    future.add_done_callback(partial(self._forget, file_hash))
+        if future is None:
+            self._set_state(upload_id, "failed", error="Server is shutting down")
+            return "failed"
+        future.add_done_callback(partial(self._finish, upload_id))
+        return "queued"
+
+    def fail(self, upload_id, error: str):
+        """
+        Mark an upload failed, e.g. when its render could not be queued, so clients stop waiting for it
+        """
+        self._set_state(upload_id, "failed", error=error)
+
+    def resume(self) -> int:
+        """
+        Queue the renders of uploads left queued or rendering by a previous run of the server, e.g. after a crash.
+        Uploads that can't be queued are marked failed. Call it on startup, before new uploads are accepted.
+        :return: Number of resumed uploads
+        """
+        with self.session_factory() as session:
+            upload_ids = session.scalars(
+                select(UploadedPDB.id)
+                .where(UploadedPDB.render_status.in_(("queued", "rendering")))
+                .order_by(UploadedPDB.id)
+            ).all()
+            session.execute(
+                update(UploadedPDB)
+                .where(UploadedPDB.render_status == "rendering")
+                .values(render_status="queued")
+            )
+            session.commit()
+
+        for upload_id in upload_ids:
+            try:
+                self.submit(upload_id)
+            except Exception as e:
+                logger.warning(
+                    f"Could not resume render of uploaded PDB {upload_id}: {e}"
+                )
+                self.fail(upload_id, "Could not queue the render")
+        return len(upload_ids)
+
+    def _forget(self, file_hash, future):
+        with self._lock:
+            if self._in_flight.get(file_hash) is future:
+                del self._in_flight[file_hash]
+
+    def _render(self, file_hash, pdb_str, filename, pdb_id):
+        with self.session_factory() as session:
+            session.execute(
+                update(UploadedPDB)
+                .where(
+                    UploadedPDB.file_hash == file_hash,
+                    UploadedPDB.render_status == "queued",
+                )
+                .values(render_status="rendering")
+            )
+            session.commit()
+
+        # The file name is chosen by the user, only pass PyMOL a plain object name
+        pdb_name = re.sub(r"[^\w.-]", "_", filename)
+        ret = self.render_pool.render(pdb_str, pdb_name)
+        structure = get_db_model_from_render(ret, pdb_name, pdb_id, UPLOAD_SPECIES)
+        source = {
+            "species": UPLOAD_SPECIES,
+            "file_hash": file_hash,
+            "pipeline_version": PIPELINE_VERSION,
+            "filename": file_hash,  # user file names collide, uploads are keyed by content
+            "file_size": len(pdb_str.encode()),
+            "structure_id": structure.id,
+        }
+        with self.session_factory() as session:
+            # Replaces the structure rendered from the same file by an older pipeline version,
+            # uploads linked to it are moved to the new one
+            save_structures(
+                session,
+                [
+                    {
+                        column.name: getattr(structure, column.name)
+                        for column in ProteinStructure.__table__.columns
+                    }
+                ],
+                [source],
+            )
+            session.execute(
+                update(UploadedPDB)
+                .where(
+                    UploadedPDB.file_hash == file_hash,
+                    UploadedPDB.structure_id.is_not(None),
+                )
+                .values(structure_id=structure.id)
+            )
+            session.commit()
+        return structure.id
+
+    def _finish(self, upload_id, future):
+        try:
+            structure_id = future.result()
+        except (CancelledError, RenderPoolClosed):
+            self._set_state(upload_id, "failed", error="Server is shutting down")
+        except Exception as e:
+            logger.warning(f"Render of uploaded PDB {upload_id} failed: {e}")
+            self._set_state(upload_id, "failed", error=str(e))
+        else:
+            self._set_state(upload_id, "done", structure_id=structure_id)
+
+    def _set_state(self, upload_id, status, error=None, structure_id=None):
+        try:
+            with self.session_factory() as session:
+                session.execute(
+                    update(UploadedPDB)
+                    .where(UploadedPDB.id == upload_id)
+                    .values(
+                        render_status=status,
+                        render_error=error,
+                        structure_id=structure_id,
+                    )
+                )
+                session.commit()
+        except Exception:
+            logger.exception(
+                f"Could not store render state of uploaded PDB {upload_id}"
+            )
+
+    def shutdown(self, wait=True):
+        """
+        Stop accepting uploads. With wait=True, finish the queued renders first.
+        """
+        self._executor.shutdown(wait=wait, cancel_futures=not wait)
@@ -55,21 +55,8 @@ class CoverageCard {
     this.card.id = this.protein_id;
     this.card.append(textDiv, coverageDiv, this.canvas, sequence_div);
 
-    if (this.is_visible) {
-      this.card.addEventListener("click", e => {
-        if(!this.card.classList.contains("selected")) {
-          clear_selected();
-          let prom = fetch_mol(this.protein_id); //fetch mol immediately on click, give promise to prom_handle
-          pdb_dest = this.protein_id; //set global variable for pdb_dest
-          this.card.classList.add("selected");
-          document.querySelector('#molloading').classList.add('spin-ani');
-          let container = glmol01.container[0].querySelector("canvas");
-          container.style.opacity = "0";
-          container.addEventListener("transitionend", e => prom_handle(prom), {once: true});
-          set_open_source(this.protein_id); // set "Open Alphafold" protein-id
-        }
-      });
-    }
+    if (this.is_visible)
+      this.card.addEventListener("click", e => this.select());
     else
       this.card.classList.add('disabled');
 
@@ -78,6 +65,30 @@ class CoverageCard {
     return this.card;
   }
 
+  select() {
+    if(!this.card.classList.contains("selected")) {
+      clear_selected();
+      let prom = fetch_mol(this.protein_id); //fetch mol immediately on click, give promise to prom_handle
+      pdb_dest = this.protein_id; //set global variable for pdb_dest
+      this.card.classList.add("selected");
+      document.querySelector('#molloading').classList.add('spin-ani');
+      let container = glmol01.container[0].querySelector("canvas");
+      container.style.opacity = "0";
+      container.addEventListener("transitionend", e => prom_handle(prom), {once: true});
+      set_open_source(this.protein_id); // set "Open Alphafold" protein-id
+    }
+  }
+
+  // Structure became available after the card was created (rendered upload)
+  enable() {
+    if (this.is_visible)
+      return;
+    this.is_visible = true;
+    this.card.classList.remove('disabled');
+    this.card.addEventListener("click", e => this.select());
+    this.drawCoverage(coverage_color);
+  }
+
   initCanvas() {
     this.ctx = this.canvas.getContext('2d');
 
@@ -227,6 +238,10 @@ let pdb_dest;
 let coverage_cards = [];
 let regex_dict = {}
 let ribbon_range;
+let uploaded_structure; // protein id of the PDB file uploaded with the job, once rendered
+let prefetched = {}; // protein id -> promise of {pdb_str, ret}
+
+const PREFETCH_COUNT = 5; // structures of the best covered proteins, fetched while the list is read
 
 let coverage_color = '#FF3E3E';
 
@@ -272,6 +287,55 @@ const create_usi_section = (usis) => {
   objectElement.id = "usiObject";
 }
 
+// Show the structure rendered from the PDB file uploaded with the job
+const show_uploaded_structure = (protein_id) => {
+  if (uploaded_structure === protein_id)
+    return;
+  uploaded_structure = protein_id; // cards created later are enabled by the protein list
+  delete prefetched[protein_id]; // may be the species' structure
+  let card = coverage_cards.find(c => c.protein_id === protein_id);
+  if (card === undefined)
+    return;
+  card.enable();
+  if (document.querySelector(".protein-card.selected") == null || get_anchor() === protein_id)
+    card.select();
+}
+
+// Wait for the job to finish. Resolves with its status, rejects if the job failed.
+// The stream stays open while an uploaded PDB file is rendering, its structure is shown once it is rendered.
+const wait_for_job = () => {
+  return new Promise((resolve, reject) => {
+    if (!window.EventSource) {
+      resolve(null); // no way to wait, load whatever is there
+      return;
+    }
+    let source = new EventSource('/job_status/stream?job_number=' + encodeURIComponent(job));
+    source.addEventListener('status', e => {
+      let status = JSON.parse(e.data);
+      let structure = status['structure'];
+      if (structure != null && structure['status'] === 'done')
+        show_uploaded_structure(structure['protein_id']);
+      let rendering = structure != null && (structure['status'] === 'queued' || structure['status'] === 'rendering');
+      if (status['status'] === 'done') {
+        if (!rendering)
+          source.close();
+        resolve(status);
+      }
+      else if (status['status'] === 'failed') {
+        source.close();
+        reject(new Error('Job failed', {
+          cause: {status: 'failed', response: {detail: status['error']}}
+        }));
+      }
+    });
+    source.onerror = () => {
+      // Stream unavailable (e.g. unknown job), let /protein-list report the error
+      source.close();
+      resolve(null);
+    };
+  });
+}
+
 window.onload = () => {
   let form = new FormData();
   form.append('job_number', job);
@@ -308,11 +372,12 @@ window.onload = () => {
       show_major_error(err.cause.status, err.cause.response.detail);
   });
 
-  // Fetch coverage data
-  let proteinListPromise = fetch('/protein-list', {
+  // Fetch coverage data once the job is finished
+  let proteinListPromise = wait_for_job()
+  .then(() => fetch('/protein-list', {
     method: 'POST',
     body: form
-  })
+  }))
   .then(async response => {
     if(response.ok) {
       document.querySelector("#list_loading").classList.remove("spin-ani");
@@ -346,7 +411,7 @@ window.onload = () => {
               i['coverage'] * 100, // convert to percent
               i['sequence_coverage'],
               i['sequence'],
-              i["has_pdb"],
+              i["has_pdb"] || i['protein_id'] === uploaded_structure,
               i["ptms"]
       );
       document.querySelector('.protein-list-container').append(c.createCard());
@@ -355,6 +420,13 @@ window.onload = () => {
       coverage_cards.push(c);
     })
 
+    // Prefetch the structures of the best covered proteins, the card selected below is fetched with them
+    let visible_cards = coverage_cards.filter(c => c.is_visible);
+    let prefetch_ids = visible_cards.slice(0, PREFETCH_COUNT).map(c => c.protein_id);
+    if (visible_cards.some(c => c.protein_id === get_anchor()) && !prefetch_ids.includes(get_anchor()))
+      prefetch_ids.push(get_anchor());
+    prefetch_structures(prefetch_ids);
+
     // select first card
     let selection = document.querySelector("#"+get_anchor());
     if (selection == null)
@@ -499,22 +571,52 @@ const toggle_autorotate = () => {
     start_autorotate();
 }
 
-const fetch_mol = (protein_id) => {
-  let form = new FormData();
-  form.append('job_number', job);
-  form.append('protein_id', protein_id);
-  return fetch('/protein-structure', {
-    method: 'POST',
-    body: form
-  })
+// PDB of a structure returned by /protein-structure(s)
+const fetch_pdb = async (structure) => {
+  let pdb_response = await fetch(structure['pdb_url']);
+  if (!pdb_response.ok)
+    throw new Error("Error in fetch " + structure['pdb_url'], {
+      cause: {status: pdb_response.status, response: await pdb_response.json()}
+    });
+  return {pdb_str: await pdb_response.text(), ret: structure['ret']};
+}
+
+// Fetch the structures of several proteins in one request, fetch_mol() uses them
+const prefetch_structures = (protein_ids) => {
+  if (protein_ids.length === 0)
+    return;
+  let params = new URLSearchParams({job_number: job});
+  protein_ids.forEach(protein_id => params.append('protein_id', protein_id));
+  let batch = fetch('/protein-structures?' + params.toString())
   .then(response => {
-    if (response.ok)
-      return response.json();
-    else
+    if (!response.ok)
+      throw new Error("Error in fetch /protein-structures");
+    return response.json();
+  });
+  protein_ids.forEach(protein_id => {
+    prefetched[protein_id] = batch.then(structures => {
+      if (!(protein_id in structures))
+        throw new Error("Structure of " + protein_id + " not prefetched");
+      return fetch_pdb(structures[protein_id]);
+    });
+    prefetched[protein_id].catch(() => {}); // fetched again on selection
+  });
+}
+
+const fetch_mol = (protein_id) => {
+  let params = new URLSearchParams({job_number: job, protein_id: protein_id});
+  // Both responses carry ETags, the PDB URL is content-addressed and cached by the browser
+  let fetch_structure = () => fetch('/protein-structure?' + params.toString())
+  .then(async response => {
+    if (!response.ok)
       throw new Error("Error in fetch /protein-structure", {
-        cause: {status: response.status, response: response.json()}
+        cause: {status: response.status, response: await response.json()}
       });
-  })
+    return fetch_pdb(await response.json());
+  });
+  if (protein_id in prefetched)
+    return prefetched[protein_id].catch(fetch_structure);
+  return fetch_structure();
 }
 
 const draw_mol = (pdbstr, ret) => {